@@ -0,0 +1,81 @@
+"""
+Cost of encoding a request's metrics for the channel, as JSON versus the
+compact binary format used with ``KADABRA_BINARY_ENCODING``.
+
+For the metrics of a typical request, and of one recorded with
+``KADABRA_PHASE_TIMERS``, reports the time to encode them as the client does,
+the number of bytes put on the queue, and the time for the agent to decode
+them again:
+
+- ``json``: ``json.dumps(metrics.serialize())``, as the Redis channel does.
+- ``msgpack``: the same dictionary packed with msgpack, if it is installed,
+  for comparison with a generic binary format.
+- ``binary``: :func:`flask_kadabra.encode_metrics`.
+
+Run from the repository root after installing the extension in development
+mode (``pip install -e .``)::
+
+    python benchmarks/bench_encoding.py [iterations]
+"""
+import datetime, json, sys, timeit
+
+import kadabra
+
+import flask_kadabra
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+def make_metrics(phases):
+    collector = kadabra.Kadabra().metrics()
+    collector.set_dimension("method", "get_user")
+    now = datetime.datetime.utcnow()
+    unit = kadabra.Units.MILLISECONDS
+    if phases:
+        for name, millis in (("PreDispatchTime", 0.3), ("ViewTime", 12.5),
+                ("AfterRequestTime", 0.2), ("ResponseTime", 0.4)):
+            collector.set_timer(name, datetime.timedelta(milliseconds=millis),
+                    unit)
+    collector.set_timer("RequestTime", datetime.timedelta(milliseconds=13.4),
+            unit, timestamp=now)
+    collector.add_count("Failure", 0, timestamp=now)
+    collector.add_count("ClientError", 0, timestamp=now)
+    return collector.close()
+
+def json_encode(metrics):
+    return json.dumps(metrics.serialize())
+
+def json_decode(raw):
+    return kadabra.Metrics.deserialize(json.loads(raw))
+
+def msgpack_encode(metrics):
+    return msgpack.packb(metrics.serialize())
+
+def msgpack_decode(raw):
+    return kadabra.Metrics.deserialize(msgpack.unpackb(raw))
+
+def bench(func, arg, iterations):
+    return min(timeit.repeat(lambda: func(arg), number=iterations,
+        repeat=5)) / iterations
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    formats = [("json", json_encode, json_decode)]
+    if msgpack is not None:
+        formats.append(("msgpack", msgpack_encode, msgpack_decode))
+    formats.append(("binary", flask_kadabra.encode_metrics,
+        flask_kadabra.decode_metrics))
+    print("%-8s %-8s %16s %8s %16s" % ("metrics", "format", "encode (us)",
+        "bytes", "decode (us)"))
+    for name, phases in (("request", False), ("phases", True)):
+        metrics = make_metrics(phases)
+        for format, encode, decode in formats:
+            raw = encode(metrics)
+            print("%-8s %-8s %16.2f %8d %16.2f" % (name, format,
+                bench(encode, metrics, iterations) * 1e6, len(raw),
+                bench(decode, raw, iterations) * 1e6))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+Per-request overhead of Flask-Kadabra on routes that don't record metrics.
+
+Compares the ``before_request`` work done for a non-instrumented route by:
+
+- ``none``: an application without the extension.
+- ``eager``: the 0.1.0 behavior, which created a collector on every request.
+- ``lazy``: the current extension, which only creates a collector on use.
+
+Run from the repository root after installing the extension in development
+mode (``pip install -e .``)::
+
+    python benchmarks/bench_lazy_metrics.py [iterations]
+"""
+import sys, timeit
+
+from flask import Flask, g, current_app
+from flask import _app_ctx_stack as stack
+
+import flask_kadabra
+
+def make_app(mode):
+    app = Flask(__name__)
+    app.config["DISABLE_KADABRA"] = True
+
+    @app.route('/health')
+    def health():
+        return 'ok'
+
+    if mode == 'lazy':
+        flask_kadabra.Kadabra(app)
+    elif mode == 'eager':
+        flask_kadabra.Kadabra(app)
+        # Replace the hook with the one shipped in 0.1.0.
+        def initialize_metrics():
+            ctx = stack.top
+            if ctx is not None:
+                ctx.kadabra_request_start_time = flask_kadabra._get_now()
+                g.metrics = current_app.kadabra.metrics()
+        app.before_request_funcs[None] = [initialize_metrics]
+    return app
+
+def bench_hooks(app, iterations):
+    # Time only the extension hooks, which is where the difference lies.
+    with app.test_request_context('/health'):
+        def run():
+            app.preprocess_request()
+        return min(timeit.repeat(run, number=iterations, repeat=5)) /\
+                iterations
+
+def bench_requests(app, iterations):
+    client = app.test_client()
+    def run():
+        client.get('/health')
+    return min(timeit.repeat(run, number=iterations, repeat=3)) / iterations
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    print("%-8s %16s %16s" % ("mode", "hooks (us/req)", "request (us/req)"))
+    for mode in ("none", "eager", "lazy"):
+        app = make_app(mode)
+        hooks = bench_hooks(app, iterations)
+        requests = bench_requests(app, iterations // 10)
+        print("%-8s %16.2f %16.2f" % (mode, hooks * 1e6, requests * 1e6))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+"""
+Per-request overhead of Flask-Kadabra under load, end to end.
+
+Drives the same application, with the metrics sent to a local stand-in for
+the channel, in four cases:
+
+- ``none``: a route of an application without the extension.
+- ``unrecorded``: a route that doesn't record metrics, with the extension.
+- ``recorded``: a route annotated with ``record_metrics``.
+- ``many``: a ``record_metrics`` route which also makes 20 ``g.metrics``
+  calls: counters, timers, a dimension, and ``g.metrics.timer`` blocks.
+
+Each case is run both through Flask's test client (``client``), which isolates
+the cost of the extension, and through a real WSGI server on localhost
+(``server``), with a keep-alive HTTP connection per client thread, several
+times over, keeping the fastest run. For each, it reports the throughput, the
+50th, 90th and 99th percentile latency, and the overhead of the median over
+the ``none`` case. For the test client it also reports, using
+:mod:`tracemalloc`, the peak memory allocated while handling a request and the
+number of memory blocks still allocated afterwards per request, which should
+be zero.
+
+Results can be saved as JSON and compared with those of a previous version,
+to catch regressions in the ``before_request`` and ``after_request`` hooks.
+The comparison is of the overhead over ``none`` rather than of the absolute
+latencies, so that it is meaningful across machines of similar speed. The
+script exits with a status of 1 if any overhead grew by more than the
+tolerance. The results of each release are kept in ``benchmarks/results``.
+
+Run from the repository root after installing the extension in development
+mode (``pip install -e .``)::
+
+    python benchmarks/bench_overhead.py [--requests N] [--rounds N]
+        [--threads N] [--save results.json] [--label VERSION]
+        [--compare benchmarks/results/0.2.0.dev0.json]
+"""
+import argparse, json, os, platform, sys, threading, time, tracemalloc
+
+try:
+    import http.client as httplib
+except ImportError:
+    import httplib
+
+from flask import Flask, g
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+import kadabra
+
+import flask_kadabra
+
+CASES = ("none", "unrecorded", "recorded", "many")
+
+class NullChannel(object):
+    # Stands in for the Redis channel: metrics are serialized as they would be
+    # for Redis, and then discarded.
+    def __init__(self):
+        self.sent = 0
+
+    def send(self, metrics):
+        json.dumps(metrics.serialize())
+        self.sent += 1
+
+def make_app(case):
+    app = Flask(__name__)
+
+    @app.route('/')
+    def index():
+        return 'ok'
+
+    if case == "none":
+        return app, '/'
+
+    @app.route('/recorded')
+    @flask_kadabra.record_metrics
+    def recorded():
+        return 'ok'
+
+    @app.route('/many')
+    @flask_kadabra.record_metrics
+    def many():
+        unit = kadabra.Units.MILLISECONDS
+        g.metrics.set_dimension("region", "east")
+        for i in range(6):
+            g.metrics.add_count("Count%d" % i, 1)
+        for i in range(6):
+            g.metrics.set_timer("Timer%d" % i, flask_kadabra._to_timedelta(
+                1000000), unit)
+        for i in range(7):
+            with g.metrics.timer("DatabaseTime"):
+                pass
+        return 'ok'
+
+    flask_kadabra.Kadabra(app)
+    app.kadabra.channel = NullChannel()
+    return app, {"unrecorded": "/", "recorded": "/recorded",
+            "many": "/many"}[case]
+
+def percentile(latencies, q):
+    return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+def summarize(latencies, elapsed):
+    latencies.sort()
+    return {
+        "throughput": len(latencies) / elapsed,
+        "p50": percentile(latencies, 0.5) / 1e3,
+        "p90": percentile(latencies, 0.9) / 1e3,
+        "p99": percentile(latencies, 0.99) / 1e3,
+    }
+
+def run_client(app, path, requests):
+    client = app.test_client()
+    for _ in range(min(requests, 1000)):
+        client.get(path)
+    latencies = []
+    clock = time.perf_counter_ns
+    start = clock()
+    for _ in range(requests):
+        before = clock()
+        client.get(path)
+        latencies.append(clock() - before)
+    result = summarize(latencies, (clock() - start) / 1e9)
+    result.update(measure_allocations(client, path, min(requests, 2000)))
+    return result
+
+def measure_allocations(client, path, requests):
+    tracemalloc.start()
+    try:
+        peaks = 0
+        before_blocks = sys.getallocatedblocks()
+        for _ in range(requests):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            client.get(path)
+            peaks += tracemalloc.get_traced_memory()[1] - before
+        retained = sys.getallocatedblocks() - before_blocks
+    finally:
+        tracemalloc.stop()
+    return {"peak_bytes": peaks / float(requests),
+            "retained_blocks": retained / float(requests)}
+
+class QuietHandler(WSGIRequestHandler):
+    # Keep connections alive, and don't log every request.
+    protocol_version = "HTTP/1.1"
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+def run_server(app, path, requests, threads):
+    server = make_server("127.0.0.1", 0, app, threaded=threads > 1,
+            request_handler=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    port = server.server_port
+    per_thread = requests // threads
+    latencies = [[] for _ in range(threads)]
+    barrier = threading.Barrier(threads + 1)
+
+    def client(latencies):
+        connection = httplib.HTTPConnection("127.0.0.1", port)
+        clock = time.perf_counter_ns
+        def get():
+            connection.request("GET", path)
+            connection.getresponse().read()
+        for _ in range(min(per_thread, 500)):
+            get()
+        barrier.wait()
+        for _ in range(per_thread):
+            before = clock()
+            get()
+            latencies.append(clock() - before)
+        connection.close()
+
+    clients = [threading.Thread(target=client, args=(l,)) for l in latencies]
+    for thread in clients:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter_ns()
+    for thread in clients:
+        thread.join()
+    elapsed = (time.perf_counter_ns() - start) / 1e9
+    server.shutdown()
+    server.server_close()
+    return summarize([l for thread in latencies for l in thread], elapsed)
+
+def compare(results, baseline, tolerance, slack):
+    # Return the (mode, case, before, after) overheads that regressed.
+    regressions = []
+    for mode, cases in results["results"].items():
+        for case, result in cases.items():
+            before = baseline["results"].get(mode, {}).get(case)
+            if before is None or case == "none":
+                continue
+            # An overhead within the noise can come out negative.
+            limit = max(before["overhead"], 0) * (1 + tolerance) + slack
+            if result["overhead"] > limit:
+                regressions.append((mode, case, before["overhead"],
+                    result["overhead"]))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--requests", type=int, default=20000,
+            help="requests per case (default: %(default)s)")
+    parser.add_argument("--rounds", type=int, default=3,
+            help="times to run each case, keeping the best (default: "
+            "%(default)s)")
+    parser.add_argument("--threads", type=int, default=1,
+            help="client threads for the WSGI server (default: %(default)s)")
+    parser.add_argument("--mode", choices=("client", "server"),
+            action="append", help="only run through the test client or the "
+            "server")
+    parser.add_argument("--save", metavar="PATH", help="save the results")
+    parser.add_argument("--label", help="the version to save the results as "
+            "(default: the installed version)")
+    parser.add_argument("--compare", metavar="PATH",
+            help="compare with previously saved results")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+            help="relative growth in overhead to report as a regression "
+            "(default: %(default)s)")
+    parser.add_argument("--slack", type=float, default=5.0,
+            help="absolute growth in overhead, in microseconds, to ignore "
+            "as noise (default: %(default)s)")
+    args = parser.parse_args()
+
+    results = {
+        "version": args.label or flask_kadabra.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "requests": args.requests,
+        "rounds": args.rounds,
+        "threads": args.threads,
+        "results": {},
+    }
+    print("%-7s %-10s %10s %9s %9s %9s %9s %10s %9s" % ("mode", "case",
+        "req/s", "p50 (us)", "p90 (us)", "p99 (us)", "overhead", "peak (B)",
+        "retained"))
+    for mode in args.mode or ("client", "server"):
+        cases = results["results"][mode] = {}
+        # Run the cases in turn, several times over, and keep the best run of
+        # each so that they are equally affected by anything else going on.
+        for _ in range(args.rounds):
+            for case in CASES:
+                app, path = make_app(case)
+                if mode == "client":
+                    result = run_client(app, path, args.requests)
+                else:
+                    result = run_server(app, path, args.requests,
+                            args.threads)
+                if case not in cases or result["p50"] < cases[case]["p50"]:
+                    cases[case] = result
+        for case in CASES:
+            result = cases[case]
+            result["overhead"] = result["p50"] - cases["none"]["p50"]
+            print("%-7s %-10s %10.0f %9.1f %9.1f %9.1f %9.1f %10s %9s" % (
+                mode, case, result["throughput"], result["p50"],
+                result["p90"], result["p99"], result["overhead"],
+                "%.0f" % result["peak_bytes"] if "peak_bytes" in result
+                else "-", "%.2f" % result["retained_blocks"]
+                if "retained_blocks" in result else "-"))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write("\n")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance, args.slack)
+        print("\nCompared with %s (%s, Python %s):" % (
+            os.path.basename(args.compare), baseline["version"],
+            baseline["python"]))
+        for mode, case, before, after in regressions:
+            print("  %s/%s: overhead %.1f us -> %.1f us" % (mode, case,
+                before, after))
+        if regressions:
+            sys.exit(1)
+        print("  no regressions")
+
+if __name__ == '__main__':
+    main()
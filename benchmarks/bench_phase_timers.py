@@ -0,0 +1,48 @@
+"""
+Overhead of the per-phase timers enabled by ``KADABRA_PHASE_TIMERS``.
+
+Times complete requests through the test client to a route annotated with
+``record_metrics``, with phase timers disabled and enabled. Sending is
+disabled, so only the cost of recording is measured.
+
+Run from the repository root after installing the extension in development
+mode (``pip install -e .``)::
+
+    python benchmarks/bench_phase_timers.py [iterations]
+"""
+import sys, timeit
+
+from flask import Flask
+
+import flask_kadabra
+
+def make_app(phase_timers):
+    app = Flask(__name__)
+    app.config["DISABLE_KADABRA"] = True
+    app.config["KADABRA_PHASE_TIMERS"] = phase_timers
+
+    @app.route('/')
+    @flask_kadabra.record_metrics
+    def index():
+        return 'ok'
+
+    flask_kadabra.Kadabra(app)
+    return app
+
+def bench(app, iterations):
+    client = app.test_client()
+    def run():
+        client.get('/').close()
+    return min(timeit.repeat(run, number=iterations, repeat=5)) / iterations
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    disabled = bench(make_app(False), iterations)
+    enabled = bench(make_app(True), iterations)
+    print("phase timers disabled: %8.2f us/request" % (disabled * 1e6))
+    print("phase timers enabled:  %8.2f us/request" % (enabled * 1e6))
+    print("overhead:              %8.2f us/request" %\
+            ((enabled - disabled) * 1e6))
+
+if __name__ == '__main__':
+    main()
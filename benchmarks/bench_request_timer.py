@@ -0,0 +1,80 @@
+"""
+Overhead of timing a request with the wall clock versus a monotonic clock.
+
+Compares the work done when a request starts, which every request pays for,
+and when an instrumented request finishes:
+
+- ``datetime``: the 0.1.0 approach, a ``datetime.utcnow()`` call at the start
+  and another at the end, subtracted to produce a ``timedelta``.
+- ``clock``: a read of the monotonic nanosecond clock used by the extension at
+  the start, and another at the end converted to a ``timedelta``.
+
+It also times the extension's ``before_request`` and ``after_request`` hooks
+for a route annotated with ``record_metrics``.
+
+Run from the repository root after installing the extension in development
+mode (``pip install -e .``)::
+
+    python benchmarks/bench_request_timer.py [iterations]
+"""
+import datetime, sys, timeit
+
+from flask import Flask
+
+import flask_kadabra
+
+utcnow = datetime.datetime.utcnow
+get_clock = flask_kadabra._get_clock
+
+DATETIME_START = utcnow()
+CLOCK_START = get_clock()
+
+def start_datetime():
+    return utcnow()
+
+def finish_datetime():
+    return utcnow() - DATETIME_START
+
+def start_clock():
+    return get_clock()
+
+def finish_clock():
+    return datetime.timedelta(0, 0, (get_clock() - CLOCK_START) // 1000)
+
+def make_app():
+    app = Flask(__name__)
+    app.config["DISABLE_KADABRA"] = True
+
+    @app.route('/')
+    @flask_kadabra.record_metrics
+    def index():
+        return 'ok'
+
+    flask_kadabra.Kadabra(app)
+    return app
+
+def bench_hooks(app, iterations):
+    with app.test_request_context('/'):
+        view = app.view_functions['index']
+        response = app.make_response('ok')
+        def run():
+            app.preprocess_request()
+            view()
+            app.process_response(response)
+        return min(timeit.repeat(run, number=iterations, repeat=5)) /\
+                iterations
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print("%-10s %16s %16s" % ("timer", "start (us/req)", "finish (us/req)"))
+    for name, start, finish in (("datetime", start_datetime, finish_datetime),
+            ("clock", start_clock, finish_clock)):
+        start = min(timeit.repeat(start, number=iterations, repeat=5))
+        finish = min(timeit.repeat(finish, number=iterations, repeat=5))
+        print("%-10s %16.3f %16.3f" % (name, start / iterations * 1e6,
+            finish / iterations * 1e6))
+    hooks = bench_hooks(make_app(), iterations // 10)
+    print("extension hooks: %.3f us/request" % (hooks * 1e6))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Startup cost of Flask-Kadabra: what it adds to starting a process that never
+sends metrics, such as a ``flask`` command, and what is deferred to the first
+request that does.
+
+Each measurement is taken in a fresh interpreter, several times over, and the
+median is reported, in milliseconds, for:
+
+- ``import flask``: importing Flask, for reference.
+- ``import flask_kadabra``: importing the extension once Flask is imported.
+- ``init_app``: creating a :class:`~flask_kadabra.Kadabra` for an application
+  with one route annotated with ``record_metrics``.
+- ``first request``: the first request to that route through the test client,
+  which creates the :class:`~kadabra.Kadabra` client, importing the Redis
+  library and setting up the channel. The channel is then swapped for one that
+  discards metrics, so that no Redis server is needed.
+- ``second request``: the next request, for comparison.
+
+Run from the repository root after installing the extension in development
+mode (``pip install -e .``)::
+
+    python benchmarks/bench_startup.py [--runs N]
+"""
+import argparse, json, subprocess, sys
+
+CHILD = r"""
+import json, sys, time
+clock = time.perf_counter
+timings = {}
+start = clock()
+import flask
+timings["import flask"] = clock() - start
+start = clock()
+import flask_kadabra
+timings["import flask_kadabra"] = clock() - start
+app = flask.Flask("bench")
+
+@app.route("/")
+@flask_kadabra.record_metrics
+def index():
+    return "ok"
+
+start = clock()
+flask_kadabra.Kadabra(app)
+timings["init_app"] = clock() - start
+
+class NullChannel(object):
+    def send(self, metrics):
+        pass
+
+app.kadabra.channel_wrapper = lambda channel: NullChannel()
+client = app.test_client()
+for name in ("first request", "second request"):
+    start = clock()
+    client.get("/")
+    timings[name] = clock() - start
+json.dump(timings, sys.stdout)
+"""
+
+STEPS = ("import flask", "import flask_kadabra", "init_app", "first request",
+        "second request")
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=15,
+            help="fresh interpreters to measure (default: %(default)s)")
+    args = parser.parse_args()
+
+    runs = [json.loads(subprocess.check_output([sys.executable, "-c", CHILD]))
+            for _ in range(args.runs)]
+    print("%-22s %10s %10s %10s" % ("step", "median", "min", "max"))
+    for step in STEPS:
+        values = [run[step] * 1e3 for run in runs]
+        print("%-22s %10.2f %10.2f %10.2f" % (step, median(values),
+            min(values), max(values)))
+
+if __name__ == '__main__':
+    main()
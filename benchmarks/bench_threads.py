@@ -0,0 +1,162 @@
+"""
+Throughput of recording metrics from many threads at once.
+
+Records requests into an :class:`~flask_kadabra.Aggregator`, a
+:class:`~flask_kadabra.SketchAggregator`, and a
+:class:`~flask_kadabra.BatchSender`, and sends metrics through an
+:class:`~flask_kadabra.AsyncSender`, a
+:class:`~flask_kadabra.CircuitBreakerSender` (to channels which discard them),
+and a :class:`~flask_kadabra.DatagramSender` (to a UDP socket which is never
+read), from 1, 2, 4, ... threads at the same time, with the flusher and worker
+threads running. It reports the total number of records per second for each
+number of threads, and its ratio to the single threaded throughput. Each
+thread records into its own buffer and counts into its own counters, so the
+ratio should stay close to 1 as threads are added on an interpreter with a
+global interpreter lock, and grow with the number of cores on one without.
+The exception is the ``AsyncSender``, whose queue is shared by every thread.
+
+With ``--locked``, each component is also run with every record taking a
+lock shared by every thread, to show what such a lock costs.
+
+Every run also checks that no record was lost.
+
+Run from the repository root after installing the extension in development
+mode (``pip install -e .``)::
+
+    python benchmarks/bench_threads.py [--records N] [--max-threads N]
+        [--rounds N] [--locked]
+"""
+import argparse, datetime, platform, socket, sys, threading, time
+
+import kadabra
+import flask_kadabra
+
+class Counter(object):
+    # Stands in for a client or sender, counting what it is sent.
+    def __init__(self, count=lambda metrics: 1):
+        self.count = count
+        self.received = 0
+
+    def send(self, metrics):
+        self.received += self.count(metrics)
+
+def request_count(metrics):
+    return sum(c.value for c in metrics.counters
+            if c.name in ("RequestTime.count", "RequestTime.sketch"))
+
+METRICS = kadabra.Metrics([kadabra.Dimension("method", "index")], [], [])
+
+# Each of these returns a function which closes the component, one which
+# records a request, and one which counts the records that came out the other
+# end.
+
+def make_aggregator():
+    sink = Counter(request_count)
+    unit = flask_kadabra.Aggregator(sink, window=0.1)
+    return unit.close, lambda dimensions, request_time: unit.record(
+            dimensions, request_time, 0, 0), lambda: sink.received
+
+def make_sketches():
+    sink = Counter(request_count)
+    unit = flask_kadabra.SketchAggregator(sink, interval=0.1)
+    return unit.close, unit.record, lambda: sink.received
+
+def make_batch():
+    sink = Counter()
+    unit = flask_kadabra.BatchSender(sink, batch_size=100, max_latency=0.01)
+    return unit.close, lambda dimensions, request_time: unit.send(
+            request_time), lambda: sink.received
+
+def make_async():
+    sink = Counter()
+    # Blocks rather than drops, so that nothing is lost while the worker
+    # catches up.
+    unit = flask_kadabra.AsyncSender(sink, queue_size=10000,
+            overflow="block", block_timeout=60)
+    return unit.close, lambda dimensions, request_time: unit.send(
+            request_time), lambda: sink.received
+
+def make_breaker():
+    unit = flask_kadabra.CircuitBreakerSender(Counter())
+    return unit.close, lambda dimensions, request_time: unit.send(
+            request_time), lambda: unit.sent
+
+def make_datagram():
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(("127.0.0.1", 0))
+    unit = flask_kadabra.DatagramSender(sink.getsockname())
+    def close():
+        unit.close()
+        sink.close()
+    return close, lambda dimensions, request_time: unit.send(METRICS),\
+            lambda: unit.sent + unit.dropped
+
+COMPONENTS = (("aggregator", make_aggregator), ("sketch", make_sketches),
+        ("batch", make_batch), ("async", make_async),
+        ("breaker", make_breaker), ("datagram", make_datagram))
+
+def run(name, make, threads, records, locked):
+    close, record, received = make()
+    if locked:
+        lock = threading.Lock()
+        unlocked = record
+        def record(dimensions, request_time):
+            with lock:
+                unlocked(dimensions, request_time)
+    dimensions = [{"method": "route%d" % i} for i in range(8)]
+    times = [datetime.timedelta(milliseconds=i) for i in range(50)]
+    barrier = threading.Barrier(threads + 1)
+
+    def target():
+        barrier.wait()
+        for i in range(records):
+            record(dimensions[i & 7], times[i % 50])
+
+    workers = [threading.Thread(target=target) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    close()
+    if received() != threads * records:
+        sys.exit("%s lost records: %s of %s" % (name, received(),
+            threads * records))
+    return threads * records / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--records", type=int, default=50000,
+            help="records per thread (default: %(default)s)")
+    parser.add_argument("--max-threads", type=int, default=16,
+            help="the most threads to run (default: %(default)s)")
+    parser.add_argument("--rounds", type=int, default=3,
+            help="times to run each case, keeping the best (default: "
+            "%(default)s)")
+    parser.add_argument("--locked", action="store_true",
+            help="also run with a lock shared by every thread")
+    args = parser.parse_args()
+
+    counts = [1]
+    while counts[-1] * 2 <= args.max_threads:
+        counts.append(counts[-1] * 2)
+    gil = getattr(sys, "_is_gil_enabled", lambda: True)()
+    print("Python %s (%s), GIL %s" % (platform.python_version(),
+        platform.platform(), "enabled" if gil else "disabled"))
+    print("%-10s %-8s %8s %12s %8s" % ("component", "buffers", "threads",
+        "records/s", "scaling"))
+    for name, make in COMPONENTS:
+        for locked in (False, True) if args.locked else (False,):
+            single = None
+            for threads in counts:
+                rate = max(run(name, make, threads, args.records, locked)
+                        for _ in range(args.rounds))
+                single = single or rate
+                print("%-10s %-8s %8d %12.0f %7.2fx" % (name,
+                    "shared" if locked else "thread", threads, rate,
+                    rate / single))
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,46 @@
-import datetime
+import atexit, bisect, collections, datetime, errno, fnmatch, inspect
+import itertools, json, logging, math, mmap, os, random, select, socket
+import struct, sys, threading, time, weakref, zlib
 import kadabra
 
-from flask import g, current_app
+from kadabra.channels import RedisChannel
+from kadabra.client import MetricsCollector, CollectorClosedError
+from kadabra.config import DEFAULT_CONFIG
+from kadabra.utils import timedelta_total_seconds
+
+if (sys.version_info > (3, 0)):
+    from queue import Queue, Full, Empty
+else:
+    from Queue import Queue, Full, Empty
+
+try:
+    from contextvars import ContextVar
+except ImportError:
+    # Python 2, which has no coroutines to keep apart.
+    ContextVar = None
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where SharedAggregator can't be used.
+    fcntl = None
+
+from flask import g, current_app, request, got_request_exception, jsonify
 from flask import _app_ctx_stack as stack
+from flask import signals
 
 from functools import wraps
 
+from werkzeug.http import HTTP_STATUS_CODES
+from werkzeug.local import LocalProxy
+
 __version__ = '0.1.0'
 
 class Kadabra(object):
     """This object holds ties the Flask application object to the Kadabra
     library. Each app object gets its own :class:`~kadabra.Kadabra` instance,
-    which it uses to generate a :class:`~kadabra.client.MetricsCollector` for
-    each request.
+    created when it first sends metrics, and a
+    :class:`~kadabra.client.MetricsCollector` for each request.
 
     :param app: The Flask application object to initialize.
     :type app: ~flask.Flask
@@ -39,43 +67,541 @@ class Kadabra(object):
 
         The metrics object will be closed and sent at the end of the
         request if any view that handles the request has been annotated with
-        :data:`~flask_kadabra.record_metrics`."""
-        app.kadabra = kadabra.Kadabra(config)
+        :data:`~flask_kadabra.record_metrics`. This happens exactly once, even
+        if the request fails with an unhandled exception, in which case it is
+        counted as a failure and the exception's type is recorded as the
+        ``exception`` dimension.
+
+        The collector itself is created lazily, the first time ``g.metrics``
+        is used or when a view annotated with
+        :data:`~flask_kadabra.record_metrics` is dispatched, so requests to
+        routes that don't record metrics don't pay for one. Likewise, the
+        :class:`~kadabra.Kadabra` client, and with it the connection to the
+        channel, is only created when metrics are first sent, and again in
+        each process forked since, by the :class:`~flask_kadabra.LazyClient`
+        that is the application's ``kadabra`` attribute.
+
+        If ``KADABRA_ASYNC_SEND`` is set in the application's config, closed
+        metrics are handed to an :class:`~flask_kadabra.AsyncSender` instead of
+        being sent to the channel while the response is being returned. If
+        ``KADABRA_CIRCUIT_BREAKER`` is set, a
+        :class:`~flask_kadabra.CircuitBreakerSender` stops sending them to a
+        channel that keeps failing. If ``KADABRA_AGGREGATE`` is set, the
+        request time, failure, and client error metrics are rolled up by an
+        :class:`~flask_kadabra.Aggregator` rather than sent with every request.
+        If ``KADABRA_SKETCH`` is set, request time percentiles are tracked by a
+        :class:`~flask_kadabra.SketchAggregator`. If ``KADABRA_PHASE_TIMERS``
+        is set, the time spent in each phase of the request is recorded too,
+        and metrics are sent once the response has been sent rather than when
+        it is returned by the view. If ``KADABRA_WSGI_MIDDLEWARE`` is set, a
+        :class:`~flask_kadabra.KadabraMiddleware` is installed to measure
+        requests until their response has been closed. Whole blueprints and URL
+        rules can record metrics without annotating each of their views,
+        through ``KADABRA_RECORD_BLUEPRINTS``, ``KADABRA_RECORD_RULES``, and
+        :func:`~flask_kadabra.record_blueprint_metrics`. Request and response
+        sizes and status codes can be recorded too, and requests slower than
+        ``KADABRA_SLOW_REQUEST_THRESHOLD`` captured in a
+        :class:`~flask_kadabra.SlowRequestLog`. If ``KADABRA_PROMETHEUS`` is
+        set, running totals are kept by a
+        :class:`~flask_kadabra.PrometheusExporter` and served for Prometheus to
+        scrape. See :doc:`configuration`."""
+        app.kadabra = LazyClient(config)
+        app.kadabra_dimensions = _Dimensions(app.kadabra.default_dimensions)
+        app.kadabra_view_dimensions = {}
+        app.kadabra_endpoints = {}
+        app.kadabra_limiter = _get_limiter(app)
+        app.kadabra_sender = _get_sender(app)
+        app.kadabra_aggregator = _get_aggregator(app)
+        app.kadabra_sketches = _get_sketches(app)
+        app.kadabra_prometheus = _get_prometheus(app)
+        app.kadabra_sampler = _get_sampler(app)
+        app.kadabra_phase_timers = app.config.get("KADABRA_PHASE_TIMERS",
+                False)
+        app.kadabra_middleware = app.config.get("KADABRA_WSGI_MIDDLEWARE",
+                False)
+        app.kadabra_finalizers = _get_finalizers(app)
+        app.kadabra_slow_requests = _get_slow_requests(app)
+        app.kadabra_profiler = _get_profiler(app)
+        if app.kadabra_middleware:
+            app.wsgi_app = KadabraMiddleware(app.wsgi_app)
+        elif app.kadabra_phase_timers:
+            app.wsgi_app = _WSGIStart(app.wsgi_app)
+        if app.kadabra_phase_timers:
+            app.dispatch_request = _stamp_dispatch(app.dispatch_request)
         self.app = app
 
         @app.before_request
         def initialize_metrics():
             ctx = stack.top
             if ctx is not None:
-                ctx.kadabra_request_start_time = _get_now()
-                g.metrics = current_app.kadabra.metrics()
+                ctx.kadabra_request_start = _get_clock()
+                ctx.kadabra_metrics = None
+                g.metrics = metrics
+                rule = request.url_rule
+                if rule is not None:
+                    app = current_app._get_current_object()
+                    dimensions = _get_endpoint_dimensions(app, rule)
+                    if dimensions is not None:
+                        _start_recording(app, ctx, app.kadabra_sampler,
+                                rule.endpoint, dimensions)
 
         @app.after_request
         def transport_metrics(response):
             # Only send the metrics if the current view has "opted in".
             ctx = stack.top
             if ctx is not None and getattr(ctx, "enable_kadabra", False):
-                end_time = _get_now()
-                g.metrics.set_timer("RequestTime",
-                        (end_time - ctx.kadabra_request_start_time),
-                        kadabra.Units.MILLISECONDS)
-
-                failure = 0
-                client_error = 0
-                if response.status_code >= 500:
-                    failure = 1
-                elif response.status_code >= 400:
-                    client_error = 1
-
-                g.metrics.add_count("Failure", failure)
-                g.metrics.add_count("ClientError", client_error)
-
-                closed = g.metrics.close()
-                if not current_app.config.get("DISABLE_KADABRA"):
-                    current_app.kadabra.send(closed)
+                ctx.enable_kadabra = False
+                _finalize(current_app._get_current_object(), ctx, response)
             return response
 
-def record_metrics(func):
+        @app.teardown_request
+        def finalize_metrics(exception):
+            # after_request functions are skipped when an exception propagates
+            # out of the request, so make sure the request is still counted.
+            ctx = stack.top
+            if ctx is not None and getattr(ctx, "enable_kadabra", False):
+                ctx.enable_kadabra = False
+                _finalize(current_app._get_current_object(), ctx, None,
+                        exception)
+
+        if getattr(signals, "signals_available", True):
+            got_request_exception.connect(_note_exception, app)
+
+def _note_exception(sender, exception, **extra):
+    # Remember the exception that caused a request to fail, for the
+    # "exception" dimension.
+    ctx = stack.top
+    if ctx is not None:
+        ctx.kadabra_exception = exception
+
+def _finalize(app, ctx, response, exception=None):
+    # Record the built-in metrics for a request whose view has opted in, and
+    # send its metrics, or arrange for that to happen once the response has
+    # been sent if the phase timers or the WSGI middleware are enabled. If
+    # there is no response, the request failed with an unhandled exception
+    # and its metrics are sent right away.
+    end = _get_clock()
+    profile = None
+    if app.kadabra_profiler is not None:
+        profile = app.kadabra_profiler.stop(ctx.kadabra_profile)
+
+    failure = 0
+    client_error = 0
+    if response is None or response.status_code >= 500:
+        failure = 1
+    elif response.status_code >= 400:
+        client_error = 1
+
+    weight = ctx.kadabra_sample_weight
+    if failure and ctx.kadabra_keep_errors:
+        # Every failed request is recorded, whether it was sampled or not, so
+        # each one only stands for itself.
+        if weight is None:
+            collector = ctx.kadabra_metrics = _Collector(
+                    app.kadabra.timestamp_format,
+                    ctx.kadabra_dimensions,
+                    app.kadabra_limiter)
+        else:
+            collector = _get_metrics()
+        weight = 1.0
+    elif weight is None:
+        return
+    else:
+        collector = _get_metrics()
+
+    if exception is None:
+        exception = ctx.kadabra_exception
+    if exception is not None:
+        collector.set_dimension("exception", type(exception).__name__)
+
+    for finalizer in app.kadabra_finalizers:
+        finalizer(collector, response, weight)
+
+    phase_timers = app.kadabra_phase_timers
+    if phase_timers:
+        _record_phases(collector, ctx, end)
+
+    disabled = app.config.get("DISABLE_KADABRA")
+    if response is None:
+        _complete(app, collector,
+                _to_timedelta(end - ctx.kadabra_request_start), failure,
+                client_error, weight, disabled, profile)
+    elif app.kadabra_middleware:
+        # The request time and response size are only known once the
+        # middleware has seen the whole response.
+        def finish(start, first_byte, response_size, closed):
+            unit = kadabra.Units.MILLISECONDS
+            if phase_timers:
+                collector.set_timer("ResponseTime",
+                        _to_timedelta(closed - end), unit)
+            if first_byte is not None:
+                collector.set_timer("TimeToFirstByte",
+                        _to_timedelta(first_byte - start), unit)
+            collector.add_count("ResponseSize", response_size * weight)
+            _complete(app, collector, _to_timedelta(closed - start), failure,
+                    client_error, weight, disabled, profile)
+        request.environ["kadabra.finish"] = finish
+    elif phase_timers:
+        request_time = _to_timedelta(end - ctx.kadabra_request_start)
+        def send():
+            collector.set_timer("ResponseTime",
+                    _to_timedelta(_get_clock() - end),
+                    kadabra.Units.MILLISECONDS)
+            _complete(app, collector, request_time, failure, client_error,
+                    weight, disabled, profile)
+        response.call_on_close(send)
+    else:
+        _complete(app, collector,
+                _to_timedelta(end - ctx.kadabra_request_start), failure,
+                client_error, weight, disabled, profile)
+
+def _complete(app, collector, request_time, failure, client_error, weight,
+        disabled, profile=None):
+    # Add the request time, failure, and client error metrics to the
+    # collector (or the aggregator), and send it. Slow requests are captured
+    # along with the stacks sampled while they were handled, if any.
+    slow_requests = app.kadabra_slow_requests
+    if (slow_requests is not None and not disabled and
+            request_time >= slow_requests.threshold):
+        slow_requests.capture(collector, request_time, profile)
+
+    sketches = app.kadabra_sketches
+    if sketches is not None and not disabled:
+        sketches.record(collector.dimensions, request_time, weight)
+
+    prometheus = app.kadabra_prometheus
+    if prometheus is not None and not disabled:
+        prometheus.record(collector.dimensions, request_time, failure,
+                client_error, weight)
+
+    aggregator = app.kadabra_aggregator
+    if aggregator is not None:
+        counters = _pop_aggregated(collector, aggregator.counters,
+                aggregator.timers, weight)
+        if not disabled:
+            aggregator.record(collector.dimensions, request_time, failure,
+                    client_error, weight, counters)
+        if not collector.counters and not collector.timers:
+            # Nothing was recorded besides what was aggregated.
+            return
+    else:
+        now = _get_now()
+        if weight != 1.0:
+            failure *= weight
+            client_error *= weight
+            collector.add_count("SampleWeight", weight, timestamp=now)
+        collector.set_timer("RequestTime", request_time,
+                kadabra.Units.MILLISECONDS, timestamp=now)
+        collector.add_count("Failure", failure, timestamp=now)
+        collector.add_count("ClientError", client_error, timestamp=now)
+
+    closed = collector.close()
+    if not disabled:
+        app.kadabra_sender.send(closed)
+
+def _pop_aggregated(collector, counters, timers, weight):
+    # Take the built-in counters and timers the aggregator rolls up out of the
+    # collector, so that they don't cause the request to be sent on its own.
+    # Each timer is passed on as its weighted count and total.
+    if not counters and not timers:
+        return None
+    recorded = collector.counters
+    values = [recorded.pop(name)["value"] if name in recorded else 0
+            for name in counters]
+    recorded = collector.timers
+    for name in timers:
+        timer = recorded.pop(name, None)
+        if timer is None:
+            values.extend((0, 0.0))
+        else:
+            values.extend((weight, _to_millis(timer["value"]) * weight))
+    return tuple(values)
+
+def _record_phases(collector, ctx, end):
+    # Time spent before the view was called (measured from when the request
+    # entered the WSGI application), in the view, and after it returned.
+    unit = kadabra.Units.MILLISECONDS
+    view_start = ctx.kadabra_view_start
+    start = request.environ.get("kadabra.start")
+    if start is not None:
+        collector.set_timer("PreDispatchTime",
+                _to_timedelta(view_start - start), unit)
+    view_end = ctx.kadabra_view_end
+    if view_end is not None:
+        collector.set_timer("ViewTime", _to_timedelta(view_end - view_start),
+                unit)
+        collector.set_timer("AfterRequestTime",
+                _to_timedelta(end - view_end), unit)
+
+def _get_finalizers(app):
+    # The optional built-in metrics that are enabled, each recorded by a
+    # function called with the collector, the response (None if the request
+    # failed with an unhandled exception), and the sample weight. Metrics
+    # that aren't enabled cost nothing.
+    finalizers = []
+    if app.config.get("KADABRA_REQUEST_SIZE", False):
+        finalizers.append(_record_request_size)
+    if (app.config.get("KADABRA_RESPONSE_SIZE", False) and
+            not app.kadabra_middleware):
+        # The middleware counts the bytes of the body itself.
+        finalizers.append(_record_response_size)
+    if app.config.get("KADABRA_STATUS_COUNTS", False):
+        finalizers.append(_record_status_counts)
+    if app.config.get("KADABRA_STATUS_DIMENSION", False):
+        finalizers.append(_record_status_dimension)
+    return tuple(finalizers)
+
+def _get_aggregated_counters(app):
+    # The built-in counters that every request records if enabled, which the
+    # aggregator rolls up rather than sending each request on their account.
+    names = []
+    if app.config.get("KADABRA_REQUEST_SIZE", False):
+        names.append("RequestSize")
+    if (app.config.get("KADABRA_RESPONSE_SIZE", False) or
+            app.config.get("KADABRA_WSGI_MIDDLEWARE", False)):
+        names.append("ResponseSize")
+    if app.config.get("KADABRA_STATUS_COUNTS", False):
+        names.extend(name for value, name in _STATUS_CLASSES)
+    return names
+
+def _get_aggregated_timers(app):
+    # The built-in timers that requests record if enabled, which the
+    # aggregator rolls up in the same way.
+    names = []
+    if app.config.get("KADABRA_PHASE_TIMERS", False):
+        names.extend(("PreDispatchTime", "ViewTime", "AfterRequestTime",
+            "ResponseTime"))
+    if app.config.get("KADABRA_WSGI_MIDDLEWARE", False):
+        names.append("TimeToFirstByte")
+    return names
+
+def _record_request_size(collector, response, weight):
+    collector.add_count("RequestSize", (request.content_length or 0) * weight)
+
+def _record_response_size(collector, response, weight):
+    # Streamed responses don't know their length until they've been sent, and
+    # aren't consumed here to find out.
+    if response is not None:
+        size = response.content_length
+        if size is None and response.is_sequence:
+            size = sum(len(chunk) for chunk in response.iter_encoded())
+        if size is not None:
+            collector.add_count("ResponseSize", size * weight)
+
+_STATUS_CLASSES = ((2, "Status2xx"), (3, "Status3xx"), (4, "Status4xx"),
+        (5, "Status5xx"))
+
+def _record_status_counts(collector, response, weight):
+    status_class = _get_status_code(response) // 100
+    for value, name in _STATUS_CLASSES:
+        collector.add_count(name, weight if value == status_class else 0)
+
+def _record_status_dimension(collector, response, weight):
+    status_code = _get_status_code(response)
+    collector.set_dimension("status", str(status_code)
+            if status_code in HTTP_STATUS_CODES else "other")
+
+def _get_status_code(response):
+    return 500 if response is None else response.status_code
+
+class LazyClient(object):
+    """Stands in for the :class:`~kadabra.Kadabra` client that metrics are
+    sent with, creating it the first time metrics are sent rather than when
+    the application is created, and creating a new one in each process forked
+    since. Senders and aggregators which send from a thread of their own have
+    it created when they start that thread, so that it isn't first needed
+    while the interpreter is shutting down. Creating the client imports the Redis library and sets up the
+    channel's connection pool, which commands and workers that never send any
+    metrics are spared, and the processes of a pre-forking server each get
+    their own connections instead of sharing those of the process they were
+    forked from.
+
+    The default dimensions and timestamp format, and :meth:`metrics`, are
+    available without creating the client.
+
+    It is created by :meth:`~flask_kadabra.Kadabra.init_app` as the
+    application's ``kadabra`` attribute.
+
+    :param config: Dictionary of configuration to use for the
+                   :class:`~kadabra.Kadabra` client API.
+    :type config: dict
+
+    :param channel_wrapper: A function which is passed the channel of each
+                            client created, and returns the channel to use
+                            instead.
+    :type channel_wrapper: function
+    """
+    def __init__(self, config=None, channel_wrapper=None):
+        self.config = config
+        self.channel_wrapper = channel_wrapper
+        settings = DEFAULT_CONFIG.copy()
+        if config:
+            settings.update(config)
+        self.default_dimensions = settings.get("CLIENT_DEFAULT_DIMENSIONS",
+                {})
+        self.timestamp_format = settings["CLIENT_TIMESTAMP_FORMAT"]
+
+        self._lock = threading.Lock()
+        self._client = None
+        self._pid = None
+
+    @property
+    def client(self):
+        """The :class:`~kadabra.Kadabra` client of the current process,
+        which is created if it doesn't exist yet."""
+        pid = os.getpid()
+        if self._pid == pid:
+            return self._client
+        with self._lock:
+            if self._pid != pid:
+                # Either this is the first use, or we are in a forked child
+                # which mustn't use the parent's connections.
+                client = kadabra.Kadabra(self.config)
+                if self.channel_wrapper is not None:
+                    client.channel = self.channel_wrapper(client.channel)
+                self._client = client
+                self._pid = pid
+            return self._client
+
+    @property
+    def channel(self):
+        """The channel of the current process's client."""
+        return self.client.channel
+
+    @channel.setter
+    def channel(self, channel):
+        self.client.channel = channel
+
+    def metrics(self):
+        """Return a :class:`~kadabra.client.MetricsCollector` initialized
+        with the default dimensions, without creating the client.
+
+        :rtype: ~kadabra.client.MetricsCollector
+        """
+        return MetricsCollector(self.timestamp_format,
+                **self.default_dimensions)
+
+    def send(self, metrics):
+        """Send metrics with the current process's client, creating it if
+        needed.
+
+        :param metrics: The metrics to send.
+        :type metrics: ~kadabra.Metrics
+        """
+        self.client.send(metrics)
+
+    def _prepare(self):
+        self.client
+
+def _prepare_client(sender):
+    # Create the client at the end of a chain of senders now, when a sender
+    # or aggregator that sends from a thread of its own starts it, rather
+    # than on the first send. That may only come from an atexit hook, by
+    # which time the Redis library can't register its own hooks any more.
+    prepare = getattr(sender, "_prepare", None)
+    if prepare is not None:
+        prepare()
+
+def _stamp_dispatch(dispatch_request):
+    # Stamps the view boundaries for the phase timers of requests recorded
+    # for their blueprint or URL rule, whose views aren't wrapped by
+    # record_metrics to do it themselves.
+    @wraps(dispatch_request)
+    def stamped_dispatch_request(*args, **kwargs):
+        ctx = stack.top
+        if ctx is None or not getattr(ctx, "enable_kadabra", False):
+            return dispatch_request(*args, **kwargs)
+        ctx.kadabra_view_start = _get_clock()
+        rv = dispatch_request(*args, **kwargs)
+        ctx.kadabra_view_end = _get_clock()
+        return rv
+    return stamped_dispatch_request
+
+class _WSGIStart(object):
+    # Stamps the time a request entered the WSGI application, for the
+    # PreDispatchTime phase timer.
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        environ["kadabra.start"] = _get_clock()
+        return self.wsgi_app(environ, start_response)
+
+class KadabraMiddleware(object):
+    """WSGI middleware which defers sending a request's metrics until the
+    WSGI server has closed the response, so that streamed and large responses
+    are measured in full. This is installed around the application's
+    :attr:`~flask.Flask.wsgi_app` by :meth:`~flask_kadabra.Kadabra.init_app`
+    if ``KADABRA_WSGI_MIDDLEWARE`` is set in the application's config; you
+    shouldn't need to create it yourself.
+
+    For requests to routes that record metrics, the "RequestTime" timer then
+    measures from when the request entered the WSGI application until the
+    response was closed, and the following are recorded as well:
+
+    - A "TimeToFirstByte" timer, in milliseconds, until the first non-empty
+      chunk of the body was produced.
+    - A "ResponseSize" counter with the number of bytes in the body.
+
+    Other requests are passed through untouched. Note that for instrumented
+    requests the response is wrapped, so a WSGI server can't recognize its own
+    ``wsgi.file_wrapper`` to send files more efficiently. If the server never
+    closes the response, as the WSGI specification requires, its metrics are
+    never sent.
+
+    :param wsgi_app: The WSGI application to wrap.
+    :type wsgi_app: function
+    """
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        start = environ["kadabra.start"] = _get_clock()
+        app_iter = self.wsgi_app(environ, start_response)
+        finish = environ.get("kadabra.finish")
+        if finish is None:
+            return app_iter
+        return _MeteredResponse(app_iter, start, finish)
+
+class _MeteredResponse(object):
+    # Wraps a response iterable to count its bytes and note when the first
+    # one was produced, and calls finish() when it is closed.
+    def __init__(self, app_iter, start, finish):
+        self.app_iter = app_iter
+        self.start = start
+        self.finish = finish
+        self.first_byte = None
+        self.size = 0
+        self._iter = None
+        self._finished = False
+
+    def __iter__(self):
+        self._iter = iter(self.app_iter)
+        return self
+
+    def __next__(self):
+        chunk = next(self._iter)
+        if chunk:
+            if self.first_byte is None:
+                self.first_byte = _get_clock()
+            self.size += len(chunk)
+        return chunk
+
+    next = __next__
+
+    def close(self):
+        try:
+            close = getattr(self.app_iter, "close", None)
+            if close is not None:
+                close()
+        finally:
+            if not self._finished:
+                self._finished = True
+                self.finish(self.start, self.first_byte, self.size,
+                        _get_clock())
+
+def record_metrics(func=None, sample_rate=None, max_per_second=None,
+        keep_errors=True):
     """Views that are annotated with this decorator will cause any request they
     handle to send all metrics collected via the Kadabra client API. For
     example::
@@ -85,17 +611,3319 @@ def record_metrics(func):
         def index():
             return 'Hello, world!'
 
+    To only record a fraction of the requests to a busy view, pass a sample
+    rate, a limit on the number of requests recorded per second, or both::
+
+        @api.route('/')
+        @record_metrics(sample_rate=0.1)
+        def index():
+            return 'Hello, world!'
+
+    Requests that are sampled out don't create a collector or send anything,
+    and ``g.metrics`` ignores whatever is recorded on it. Requests that are
+    recorded carry a ``SampleWeight`` counter with the number of requests they
+    stand for, and their ``Failure`` and ``ClientError`` counts are multiplied
+    by it, so that sums of these metrics remain unbiased. If no sampling
+    arguments are given, the application's ``KADABRA_SAMPLE_RATE`` and
+    ``KADABRA_SAMPLE_MAX_PER_SECOND`` configuration values are used.
+
     :param func: The view function to decorate.
     :type func: function
+
+    :param sample_rate: The probability that a request is recorded.
+    :type sample_rate: float
+
+    :param max_per_second: The approximate maximum number of requests recorded
+                           per second. The sample rate is adjusted every second
+                           based on the number of requests in the previous one.
+    :type max_per_second: float
+
+    :param keep_errors: Whether every request that fails with a server error
+                        is recorded, with a weight of ``1``, whether it was
+                        sampled or not. Only the requests that don't fail are
+                        then weighted by the sample rate.
+    :type keep_errors: bool
+
+    Coroutine functions (``async def`` views) can be annotated too, in which
+    case the decorated view is also a coroutine function.
     """
-    @wraps(func)
-    def decorated_view(*args, **kwargs):
+    if func is None:
+        return lambda func: record_metrics(func, sample_rate, max_per_second,
+                keep_errors)
+
+    name = func.__name__
+    sampler = None
+    if sample_rate is not None or max_per_second is not None:
+        sampler = _Sampler(sample_rate, max_per_second, keep_errors)
+
+    def start_view():
+        # Opt the current request in, and return its context, if there is one.
         ctx = stack.top
         if ctx is not None:
-            ctx.enable_kadabra = True
-            g.metrics.set_dimension("method", func.__name__)
-        return func(*args, **kwargs)
+            app = current_app._get_current_object()
+            _start_recording(app, ctx, sampler or app.kadabra_sampler, name,
+                    _get_view_dimensions(app, name))
+        return ctx
+
+    def finish_view(ctx):
+        ctx.kadabra_view_end = _get_clock()
+
+    if _iscoroutinefunction(func):
+        # Coroutine support needs syntax that isn't available on Python 2.
+        from flask_kadabra_asyncio import wrap_coroutine_view
+        decorated_view = wrap_coroutine_view(func, start_view, finish_view)
+    else:
+        @wraps(func)
+        def decorated_view(*args, **kwargs):
+            ctx = start_view()
+            if ctx is None:
+                return func(*args, **kwargs)
+            rv = func(*args, **kwargs)
+            finish_view(ctx)
+            return rv
+    # So that blueprints and URL rules which record metrics leave it be.
+    decorated_view.kadabra_recorded = True
     return decorated_view
 
-def _get_now():
-    return datetime.datetime.utcnow()
+def record_blueprint_metrics(blueprint):
+    """Record metrics for every request handled by a view of ``blueprint``,
+    as if each of them had been annotated with
+    :data:`~flask_kadabra.record_metrics`, including the views of any
+    blueprints registered on it. For example::
+
+        api = Blueprint('api', __name__)
+        record_blueprint_metrics(api)
+
+    Instead of the name of the view function, which need not be unique across
+    blueprints, such requests have the ``endpoint`` and ``url_rule``
+    dimensions, for example ``api.get_user`` and ``/users/<int:user_id>``.
+    Views annotated with :data:`~flask_kadabra.record_metrics` keep their own
+    settings. Blueprints can also be named in the application's
+    ``KADABRA_RECORD_BLUEPRINTS`` configuration value instead.
+
+    :param blueprint: The blueprint whose views should record metrics.
+    :type blueprint: ~flask.Blueprint
+
+    :rtype: ~flask.Blueprint
+    :returns: The blueprint.
+    """
+    blueprint.kadabra_record = True
+    return blueprint
+
+def timed(name=None):
+    """Time every call to the decorated function with
+    ``g.metrics.timer(name)`` (see :data:`~flask_kadabra.metrics`), for
+    example::
+
+        @timed("DatabaseTime")
+        def fetch_user(user_id):
+            ...
+
+    If no name is given, the name of the function is used. Calls made outside
+    of a request aren't timed. Coroutine functions can be decorated too.
+
+    :param name: The name of the timer.
+    :type name: str
+    """
+    if callable(name):
+        return timed()(name)
+
+    def decorator(func):
+        timer_name = name or func.__name__
+
+        def get_timer():
+            # The request's timer, or None outside of a request.
+            if stack.top is None:
+                return None
+            return _get_metrics().timer(timer_name)
+
+        if _iscoroutinefunction(func):
+            from flask_kadabra_asyncio import wrap_coroutine_timer
+            return wrap_coroutine_timer(func, get_timer)
+
+        @wraps(func)
+        def timed_function(*args, **kwargs):
+            timer = get_timer()
+            if timer is None:
+                return func(*args, **kwargs)
+            with timer:
+                return func(*args, **kwargs)
+        return timed_function
+    return decorator
+
+def _start_recording(app, ctx, sampler, name, dimensions):
+    # Opt the request in, deciding whether it is sampled, and give it a
+    # collector with the shared dimensions of what it is recorded as.
+    ctx.enable_kadabra = True
+    weight = 1.0 if sampler is None else sampler.sample(name)
+    ctx.kadabra_sample_weight = weight
+    ctx.kadabra_keep_errors = sampler is not None and sampler.keep_errors
+    if weight is None:
+        ctx.kadabra_metrics = _NULL_COLLECTOR
+        ctx.kadabra_dimensions = dimensions
+    else:
+        collector = getattr(ctx, "kadabra_metrics", None)
+        if collector is None:
+            ctx.kadabra_metrics = _Collector(app.kadabra.timestamp_format,
+                    dimensions, app.kadabra_limiter)
+        else:
+            # The request created a collector of its own before it got here.
+            defaults = app.kadabra_dimensions
+            for key, value in dimensions.items():
+                if key not in defaults:
+                    collector.set_dimension(key, value)
+    profiler = app.kadabra_profiler
+    if profiler is not None:
+        # Sample the thread the view runs on, which for async views isn't the
+        # one the request is finalized on.
+        profiler.stop(getattr(ctx, "kadabra_profile", None))
+        ctx.kadabra_profile = profiler.start()
+    ctx.kadabra_exception = None
+    ctx.kadabra_view_end = None
+    ctx.kadabra_view_start = _get_clock()
+
+def _get_view_dimensions(app, name):
+    # The default dimensions plus the view's name, built once per view.
+    dimensions = app.kadabra_view_dimensions.get(name)
+    if dimensions is None:
+        dimensions = dict(app.kadabra_dimensions)
+        dimensions["method"] = name
+        dimensions = app.kadabra_view_dimensions[name] =\
+                _Dimensions(dimensions)
+    return dimensions
+
+def _get_endpoint_dimensions(app, rule):
+    # The dimensions of requests to a URL rule whose blueprint or pattern is
+    # recorded, or None. Only the first request to each endpoint builds its
+    # entry; after that deciding is a single lookup for endpoints that
+    # aren't recorded, and two for those that are.
+    entry = app.kadabra_endpoints.get(rule.endpoint, _MISSING)
+    if entry is None:
+        return None
+    if entry is not _MISSING:
+        dimensions = entry.get(rule.rule, _MISSING)
+        if dimensions is not _MISSING:
+            return dimensions
+    entry = _build_endpoint_entry(app, rule.endpoint)
+    if entry is None:
+        return None
+    return entry.get(rule.rule)
+
+def _build_endpoint_entry(app, endpoint):
+    # Map each of the endpoint's URL rules to its dimensions if it should be
+    # recorded, and None if not; None stands for the whole endpoint if none
+    # of them are.
+    view = app.view_functions.get(endpoint)
+    entry = None
+    if not getattr(view, "kadabra_recorded", False):
+        blueprint = _is_blueprint_recorded(app, endpoint)
+        patterns = app.config.get("KADABRA_RECORD_RULES", ())
+        entry = {}
+        for rule in app.url_map.iter_rules(endpoint):
+            if blueprint or any(fnmatch.fnmatchcase(rule.rule, pattern)
+                    for pattern in patterns):
+                dimensions = dict(app.kadabra_dimensions)
+                dimensions["endpoint"] = endpoint
+                dimensions["url_rule"] = rule.rule
+                entry[rule.rule] = _Dimensions(dimensions)
+            else:
+                entry[rule.rule] = None
+        if not any(entry.values()):
+            entry = None
+    app.kadabra_endpoints[endpoint] = entry
+    return entry
+
+def _is_blueprint_recorded(app, endpoint):
+    # Whether the endpoint belongs to a recorded blueprint, or to one nested
+    # in a recorded blueprint.
+    names = app.config.get("KADABRA_RECORD_BLUEPRINTS", ())
+    name = endpoint.rpartition(".")[0]
+    while name:
+        blueprint = app.blueprints.get(name)
+        if name in names or getattr(blueprint, "kadabra_record", False):
+            return True
+        name = name.rpartition(".")[0]
+    return False
+
+class _Dimensions(dict):
+    # A frozen set of dimensions, shared by every collector created with it.
+    # The sorted items, which the aggregators key on, are computed once.
+    __slots__ = ("key",)
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.key = tuple(sorted(self.items()))
+
+    def _frozen(self, *args, **kwargs):
+        raise TypeError("Shared dimensions can't be modified")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update =\
+            _frozen
+
+class _Collector(MetricsCollector):
+    # A collector which starts out sharing a frozen set of dimensions, and
+    # only copies them if a dimension is set (copy-on-write). Values set are
+    # passed through the app's CardinalityLimiter, if there is one.
+    def __init__(self, timestamp_format, dimensions, limiter=None):
+        super(_Collector, self).__init__(timestamp_format)
+        self.dimensions = dimensions
+        self.limiter = limiter
+
+    def set_dimension(self, name, value):
+        folded = False
+        if self.limiter is not None:
+            limited = self.limiter.limit(name, value)
+            folded = limited is not value
+            value = limited
+        with self.lock:
+            if self.closed:
+                raise CollectorClosedError()
+            if self.dimensions.get(name, _MISSING) != value:
+                if type(self.dimensions) is _Dimensions:
+                    self.dimensions = dict(self.dimensions)
+                self.dimensions[name] = value
+        if folded:
+            self.add_count("FoldedDimensions", 1)
+
+    def timer(self, name):
+        """Return a context manager which times the code it wraps using a
+        monotonic clock, for example::
+
+            with g.metrics.timer("DatabaseTime"):
+                cursor.execute(...)
+
+        Every use of the same timer in a request is aggregated into a
+        ``<name>.count`` counter and ``<name>.sum`` and ``<name>.max`` timers,
+        in milliseconds, rather than overwriting the previous one. Timers used
+        inside another timer are named after it, separated by a slash: a
+        ``"DatabaseTime"`` timer inside a ``"Checkout"`` timer is recorded as
+        ``Checkout/DatabaseTime``. Coroutines run concurrently, for example
+        with :func:`asyncio.gather`, are named after the timer they were
+        started in rather than after each other.
+
+        :param name: The name of the timer.
+        :type name: str
+
+        :rtype: object
+        """
+        return _Timer(self, name)
+
+    def _record_span(self, path, nanoseconds):
+        # Fold one use of a timer into its count, sum, and max.
+        value = _to_timedelta(nanoseconds)
+        count_name = path + ".count"
+        sum_name = path + ".sum"
+        max_name = path + ".max"
+        with self.lock:
+            if self.closed:
+                raise CollectorClosedError()
+            count = self.counters.get(count_name)
+            if count is None:
+                now = _get_now()
+                self.counters[count_name] = {"metadata": {}, "timestamp": now,
+                        "value": 1.0}
+                for name in (sum_name, max_name):
+                    self.timers[name] = {"unit": kadabra.Units.MILLISECONDS,
+                            "metadata": {}, "timestamp": now, "value": value}
+            else:
+                count["value"] += 1.0
+                self.timers[sum_name]["value"] += value
+                longest = self.timers[max_name]
+                if value > longest["value"]:
+                    longest["value"] = value
+
+class _ThreadVar(object):
+    # The subset of ContextVar used by _Timer, with a value per thread.
+    def __init__(self, name, default=None):
+        self.default = default
+        self._local = threading.local()
+
+    def get(self):
+        return getattr(self._local, "value", self.default)
+
+    def set(self, value):
+        token = self.get()
+        self._local.value = value
+        return token
+
+    def reset(self, token):
+        self._local.value = token
+
+# The collector and path of the innermost timer that is running. Being a
+# context variable, each asyncio task that is started inside a timer sees it
+# as its parent, but not the timers started by the tasks running alongside.
+_CURRENT_SPAN = (ContextVar or _ThreadVar)("kadabra_span", default=None)
+
+class _Timer(object):
+    # The context manager returned by _Collector.timer(). Timers started
+    # while another timer of the same collector is running are named after
+    # it.
+    __slots__ = ("collector", "name", "path", "start", "token")
+
+    def __init__(self, collector, name):
+        self.collector = collector
+        self.name = name
+
+    def __enter__(self):
+        parent = _CURRENT_SPAN.get()
+        if parent is not None and parent[0] is self.collector:
+            self.path = parent[1] + "/" + self.name
+        else:
+            self.path = self.name
+        self.token = _CURRENT_SPAN.set((self.collector, self.path))
+        self.start = _get_clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = _get_clock() - self.start
+        _CURRENT_SPAN.reset(self.token)
+        self.collector._record_span(self.path, elapsed)
+        return False
+
+class _NullTimer(object):
+    # Stands in for the timers of requests that were sampled out.
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+_MISSING = object()
+
+class CardinalityLimiter(object):
+    """Bounds the number of distinct values each dimension can take, so that
+    a dimension set to something unbounded, such as a user ID, can't create an
+    unbounded number of series in the channel, the agent, and the metrics
+    database. The first ``max_values`` distinct values of each dimension are
+    kept; any other value is replaced with ``overflow_value``. At most
+    ``max_names`` dimension names are tracked, beyond which the values of new
+    dimensions are replaced too.
+
+    It is applied to the dimensions set with ``g.metrics.set_dimension`` when
+    ``KADABRA_MAX_DIMENSION_VALUES`` is set. Requests which had a value
+    replaced get a ``FoldedDimensions`` counter, and the number of values
+    replaced so far is available as the :attr:`folded` attribute, and per
+    dimension name as :attr:`folded_by_name`.
+
+    :param max_values: The maximum number of distinct values kept for each
+                       dimension.
+    :type max_values: int
+
+    :param max_names: The maximum number of dimension names tracked.
+    :type max_names: int
+
+    :param overflow_value: The value that other values are replaced with.
+    :type overflow_value: str
+    """
+    def __init__(self, max_values=100, max_names=100,
+            overflow_value="__other__"):
+        self.max_values = max_values
+        self.max_names = max_names
+        self.overflow_value = overflow_value
+
+        #: The number of values that were replaced.
+        self.folded = 0
+        #: The number of values that were replaced, by dimension name.
+        self.folded_by_name = {}
+
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def limit(self, name, value):
+        """Return the value to record for a dimension: either ``value``
+        itself, or ``overflow_value`` if it would exceed the limits.
+
+        :param name: The name of the dimension.
+        :type name: str
+
+        :param value: The value of the dimension.
+        :type value: str
+
+        :rtype: str
+        """
+        values = self._values.get(name)
+        if values is not None and value in values:
+            return value
+        with self._lock:
+            if values is None:
+                values = self._values.get(name)
+                if values is None and len(self._values) < self.max_names:
+                    values = self._values[name] = set()
+            if values is not None and (value in values or
+                    len(values) < self.max_values):
+                values.add(value)
+                return value
+            self.folded += 1
+            self.folded_by_name[name] = self.folded_by_name.get(name, 0) + 1
+            return self.overflow_value
+
+def _get_limiter(app):
+    max_values = app.config.get("KADABRA_MAX_DIMENSION_VALUES")
+    if max_values is None:
+        return None
+    return CardinalityLimiter(max_values,
+            overflow_value=app.config.get("KADABRA_DIMENSION_OVERFLOW_VALUE",
+                "__other__"))
+
+def _dimensions_key(dimensions):
+    key = getattr(dimensions, "key", None)
+    if key is None:
+        key = tuple(sorted(dimensions.items()))
+    return key
+
+class _Sampler(object):
+    # Decides which requests to a view are recorded, and with what weight.
+    def __init__(self, sample_rate=None, max_per_second=None,
+            keep_errors=True):
+        self.sample_rate = 1.0 if sample_rate is None else sample_rate
+        self.max_per_second = max_per_second
+        self.keep_errors = keep_errors
+        self._limits = {}
+
+    def sample(self, route):
+        # Returns the weight of the request if it should be recorded, or None.
+        rate = self.sample_rate
+        if self.max_per_second is not None:
+            limit = self._limits.get(route)
+            if limit is None:
+                limit = self._limits.setdefault(route,
+                        _RateLimit(self.max_per_second))
+            rate = min(rate, limit.rate())
+        if rate >= 1.0:
+            return 1.0
+        if random.random() < rate:
+            return 1.0 / rate
+        return None
+
+class _RateLimit(object):
+    # Tracks the requests per second to a route, and the sample rate needed to
+    # record at most max_per_second of them given the previous second's
+    # traffic. Updates aren't locked, so counts are approximate under
+    # concurrency, which is fine for this purpose.
+    def __init__(self, max_per_second):
+        self.max_per_second = float(max_per_second)
+        self._second = None
+        self._seen = 0
+        self._previous = 0
+
+    def rate(self):
+        second = int(_get_monotonic())
+        if second != self._second:
+            if self._second is not None and second == self._second + 1:
+                self._previous = self._seen
+            else:
+                self._previous = 0
+            self._second = second
+            self._seen = 0
+        self._seen += 1
+        if self._previous <= self.max_per_second:
+            return 1.0
+        return self.max_per_second / self._previous
+
+class _NullCollector(object):
+    # Stands in for the collector of requests that were sampled out.
+    dimensions = {}
+    counters = {}
+    timers = {}
+
+    def set_dimension(self, name, value):
+        pass
+
+    def add_count(self, name, value, *args, **kwargs):
+        pass
+
+    def set_timer(self, name, value, unit, *args, **kwargs):
+        pass
+
+    def timer(self, name):
+        return _NULL_TIMER
+
+    def close(self):
+        return None
+
+_NULL_COLLECTOR = _NullCollector()
+
+def _get_sampler(app):
+    sample_rate = app.config.get("KADABRA_SAMPLE_RATE")
+    max_per_second = app.config.get("KADABRA_SAMPLE_MAX_PER_SECOND")
+    if sample_rate is None and max_per_second is None:
+        return None
+    return _Sampler(sample_rate, max_per_second,
+            app.config.get("KADABRA_SAMPLE_KEEP_ERRORS", True))
+
+class AsyncSender(object):
+    """Sends :class:`~kadabra.Metrics` to a :class:`~kadabra.Kadabra`
+    client's channel from a background thread, so that the request which
+    produced them never waits on the channel. Metrics are placed on a bounded
+    queue which is drained by a daemon worker thread. The worker is started on
+    the first call to :meth:`send`, and restarted if the process has forked
+    since, so it is safe to create a sender before forking worker processes.
+
+    When the queue is full, ``overflow`` decides what happens to the metrics
+    being sent:
+
+    - ``"drop_newest"``: the metrics being sent are dropped.
+    - ``"drop_oldest"``: the oldest metrics on the queue are dropped to make
+      room.
+    - ``"block"``: the caller waits up to ``block_timeout`` seconds for room on
+      the queue, after which the metrics are dropped.
+
+    The number of metrics that were enqueued, sent, and dropped (either due to
+    overflow or because the channel raised an error) are available as the
+    :attr:`enqueued`, :attr:`sent`, and :attr:`dropped` attributes. These are
+    counted per thread, but the queue is shared by every thread: placing
+    metrics on it briefly takes the queue's lock, so threads sending at the
+    same time can wait on one another there.
+
+    :param client: The client whose channel to send metrics to, or another
+                   sender such as a :class:`~flask_kadabra.BatchSender`.
+    :type client: ~kadabra.Kadabra
+
+    :param queue_size: The maximum number of metrics waiting to be sent.
+    :type queue_size: int
+
+    :param overflow: The overflow policy, one of ``"drop_newest"``,
+                     ``"drop_oldest"``, or ``"block"``.
+    :type overflow: str
+
+    :param block_timeout: The number of seconds to wait for room on the queue
+                          when the overflow policy is ``"block"``.
+    :type block_timeout: float
+
+    :param logger: The name of the logger to use.
+    :type logger: str
+    """
+    OVERFLOW_POLICIES = ("drop_newest", "drop_oldest", "block")
+
+    def __init__(self, client, queue_size=10000, overflow="drop_newest",
+            block_timeout=0.1, logger="flask_kadabra.sender"):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError("Unrecognized overflow policy: '%s'" % overflow)
+        self.client = client
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.logger = logging.getLogger(logger)
+
+        self._lock = threading.Lock()
+        self._enqueued = _ThreadCounter()
+        self._sent = _ThreadCounter()
+        self._dropped = _ThreadCounter()
+        self._queue = None
+        self._worker = None
+        self._pid = None
+
+    @property
+    def enqueued(self):
+        """The number of metrics placed on the queue."""
+        return self._enqueued.value
+
+    @property
+    def sent(self):
+        """The number of metrics sent to the channel by the worker."""
+        return self._sent.value
+
+    @property
+    def dropped(self):
+        """The number of metrics dropped, either because the queue was full
+        or because the channel failed to send them."""
+        return self._dropped.value
+
+    def send(self, metrics):
+        """Queue metrics to be sent by the worker thread. This never blocks,
+        unless the overflow policy is ``"block"`` and the queue is full.
+
+        :param metrics: The metrics to send.
+        :type metrics: ~kadabra.Metrics
+        """
+        queue = self._ensure_worker()
+        try:
+            if self.overflow == "block":
+                queue.put(metrics, timeout=self.block_timeout)
+            else:
+                queue.put_nowait(metrics)
+        except Full:
+            if self.overflow != "drop_oldest":
+                self._dropped.add()
+                return
+            while True:
+                try:
+                    queue.get_nowait()
+                    queue.task_done()
+                    self._dropped.add()
+                except Empty:
+                    pass
+                try:
+                    queue.put_nowait(metrics)
+                    break
+                except Full:
+                    continue
+        self._enqueued.add()
+
+    def flush(self, timeout=None):
+        """Wait until every queued metric has been handled by the worker.
+
+        :param timeout: The maximum number of seconds to wait, or ``None`` to
+                        wait indefinitely.
+        :type timeout: float
+
+        :rtype: bool
+        :returns: Whether the queue was drained before the timeout expired.
+        """
+        queue = self._queue
+        if queue is None or self._pid != os.getpid():
+            return True
+        deadline = None if timeout is None else _get_monotonic() + timeout
+        with queue.all_tasks_done:
+            while queue.unfinished_tasks:
+                if deadline is None:
+                    queue.all_tasks_done.wait()
+                else:
+                    remaining = deadline - _get_monotonic()
+                    if remaining <= 0:
+                        return False
+                    queue.all_tasks_done.wait(remaining)
+        return True
+
+    def close(self, timeout=5.0):
+        """Flush any queued metrics and stop the worker thread. This is
+        registered to run when the interpreter exits.
+
+        :param timeout: The maximum number of seconds to wait for the queue to
+                        be flushed.
+        :type timeout: float
+        """
+        with self._lock:
+            worker = self._worker
+            if worker is None or self._pid != os.getpid():
+                return
+            if not self.flush(timeout):
+                self.logger.warning("Timed out flushing metrics, %s still "
+                        "queued" % self._queue.qsize())
+            self._queue.put(_STOP)
+            worker.join(timeout)
+            self._worker = None
+            self._pid = None
+
+    def _ensure_worker(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return self._queue
+        with self._lock:
+            if self._pid != pid:
+                # Either this is the first send, or we are in a forked child
+                # whose copy of the worker thread doesn't exist. Anything left
+                # on the parent's queue belongs to the parent.
+                if self._pid is not None:
+                    for counter in (self._enqueued, self._sent,
+                            self._dropped):
+                        counter.after_fork()
+                _prepare_client(self.client)
+                self._queue = Queue(self.queue_size)
+                self._worker = threading.Thread(target=self._run,
+                        name="flask-kadabra-sender")
+                self._worker.daemon = True
+                self._worker.start()
+                self._pid = pid
+            return self._queue
+
+    def _prepare(self):
+        _prepare_client(self.client)
+
+    def _run(self):
+        queue = self._queue
+        while True:
+            metrics = queue.get()
+            try:
+                if metrics is _STOP:
+                    return
+                self.client.send(metrics)
+                self._sent.add()
+            except Exception:
+                self.logger.exception("Failed to send metrics")
+                self._dropped.add()
+            finally:
+                queue.task_done()
+
+_STOP = object()
+
+class _ThreadBuffer(object):
+    __slots__ = ("lock", "contents", "registered")
+
+    def __init__(self, contents):
+        self.lock = threading.Lock()
+        self.contents = contents
+        self.registered = False
+
+class _ThreadBuffers(object):
+    # A buffer per thread, or per greenlet when the threading module is monkey
+    # patched by gevent or eventlet, which a flusher drains. Each buffer has
+    # its own lock, which is only ever contended by the flusher, so threads
+    # recording at the same time don't wait for each other. The registry of
+    # buffers is locked when a thread first records, and again once its
+    # buffer has been drained empty, which forgets the buffers of threads that
+    # are gone.
+    def __init__(self, factory):
+        self.factory = factory
+        self.reset()
+
+    def reset(self):
+        # Start over, as in a forked child: the parent's buffers, and any
+        # locks held by its other threads, belong to the parent.
+        self._lock = threading.Lock()
+        self._buffers = []
+        self._local = threading.local()
+
+    def acquire(self):
+        # Return the calling thread's buffer, locked. The caller releases
+        # buffer.lock once done with buffer.contents.
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is None:
+            buffer = self._local.buffer = _ThreadBuffer(self.factory())
+        buffer.lock.acquire()
+        if not buffer.registered:
+            with self._lock:
+                self._buffers.append(buffer)
+            buffer.registered = True
+        return buffer
+
+    def drain(self):
+        # Swap out the contents of every buffer, and return the non-empty
+        # ones.
+        with self._lock:
+            buffers = list(self._buffers)
+        drained = []
+        for buffer in buffers:
+            with buffer.lock:
+                contents, buffer.contents = buffer.contents, self.factory()
+                if not contents:
+                    buffer.registered = False
+                    with self._lock:
+                        self._buffers.remove(buffer)
+                    continue
+            drained.append(contents)
+        return drained
+
+class _ThreadCounter(object):
+    # A count which threads add to without waiting for each other: each
+    # thread (or greenlet) adds to a cell of its own, and the count is the sum
+    # of the cells. The lock is only taken when a thread first adds to the
+    # count, when the count is read, and when a thread is gone and its cell is
+    # folded into the total.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._total = 0
+        self._cells = {}
+        self._keys = itertools.count()
+        self._local = threading.local()
+
+    def add(self, count=1):
+        cell = getattr(self._local, "cell", None)
+        if cell is None:
+            cell = self._new_cell()
+        cell[0] += count
+
+    @property
+    def value(self):
+        with self._lock:
+            return self._total + sum(cell[0] for cell in self._cells.values())
+
+    def after_fork(self):
+        # The lock may have been held by a thread which didn't survive the
+        # fork; the counts carry over.
+        self._lock = threading.Lock()
+
+    def _new_cell(self):
+        cell = self._local.cell = [0]
+        with self._lock:
+            key = next(self._keys)
+            self._cells[key] = cell
+        # The holder goes away with the thread's local, and folds the cell
+        # into the total as it does.
+        self._local.holder = _CellHolder(self, key)
+        return cell
+
+    def _fold(self, key):
+        with self._lock:
+            self._total += self._cells.pop(key)[0]
+
+class _CellHolder(object):
+    __slots__ = ("counter", "key")
+
+    def __init__(self, counter, key):
+        self.counter = weakref.ref(counter)
+        self.key = key
+
+    def __del__(self):
+        counter = self.counter()
+        if counter is not None:
+            counter._fold(self.key)
+
+class BatchSender(object):
+    """Buffers :class:`~kadabra.Metrics` and sends them to a
+    :class:`~kadabra.Kadabra` client's channel in batches. A batch is sent as
+    soon as it holds ``batch_size`` metrics, or once the oldest metrics in it
+    have waited ``max_latency`` seconds, whichever comes first. The latter is
+    handled by a daemon thread which is started on the first call to
+    :meth:`send`, and restarted if the process has forked since.
+
+    For the Redis channel a batch is pushed with a single command; each
+    metrics object is still its own item on the queue, so nothing changes for
+    the agent. Other channels are sent each metrics object in turn.
+
+    Each thread (or greenlet, if the server monkey patches threading) fills
+    its own batch, so that threads sending at the same time don't wait for one
+    another. Batches that fill up are sent by the thread calling :meth:`send`;
+    to keep that off the request path, put an
+    :class:`~flask_kadabra.AsyncSender` in front of this sender. The flusher
+    thread sends the metrics of every thread's partial batch together.
+
+    The number of batches and metrics sent, and the number of metrics dropped
+    because the channel raised an error, are available as the
+    :attr:`batches`, :attr:`sent`, and :attr:`dropped` attributes.
+
+    :param client: The client whose channel to send metrics to.
+    :type client: ~kadabra.Kadabra
+
+    :param batch_size: The number of metrics at which a batch is sent.
+    :type batch_size: int
+
+    :param max_latency: The maximum number of seconds metrics wait in the
+                        buffer before being sent.
+    :type max_latency: float
+
+    :param logger: The name of the logger to use.
+    :type logger: str
+    """
+    def __init__(self, client, batch_size=100, max_latency=0.05,
+            logger="flask_kadabra.sender"):
+        self.client = client
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.logger = logging.getLogger(logger)
+
+        #: The number of batches sent to the channel.
+        self.batches = 0
+        #: The number of metrics sent to the channel.
+        self.sent = 0
+        #: The number of metrics dropped because the channel failed to send
+        #: them.
+        self.dropped = 0
+
+        self._lock = threading.Lock()
+        self._buffers = _ThreadBuffers(list)
+        self._pending = threading.Event()
+        self._stopped = threading.Event()
+        self._flusher = None
+        self._pid = None
+
+    def send(self, metrics):
+        """Add metrics to the calling thread's batch, sending the batch if
+        it is full.
+
+        :param metrics: The metrics to send.
+        :type metrics: ~kadabra.Metrics
+        """
+        self._ensure_flusher()
+        buffer = self._buffers.acquire()
+        try:
+            buffer.contents.append(metrics)
+            if len(buffer.contents) < self.batch_size:
+                batch = None
+            else:
+                batch, buffer.contents = buffer.contents, []
+        finally:
+            buffer.lock.release()
+        if batch is not None:
+            self._send(batch)
+        elif not self._pending.is_set():
+            self._pending.set()
+
+    def flush(self, timeout=None):
+        """Send the metrics of every thread's batch immediately, in batches
+        of at most ``batch_size``.
+
+        :param timeout: Unused; accepted for symmetry with
+                        :meth:`AsyncSender.flush`.
+        :type timeout: float
+
+        :rtype: bool
+        :returns: Always ``True``.
+        """
+        self._pending.clear()
+        pending = [m for batch in self._buffers.drain() for m in batch]
+        for start in range(0, len(pending), self.batch_size):
+            self._send(pending[start:start + self.batch_size])
+        return True
+
+    def close(self, timeout=5.0):
+        """Stop the flusher thread and send the current batch. This is
+        registered to run when the interpreter exits.
+
+        :param timeout: The maximum number of seconds to wait for the flusher
+                        thread to stop.
+        :type timeout: float
+        """
+        flusher = self._flusher
+        if flusher is not None and self._pid == os.getpid():
+            self._stopped.set()
+            self._pending.set()
+            flusher.join(timeout)
+            self._flusher = None
+            self._pid = None
+        self.flush()
+
+    def _ensure_flusher(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid != pid:
+                self._buffers.reset()
+                _prepare_client(self.client)
+                self._stopped.clear()
+                self._flusher = threading.Thread(target=self._run,
+                        name="flask-kadabra-batcher")
+                self._flusher.daemon = True
+                self._flusher.start()
+                self._pid = pid
+
+    def _prepare(self):
+        _prepare_client(self.client)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._pending.wait()
+            # Give the batch that was just started time to fill up.
+            if self._stopped.wait(self.max_latency):
+                return
+            self.flush()
+
+    def _send(self, batch):
+        try:
+            _send_batch(self.client, batch)
+        except Exception:
+            self.logger.exception("Failed to send batch of %s metrics" %\
+                    len(batch))
+            with self._lock:
+                self.dropped += len(batch)
+        else:
+            with self._lock:
+                self.batches += 1
+                self.sent += len(batch)
+
+def _to_binary_channel(channel):
+    if isinstance(channel, RedisChannel):
+        return BinaryRedisChannel.from_channel(channel)
+    return channel
+
+def _send_batch(client, batch):
+    # Push a list of metrics to the client's channel, in as few round trips as
+    # the channel allows.
+    if isinstance(client, CircuitBreakerSender):
+        client.send_batch(batch)
+        return
+    channel = getattr(client, "channel", None)
+    if isinstance(channel, BinaryRedisChannel):
+        channel.client.lpush(channel.queue_key,
+                *[encode_metrics(m) for m in batch])
+    elif isinstance(channel, RedisChannel):
+        channel.client.lpush(channel.queue_key,
+                *[json.dumps(m.serialize()) for m in batch])
+    else:
+        for metrics in batch:
+            client.send(metrics)
+
+class CircuitBreakerSender(object):
+    """Stops sending :class:`~kadabra.Metrics` to a :class:`~kadabra.Kadabra`
+    client's channel while the channel is failing, so that requests don't
+    keep paying for errors and connection timeouts when, for example, the
+    Redis server is down.
+
+    After ``failure_threshold`` sends in a row have failed, the circuit
+    *opens*: for the next ``reset_timeout`` seconds the channel isn't tried
+    at all. After that, the next send is let through as a trial. If it
+    succeeds the circuit *closes* and sending resumes as usual; if not, it
+    stays open for another ``reset_timeout`` seconds. The circuit's current
+    state is available as the :attr:`state` attribute.
+
+    Metrics which couldn't be sent, or which were sent while the circuit was
+    open, are appended to the spill file at ``spill_path``, if there is one,
+    in the format of :func:`encode_metrics`, each preceded by its length.
+    Once the circuit closes again, the spill file is replayed to the channel
+    in batches of ``replay_batch_size`` from a daemon thread, as is a spill
+    file left over from a previous run, the first time metrics are sent. Any
+    number of processes can share a spill file; only one at a time replays
+    it. When the file would grow beyond ``max_spill_size`` bytes, or if there
+    is no spill file, the metrics are dropped instead.
+
+    The number of metrics sent to the channel, appended to the spill file,
+    replayed from it, and dropped are available as the :attr:`sent`,
+    :attr:`spilled`, :attr:`replayed`, and :attr:`dropped` attributes, and the
+    number of failed sends as :attr:`failures`.
+
+    Trial sends, and sends while the circuit is closed, are still made by the
+    thread calling :meth:`send`, so a channel that hangs slows that thread
+    down until the circuit opens. To keep the channel off the request path
+    entirely, put an :class:`~flask_kadabra.AsyncSender` in front of this
+    sender.
+
+    :param client: The client whose channel to send metrics to.
+    :type client: ~kadabra.Kadabra
+
+    :param spill_path: The path of the spill file, or ``None`` to drop
+                       metrics while the circuit is open.
+    :type spill_path: str
+
+    :param failure_threshold: The number of failed sends in a row after which
+                              the circuit opens.
+    :type failure_threshold: int
+
+    :param reset_timeout: The number of seconds after which the channel is
+                          tried again once the circuit has opened.
+    :type reset_timeout: float
+
+    :param max_spill_size: The maximum size of the spill file, in bytes.
+    :type max_spill_size: int
+
+    :param replay_batch_size: The number of metrics replayed to the channel
+                              at a time.
+    :type replay_batch_size: int
+
+    :param logger: The name of the logger to use.
+    :type logger: str
+    """
+    def __init__(self, client, spill_path=None, failure_threshold=5,
+            reset_timeout=30.0, max_spill_size=64 * 1024 * 1024,
+            replay_batch_size=100, logger="flask_kadabra.sender"):
+        self.client = client
+        self.spill_path = spill_path
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_spill_size = max_spill_size
+        self.replay_batch_size = replay_batch_size
+        self.logger = logging.getLogger(logger)
+
+        #: The number of metrics replayed from the spill file.
+        self.replayed = 0
+        #: The number of sends to the channel which failed.
+        self.failures = 0
+
+        self._lock = threading.Lock()
+        self._sent = _ThreadCounter()
+        self._spilled = _ThreadCounter()
+        self._dropped = _ThreadCounter()
+        self._consecutive_failures = 0
+        self._opened_at = None
+        self._trial = False
+        self._replayer = None
+        self._pid = None
+
+    @property
+    def sent(self):
+        """The number of metrics sent to the channel."""
+        return self._sent.value
+
+    @property
+    def spilled(self):
+        """The number of metrics appended to the spill file."""
+        return self._spilled.value
+
+    @property
+    def dropped(self):
+        """The number of metrics dropped, because there was no room for them
+        in the spill file or there is no spill file."""
+        return self._dropped.value
+
+    @property
+    def state(self):
+        """``"closed"`` if metrics are being sent to the channel, ``"open"``
+        if they aren't, and ``"half-open"`` if a trial send is due or under
+        way."""
+        opened_at = self._opened_at
+        if opened_at is None:
+            return "closed"
+        if self._trial or _get_monotonic() - opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def send(self, metrics):
+        """Send metrics to the channel, or to the spill file if the circuit
+        is open or the channel fails. This never raises.
+
+        :param metrics: The metrics to send.
+        :type metrics: ~kadabra.Metrics
+        """
+        self.send_batch([metrics])
+
+    def send_batch(self, batch):
+        """Send a list of metrics to the channel in as few round trips as it
+        allows, or to the spill file if the circuit is open or the channel
+        fails. This is used by :class:`~flask_kadabra.BatchSender`, and never
+        raises.
+
+        :param batch: The metrics to send.
+        :type batch: list
+        """
+        if self._pid != os.getpid():
+            self._on_fork()
+        if not self._allow():
+            self._spill(batch)
+            return
+        try:
+            if len(batch) == 1:
+                self.client.send(batch[0])
+            else:
+                _send_batch(self.client, batch)
+        except Exception:
+            self._on_failure()
+            self._spill(batch)
+        else:
+            self._on_success(len(batch))
+
+    def flush(self, timeout=None):
+        """Wait for the spill file to finish being replayed, if it is.
+
+        :param timeout: The maximum number of seconds to wait, or ``None`` to
+                        wait indefinitely.
+        :type timeout: float
+
+        :rtype: bool
+        :returns: Whether the replay finished before the timeout expired.
+        """
+        replayer = self._replayer
+        if replayer is None or self._pid != os.getpid():
+            return True
+        replayer.join(timeout)
+        return not replayer.is_alive()
+
+    def close(self, timeout=5.0):
+        """Wait for the spill file to finish being replayed, if it is. This
+        is registered to run when the interpreter exits; anything that hasn't
+        been replayed by then stays in the spill file for the next run.
+
+        :param timeout: The maximum number of seconds to wait.
+        :type timeout: float
+        """
+        if not self.flush(timeout):
+            self.logger.warning("Timed out replaying spilled metrics")
+
+    def _on_fork(self):
+        # Either this is the first send, or we are in a forked child. A spill
+        # file left behind by an earlier run is replayed if the channel is
+        # up.
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            if self._pid is not None:
+                for counter in (self._sent, self._spilled, self._dropped):
+                    counter.after_fork()
+            self._pid = os.getpid()
+            self._replayer = None
+        if self.spill_path is not None and self._opened_at is None and (
+                os.path.exists(self.spill_path) or
+                os.path.exists(self.spill_path + ".replaying")):
+            self._start_replay()
+
+    def _prepare(self):
+        _prepare_client(self.client)
+
+    def _allow(self):
+        # Whether to try the channel: either the circuit is closed, or it has
+        # been open for long enough and no other trial is under way.
+        if self._opened_at is None:
+            return True
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._trial or\
+                    _get_monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            self._trial = True
+            return True
+
+    def _on_failure(self, trip=False):
+        with self._lock:
+            self.failures += 1
+            self._consecutive_failures += 1
+            if self._trial or (trip and self._opened_at is None):
+                # The channel is (still) down; wait another reset_timeout.
+                self._trial = False
+                self._opened_at = _get_monotonic()
+            elif self._opened_at is None and\
+                    self._consecutive_failures >= self.failure_threshold:
+                self._opened_at = _get_monotonic()
+                self.logger.exception("Failed to send metrics %s times in a "
+                        "row; not trying again for %s seconds" %
+                        (self._consecutive_failures, self.reset_timeout))
+
+    def _on_success(self, count):
+        # While the circuit is closed and the channel healthy, as it is on
+        # nearly every send, this takes no lock.
+        self._sent.add(count)
+        if self._consecutive_failures:
+            with self._lock:
+                self._consecutive_failures = 0
+        if self._opened_at is None:
+            return
+        with self._lock:
+            if self._opened_at is None:
+                return
+            self._opened_at = None
+            self._trial = False
+        self.logger.info("Sending metrics again")
+        if self.spill_path is not None:
+            self._start_replay()
+
+    def _spill(self, batch):
+        if self.spill_path is None:
+            self._dropped.add(len(batch))
+            return
+        data = b"".join(_frame(encode_metrics(metrics)) for metrics in batch)
+        if self._append(data):
+            self._spilled.add(len(batch))
+        else:
+            self._dropped.add(len(batch))
+
+    def _append(self, data):
+        # Append records to the spill file with a single write, which is
+        # atomic with respect to other appends. Returns whether there was
+        # room for them.
+        path = self.spill_path
+        while True:
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                        0o644)
+            except OSError:
+                self.logger.exception("Failed to open spill file %s" % path)
+                return False
+            try:
+                if fcntl is not None:
+                    # Keeps the file from being replayed while we write to
+                    # it; if it was renamed for replaying before we got the
+                    # lock, write to the new file instead.
+                    fcntl.flock(fd, fcntl.LOCK_SH)
+                    try:
+                        renamed = os.stat(path).st_ino != os.fstat(fd).st_ino
+                    except OSError:
+                        renamed = True
+                    if renamed:
+                        continue
+                if os.fstat(fd).st_size + len(data) > self.max_spill_size:
+                    return False
+                os.write(fd, data)
+                return True
+            except OSError:
+                self.logger.exception("Failed to write to spill file %s" %
+                        path)
+                return False
+            finally:
+                os.close(fd)
+
+    def _start_replay(self):
+        with self._lock:
+            if self._replayer is not None and self._replayer.is_alive():
+                return
+            self._replayer = threading.Thread(target=self._replay,
+                    name="flask-kadabra-replayer")
+            self._replayer.daemon = True
+            self._replayer.start()
+
+    def _replay(self):
+        try:
+            lock_fd = os.open(self.spill_path + ".lock",
+                    os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError:
+            self.logger.exception("Failed to replay spilled metrics")
+            return
+        try:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError):
+                    # Another process is replaying the spill file.
+                    return
+            replaying = self.spill_path + ".replaying"
+            if not os.path.exists(replaying):
+                # A file left over from a replay that was interrupted is
+                # replayed before any new one.
+                try:
+                    os.rename(self.spill_path, replaying)
+                except OSError:
+                    return
+            self._replay_file(replaying)
+        except Exception:
+            self.logger.exception("Failed to replay spilled metrics")
+        finally:
+            os.close(lock_fd)
+
+    def _replay_file(self, path):
+        fd = os.open(path, os.O_RDONLY)
+        with os.fdopen(fd, "rb") as f:
+            if fcntl is not None:
+                # Wait for anyone still appending to it.
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            data = f.read()
+        # Records that can't be decoded are dropped, rather than taken for a
+        # failure of the channel or put back to fail again.
+        records = []
+        metrics = []
+        for record in _unframe(data):
+            try:
+                metrics.append(decode_metrics(record))
+            except Exception:
+                self.logger.warning("Dropping spilled metrics which can't be "
+                        "decoded")
+                self._dropped.add()
+                continue
+            records.append(record)
+        for i in range(0, len(metrics), self.replay_batch_size):
+            batch = metrics[i:i + self.replay_batch_size]
+            try:
+                _send_batch(self.client, batch)
+            except Exception:
+                # The channel went down again; put back whatever is left for
+                # the next replay.
+                self._on_failure(trip=True)
+                self._append(b"".join(_frame(record)
+                    for record in records[i:]))
+                break
+            with self._lock:
+                self.replayed += len(batch)
+        os.unlink(path)
+
+_RECORD_LENGTH = struct.Struct("<I")
+
+def _frame(record):
+    return _RECORD_LENGTH.pack(len(record)) + record
+
+def _unframe(data):
+    # Yield the records of a spill file, ignoring a partial one at the end
+    # left by a process which died while writing it.
+    offset = 0
+    while offset + _RECORD_LENGTH.size <= len(data):
+        length, = _RECORD_LENGTH.unpack_from(data, offset)
+        offset += _RECORD_LENGTH.size
+        if offset + length > len(data):
+            return
+        yield data[offset:offset + length]
+        offset += length
+
+def encode_metrics(metrics):
+    """Encode :class:`~kadabra.Metrics` in a compact binary format, as sent by
+    :class:`DatagramSender` and :class:`BinaryRedisChannel`. The encoding
+    starts with a version number, so that :func:`decode_metrics` can reject
+    anything it doesn't understand. Timestamps and timer values keep their
+    full microsecond precision.
+
+    The dimension and metric names recorded by the extension itself, the
+    default timestamp format, and the built-in units are each encoded as a
+    single byte; other names and values are written out in full.
+
+    :param metrics: The metrics to encode.
+    :type metrics: ~kadabra.Metrics
+
+    :rtype: bytes
+    :returns: The encoded metrics.
+    """
+    if metrics.serialized_at is None:
+        serialized_at = _to_micros(_get_now())
+    else:
+        serialized_at = _to_micros(datetime.datetime.strptime(
+            metrics.serialized_at, metrics.timestamp_format))
+    parts = [_ENCODING_HEADER.pack(_ENCODING_MAGIC, _ENCODING_VERSION,
+            serialized_at), _pack_name(metrics.timestamp_format),
+            _ENCODING_COUNT.pack(len(metrics.dimensions))]
+    for dimension in metrics.dimensions:
+        parts.append(_pack_name(dimension.name))
+        parts.append(_pack_name(dimension.value))
+    parts.append(_ENCODING_COUNT.pack(len(metrics.counters)))
+    for counter in metrics.counters:
+        parts.append(_pack_name(counter.name))
+        parts.append(_pack_metadata(counter.metadata))
+        parts.append(_pack_timestamp(counter.timestamp, serialized_at))
+        parts.append(_ENCODING_DOUBLE.pack(counter.value))
+    parts.append(_ENCODING_COUNT.pack(len(metrics.timers)))
+    for timer in metrics.timers:
+        parts.append(_pack_name(timer.name))
+        parts.append(_pack_metadata(timer.metadata))
+        parts.append(_pack_timestamp(timer.timestamp, serialized_at))
+        value = timer.value
+        parts.append(_ENCODING_INT64.pack(
+            (value.days * 86400 + value.seconds) * 1000000 +
+            value.microseconds))
+        unit = timer.unit
+        code = _UNIT_CODES.get((unit.name, unit.seconds_offset))
+        if code is None:
+            parts.append(_INLINE)
+            parts.append(_pack_name(unit.name))
+            parts.append(_ENCODING_DOUBLE.pack(unit.seconds_offset))
+        else:
+            parts.append(code)
+    return b"".join(parts)
+
+def decode_metrics(data):
+    """Decode :class:`~kadabra.Metrics` encoded by :func:`encode_metrics`.
+
+    :param data: The encoded metrics.
+    :type data: bytes
+
+    :rtype: ~kadabra.Metrics
+    :returns: The decoded metrics, with ``serialized_at`` set to when they
+              were encoded.
+
+    :raises ValueError: If the data isn't encoded metrics, or was encoded
+                        with an unsupported version of the format.
+    """
+    try:
+        magic, version, serialized_at = _ENCODING_HEADER.unpack_from(data, 0)
+    except struct.error:
+        raise ValueError("Data is too short to be encoded metrics")
+    if magic != _ENCODING_MAGIC:
+        raise ValueError("Data is not encoded metrics")
+    if version != _ENCODING_VERSION:
+        raise ValueError("Unsupported encoding version: %s" % version)
+    try:
+        timestamp_format, dimensions, counters, timers = _decode(data,
+                _ENCODING_HEADER.size, serialized_at)
+    except (struct.error, IndexError):
+        raise ValueError("Encoded metrics are truncated or corrupt")
+    return kadabra.Metrics(dimensions, counters, timers, timestamp_format,
+            _from_micros(serialized_at).strftime(timestamp_format))
+
+def _decode(data, offset, serialized_at):
+    timestamp_format, offset = _unpack_name(data, offset)
+    dimensions = []
+    count, offset = _unpack_count(data, offset)
+    for _ in range(count):
+        name, offset = _unpack_name(data, offset)
+        value, offset = _unpack_name(data, offset)
+        dimensions.append(kadabra.Dimension(name, value))
+    counters = []
+    count, offset = _unpack_count(data, offset)
+    for _ in range(count):
+        name, offset = _unpack_name(data, offset)
+        metadata, offset = _unpack_name(data, offset)
+        timestamp, offset = _unpack_timestamp(data, offset, serialized_at)
+        value = _ENCODING_DOUBLE.unpack_from(data, offset)[0]
+        offset += _ENCODING_DOUBLE.size
+        counters.append(kadabra.Counter(name, timestamp,
+            json.loads(metadata) if metadata else {}, value))
+    timers = []
+    count, offset = _unpack_count(data, offset)
+    for _ in range(count):
+        name, offset = _unpack_name(data, offset)
+        metadata, offset = _unpack_name(data, offset)
+        timestamp, offset = _unpack_timestamp(data, offset, serialized_at)
+        value = _ENCODING_INT64.unpack_from(data, offset)[0]
+        offset += _ENCODING_INT64.size
+        code, offset = _unpack_code(data, offset)
+        if code == _INLINE:
+            unit, offset = _unpack_name(data, offset)
+            unit = kadabra.Unit(unit,
+                    _ENCODING_DOUBLE.unpack_from(data, offset)[0])
+            offset += _ENCODING_DOUBLE.size
+        else:
+            unit = _UNITS[ord(code)]
+        timers.append(kadabra.Timer(name, timestamp,
+            json.loads(metadata) if metadata else {},
+            datetime.timedelta(0, 0, value), unit))
+    return timestamp_format, dimensions, counters, timers
+
+_ENCODING_MAGIC = b"K"
+_ENCODING_VERSION = 2
+_ENCODING_HEADER = struct.Struct("<cBq")
+_ENCODING_COUNT = struct.Struct("<H")
+_ENCODING_DOUBLE = struct.Struct("<d")
+_ENCODING_INT32 = struct.Struct("<i")
+_ENCODING_INT64 = struct.Struct("<q")
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+# Names encoded as their index in this tuple, in a single byte. Indices are
+# part of the format, so names may only ever be appended, and decoders must
+# be upgraded before encoders.
+_INTERNED_NAMES = ("", "%Y-%m-%dT%H:%M:%S.%fZ", "method", "exception",
+        "RequestTime", "Failure", "ClientError", "SampleWeight",
+        "PreDispatchTime", "ViewTime", "AfterRequestTime", "ResponseTime",
+        "TimeToFirstByte", "ResponseSize", "RequestTime.count",
+        "RequestTime.sum", "RequestTime.min", "RequestTime.max",
+        "RequestTime.sketch", "RequestTime.p50", "RequestTime.p90",
+        "RequestTime.p99", "RequestTime.bucket.5", "RequestTime.bucket.10",
+        "RequestTime.bucket.25", "RequestTime.bucket.50",
+        "RequestTime.bucket.100", "RequestTime.bucket.250",
+        "RequestTime.bucket.500", "RequestTime.bucket.1000",
+        "RequestTime.bucket.2500", "RequestTime.bucket.5000",
+        "RequestTime.bucket.10000", "RequestTime.bucket.inf",
+        "FoldedDimensions", "endpoint", "url_rule", "RequestSize",
+        "Status2xx", "Status3xx", "Status4xx", "Status5xx", "status")
+_NAME_CODES = dict((name, struct.pack("<B", i))
+        for i, name in enumerate(_INTERNED_NAMES))
+_UNITS = (kadabra.Units.MILLISECONDS, kadabra.Units.SECONDS)
+_UNIT_CODES = dict(((unit.name, unit.seconds_offset), struct.pack("<B", i))
+        for i, unit in enumerate(_UNITS))
+# Marks a name or unit that is written out in full, and a timestamp too far
+# from serialized_at to be written relative to it.
+_INLINE = b"\xff"
+_FAR_TIMESTAMP = -2 ** 31
+
+def _pack_name(value):
+    code = _NAME_CODES.get(value)
+    if code is None:
+        return _INLINE + _pack_string(value)
+    return code
+
+def _unpack_name(data, offset):
+    code, offset = _unpack_code(data, offset)
+    if code == _INLINE:
+        return _unpack_string(data, offset)
+    return _INTERNED_NAMES[ord(code)], offset
+
+def _unpack_code(data, offset):
+    code = data[offset:offset + 1]
+    if not code:
+        raise struct.error("code runs past the end of the data")
+    return code, offset + 1
+
+def _pack_string(value):
+    encoded = value.encode("utf-8")
+    return _ENCODING_COUNT.pack(len(encoded)) + encoded
+
+def _unpack_string(data, offset):
+    length = _ENCODING_COUNT.unpack_from(data, offset)[0]
+    offset += _ENCODING_COUNT.size
+    if offset + length > len(data):
+        raise struct.error("string runs past the end of the data")
+    return data[offset:offset + length].decode("utf-8"), offset + length
+
+def _unpack_count(data, offset):
+    return _ENCODING_COUNT.unpack_from(data, offset)[0],\
+            offset + _ENCODING_COUNT.size
+
+def _pack_metadata(metadata):
+    # Nearly always empty, which costs a single byte.
+    return _pack_name(json.dumps(metadata) if metadata else "")
+
+def _pack_timestamp(timestamp, serialized_at):
+    # Metrics are nearly always recorded within moments of being serialized,
+    # so four bytes of microseconds either way are enough.
+    micros = _to_micros(timestamp)
+    delta = micros - serialized_at
+    if _FAR_TIMESTAMP < delta < -_FAR_TIMESTAMP:
+        return _ENCODING_INT32.pack(delta)
+    return _ENCODING_INT32.pack(_FAR_TIMESTAMP) + _ENCODING_INT64.pack(micros)
+
+def _unpack_timestamp(data, offset, serialized_at):
+    delta = _ENCODING_INT32.unpack_from(data, offset)[0]
+    offset += _ENCODING_INT32.size
+    if delta != _FAR_TIMESTAMP:
+        return _from_micros(serialized_at + delta), offset
+    micros = _ENCODING_INT64.unpack_from(data, offset)[0]
+    return _from_micros(micros), offset + _ENCODING_INT64.size
+
+def _to_micros(timestamp):
+    delta = timestamp - _EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 +\
+            delta.microseconds
+
+def _from_micros(micros):
+    return _EPOCH + datetime.timedelta(0, 0, micros)
+
+class BinaryRedisChannel(RedisChannel):
+    """A :class:`~kadabra.channels.RedisChannel` that puts metrics on the
+    queue encoded with :func:`encode_metrics` rather than as JSON, which
+    takes less time to encode and decode and less memory in Redis. It is used
+    to send metrics when ``KADABRA_BINARY_ENCODING`` is set; the agent must
+    use it too, in place of the Redis channel, to decode them. Metrics queued
+    as JSON, for example by applications that haven't been switched over yet,
+    are still received.
+
+    It takes the same arguments as
+    :class:`~kadabra.channels.RedisChannel`.
+    """
+    def __init__(self, *args, **kwargs):
+        super(BinaryRedisChannel, self).__init__(*args, **kwargs)
+        self._init_raw()
+
+    @classmethod
+    def from_channel(cls, channel):
+        """Return a binary channel that shares the connection and queues of
+        an existing Redis channel.
+
+        :param channel: The channel to share.
+        :type channel: ~kadabra.channels.RedisChannel
+
+        :rtype: ~flask_kadabra.BinaryRedisChannel
+        """
+        binary = cls.__new__(cls)
+        binary.__dict__.update(channel.__dict__)
+        binary._init_raw()
+        return binary
+
+    def send(self, metrics):
+        """Send metrics to the Redis queue.
+
+        :param metrics: The metrics to send.
+        :type metrics: ~kadabra.Metrics
+        """
+        self.client.lpush(self.queue_key, encode_metrics(metrics))
+
+    def receive(self):
+        """Receive metrics from the queue, moving them to the in-progress
+        queue, as :meth:`~kadabra.channels.RedisChannel.receive` does.
+
+        :rtype: ~kadabra.Metrics
+        :returns: The metrics to be published, or ``None`` if there were no
+                  metrics received after the timeout.
+        """
+        raw = self.client.brpoplpush(self.queue_key, self.inprogress_key,
+                timeout=10)
+        return self._decode(raw) if raw else None
+
+    def receive_batch(self, max_batch_size):
+        """Receive up to ``max_batch_size`` metrics from the queue, moving
+        them to the in-progress queue, as
+        :meth:`~kadabra.channels.RedisChannel.receive_batch` does.
+
+        :param max_batch_size: The maximum number of metrics to receive.
+        :type max_batch_size: int
+
+        :rtype: list
+        :returns: The list of metrics to be published, possibly empty.
+        """
+        pipeline = self.client.pipeline()
+        for i in range(max_batch_size):
+            pipeline.rpoplpush(self.queue_key, self.inprogress_key)
+        return [self._decode(raw) for raw in pipeline.execute()
+                if raw is not None]
+
+    def complete(self, metrics):
+        """Remove a list of metrics from the in-progress queue.
+
+        :param metrics: The list of :class:`~kadabra.Metrics` to mark as
+                        complete.
+        :type metrics: list
+        """
+        if len(metrics) > 0:
+            pipeline = self.client.pipeline()
+            for m in metrics:
+                with self._raw_lock:
+                    raw = self._raw.get(m)
+                if raw is None:
+                    raw = encode_metrics(m)
+                pipeline.lrem(self.inprogress_key, 1, raw)
+            pipeline.execute()
+
+    def in_progress(self, query_limit):
+        """Return up to ``query_limit`` of the metrics that are in progress.
+
+        :param query_limit: The maximum number of metrics to return.
+        :type query_limit: int
+
+        :rtype: list
+        :returns: A list of :class:`~kadabra.Metrics` that are in progress.
+        """
+        return [self._decode(raw) for raw in
+                self.client.lrange(self.inprogress_key, 0, query_limit - 1)]
+
+    def _init_raw(self):
+        # The exact item each received metrics object was read from, which is
+        # what complete() must remove from the in-progress queue.
+        self._raw = weakref.WeakKeyDictionary()
+        self._raw_lock = threading.Lock()
+
+    def _decode(self, raw):
+        if raw[:1] == b"{":
+            metrics = kadabra.Metrics.deserialize(json.loads(raw))
+        else:
+            metrics = decode_metrics(raw)
+        with self._raw_lock:
+            self._raw[metrics] = raw
+        return metrics
+
+class DatagramSender(object):
+    """Sends :class:`~kadabra.Metrics` to a :class:`DatagramReceiver` as
+    datagrams, encoded with :func:`encode_metrics`, instead of through the
+    client's channel. This needs no Redis server and no round trip: each send
+    is a single non-blocking system call, and there is nothing to wait for.
+
+    If ``address`` is a path, a Unix datagram socket is used; if it is a
+    ``(host, port)`` tuple, UDP is used. Sending never blocks. Metrics are
+    dropped, and counted by :attr:`dropped`, if the receiver isn't running,
+    if its socket's buffer is full, or if they are too large for a single
+    datagram. With UDP a receiver that isn't running can't be detected, so
+    those metrics are lost without being counted.
+
+    The socket is created on the first call to :meth:`send`, and recreated if
+    the process has forked since.
+
+    :param address: The path of the receiver's Unix socket, or the host and
+                    port it listens on for UDP.
+    :type address: str
+
+    :param logger: The name of the logger to use.
+    :type logger: str
+    """
+    def __init__(self, address, logger="flask_kadabra.sender"):
+        self.address = address
+        self.logger = logging.getLogger(logger)
+
+        self._lock = threading.Lock()
+        self._sent = _ThreadCounter()
+        self._dropped = _ThreadCounter()
+        self._socket = None
+        self._pid = None
+
+    @property
+    def sent(self):
+        """The number of metrics sent."""
+        return self._sent.value
+
+    @property
+    def dropped(self):
+        """The number of metrics dropped, because the receiver couldn't be
+        reached or they couldn't be encoded."""
+        return self._dropped.value
+
+    def send(self, metrics):
+        """Send metrics to the receiver. This never blocks.
+
+        :param metrics: The metrics to send.
+        :type metrics: ~kadabra.Metrics
+        """
+        try:
+            self._ensure_socket().sendto(encode_metrics(metrics),
+                    self.address)
+        except (IOError, OSError) as e:
+            # The receiver is down or can't keep up; don't flood the logs.
+            self.logger.debug("Failed to send metrics: %s" % e)
+            self._dropped.add()
+        except Exception:
+            self.logger.exception("Failed to encode metrics")
+            self._dropped.add()
+        else:
+            self._sent.add()
+
+    def flush(self, timeout=None):
+        """Nothing is buffered, so this returns immediately.
+
+        :param timeout: Unused; accepted for symmetry with
+                        :meth:`AsyncSender.flush`.
+        :type timeout: float
+
+        :rtype: bool
+        :returns: Always ``True``.
+        """
+        return True
+
+    def close(self, timeout=None):
+        """Close the socket. This is registered to run when the interpreter
+        exits.
+
+        :param timeout: Unused; accepted for symmetry with
+                        :meth:`AsyncSender.close`.
+        :type timeout: float
+        """
+        with self._lock:
+            if self._socket is not None and self._pid == os.getpid():
+                self._socket.close()
+            self._socket = None
+            self._pid = None
+
+    def _ensure_socket(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return self._socket
+        with self._lock:
+            if self._pid != pid:
+                if self._pid is not None:
+                    self._sent.after_fork()
+                    self._dropped.after_fork()
+                sock = socket.socket(_get_family(self.address),
+                        socket.SOCK_DGRAM)
+                sock.setblocking(False)
+                self._socket = sock
+                self._pid = pid
+            return self._socket
+
+class DatagramReceiver(object):
+    """Receives the :class:`~kadabra.Metrics` sent by a
+    :class:`DatagramSender`. This implements the same interface as the
+    channels in :mod:`kadabra.channels`, so it can take the place of a
+    :class:`~kadabra.channels.RedisChannel` in the agent's
+    :class:`~kadabra.agent.Receiver`, :class:`~kadabra.agent.BatchedReceiver`,
+    and :class:`~kadabra.agent.Nanny`.
+
+    Received metrics are kept in memory until they are marked complete, so
+    the nanny can republish them if publishing fails; unlike with Redis, they
+    are lost if the process exits first. Datagrams that can't be decoded are
+    counted by :attr:`dropped`.
+
+    The socket is bound when the receiver is created. For a Unix socket, any
+    file left at ``address`` by a previous receiver is removed first.
+
+    :param address: The path of the Unix socket to receive metrics on, or the
+                    host and port to listen on for UDP. With a port of ``0``
+                    one is picked, after which :attr:`address` holds the
+                    actual address.
+    :type address: str
+
+    :param timeout: The maximum number of seconds :meth:`receive` waits for
+                    metrics.
+    :type timeout: float
+
+    :param buffer_size: The size of the largest datagram that can be
+                        received.
+    :type buffer_size: int
+
+    :param logger: The name of the logger to use.
+    :type logger: str
+    """
+    def __init__(self, address, timeout=10.0, buffer_size=65536,
+            logger="kadabra.channel"):
+        self.timeout = timeout
+        self.buffer_size = buffer_size
+        self.logger = logging.getLogger(logger)
+
+        #: The number of datagrams that couldn't be decoded.
+        self.dropped = 0
+
+        family = _get_family(address)
+        if family == socket.AF_UNIX and os.path.exists(address):
+            os.unlink(address)
+        self._socket = socket.socket(family, socket.SOCK_DGRAM)
+        self._socket.bind(address)
+        # Waiting is done with select, so several threads can share it.
+        self._socket.setblocking(False)
+        #: The address the receiver is bound to.
+        self.address = self._socket.getsockname()
+
+        self._lock = threading.Lock()
+        self._in_progress = collections.OrderedDict()
+
+    def receive(self):
+        """Receive metrics so they can be published, waiting up to
+        ``timeout`` seconds for them. They are kept in progress until they are
+        marked complete with :meth:`complete`.
+
+        :rtype: ~kadabra.Metrics
+        :returns: The metrics to be published, or ``None`` if none were
+                  received before the timeout.
+        """
+        if not select.select([self._socket], [], [], self.timeout)[0]:
+            return None
+        data = self._recv()
+        return None if data is None else self._track(data)
+
+    def receive_batch(self, max_batch_size):
+        """Receive the metrics that have already arrived, without waiting,
+        so they can be published. They are kept in progress until they are
+        marked complete with :meth:`complete`.
+
+        :param max_batch_size: The maximum number of metrics to receive.
+        :type max_batch_size: int
+
+        :rtype: list
+        :returns: The list of metrics to be published, possibly empty.
+        """
+        batch = []
+        while len(batch) < max_batch_size:
+            data = self._recv()
+            if data is None:
+                break
+            metrics = self._track(data)
+            if metrics is not None:
+                batch.append(metrics)
+        return batch
+
+    def complete(self, metrics):
+        """Mark a list of metrics as published.
+
+        :param metrics: The list of :class:`~kadabra.Metrics` to mark as
+                        complete.
+        :type metrics: list
+        """
+        with self._lock:
+            for m in metrics:
+                self._in_progress.pop(id(m), None)
+
+    def in_progress(self, query_limit):
+        """Return the metrics that have been received but not completed,
+        oldest first.
+
+        :param query_limit: The maximum number of metrics to return.
+        :type query_limit: int
+
+        :rtype: list
+        :returns: A list of :class:`~kadabra.Metrics` that are in progress.
+        """
+        with self._lock:
+            return list(itertools.islice(self._in_progress.values(),
+                query_limit))
+
+    def close(self):
+        """Close the socket, removing it if it is a Unix socket."""
+        self._socket.close()
+        if _get_family(self.address) == socket.AF_UNIX:
+            try:
+                os.unlink(self.address)
+            except OSError:
+                pass
+
+    def _recv(self):
+        # Return the next datagram, or None if there isn't one (yet).
+        try:
+            return self._socket.recv(self.buffer_size)
+        except (IOError, OSError) as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return None
+            raise
+
+    def _track(self, data):
+        try:
+            metrics = decode_metrics(data)
+        except ValueError as e:
+            self.logger.warning("Dropping undecodable datagram: %s" % e)
+            self.dropped += 1
+            return None
+        with self._lock:
+            self._in_progress[id(metrics)] = metrics
+        return metrics
+
+def _get_family(address):
+    return socket.AF_INET if isinstance(address, tuple) else socket.AF_UNIX
+
+class _PeriodicFlusher(object):
+    # Base class for objects that call their flush() method, which subclasses
+    # define, every `interval` seconds from a daemon thread. The thread is
+    # started by _ensure_flusher(), and restarted if the process has forked
+    # since.
+    def __init__(self, interval, logger):
+        self.interval = interval
+        self.logger = logging.getLogger(logger)
+        self._flusher_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._flusher = None
+        self._pid = None
+
+    def close(self, timeout=5.0):
+        """Stop the flusher thread and flush. This is registered to run when
+        the interpreter exits.
+
+        :param timeout: The maximum number of seconds to wait for the flusher
+                        thread to stop.
+        :type timeout: float
+        """
+        flusher = self._flusher
+        if flusher is not None and self._pid == os.getpid():
+            self._stopped.set()
+            flusher.join(timeout)
+            self._flusher = None
+            self._pid = None
+        self.flush()
+
+    def _ensure_flusher(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._flusher_lock:
+            if self._pid != pid:
+                self._on_fork()
+                self._stopped.clear()
+                self._flusher = threading.Thread(target=self._run,
+                        name="flask-kadabra-%s" % self.__class__.__name__)
+                self._flusher.daemon = True
+                self._flusher.start()
+                self._pid = pid
+
+    def _on_fork(self):
+        # Called before the flusher is (re)started in a new process.
+        pass
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                self.logger.exception("Failed to flush")
+
+class Aggregator(_PeriodicFlusher):
+    """Rolls up the request time, failure, and client error metrics of
+    requests that share the same dimensions, and sends a single
+    :class:`~kadabra.Metrics` per set of dimensions every ``window`` seconds
+    instead of one per request. For each set of dimensions, the following are
+    sent:
+
+    - ``Failure`` and ``ClientError`` counters, summed over the window.
+    - A ``RequestTime.count`` counter with the number of requests.
+    - ``RequestTime.sum``, ``RequestTime.min``, and ``RequestTime.max``
+      timers, in milliseconds.
+    - A ``RequestTime.bucket.<bound>`` counter for each histogram bucket,
+      counting the requests that took at most ``bound`` milliseconds (and
+      more than the previous bound), plus ``RequestTime.bucket.inf`` for
+      requests slower than the last bound.
+    - Each of the ``counters``, summed over the window. These are the
+      built-in counters enabled by the configuration, such as ``Status2xx``
+      or ``RequestSize``, which are aggregated rather than sent with every
+      request.
+    - For each of the ``timers``, a ``<name>.count`` counter with the number
+      of requests that recorded it, and a ``<name>.sum`` timer with their
+      total, in milliseconds. These are the built-in timers enabled by the
+      configuration, such as ``ViewTime`` or ``TimeToFirstByte``.
+
+    Each thread (or greenlet, if the server monkey patches threading) rolls
+    up the requests it handles on its own, so that threads recording at the
+    same time don't wait for one another, and the flusher merges them.
+
+    The flusher thread is started the first time a request is recorded, and
+    restarted if the process has forked since.
+
+    :param sender: The client or sender to send the rolled up metrics to.
+    :type sender: ~kadabra.Kadabra
+
+    :param window: The number of seconds over which to roll up metrics.
+    :type window: float
+
+    :param buckets: The upper bounds, in milliseconds, of the request time
+                    histogram buckets.
+    :type buckets: list
+
+    :param timestamp_format: The format for timestamps of the rolled up
+                             metrics.
+    :type timestamp_format: str
+
+    :param logger: The name of the logger to use.
+    :type logger: str
+
+    :param counters: The names of the counters summed for each set of
+                     dimensions, whose values are passed to :meth:`record`.
+    :type counters: list
+
+    :param timers: The names of the timers whose count and total are summed
+                   for each set of dimensions, which are passed to
+                   :meth:`record` after the counters.
+    :type timers: list
+    """
+    #: The default upper bounds, in milliseconds, of the request time
+    #: histogram buckets.
+    DEFAULT_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self, sender, window=10.0, buckets=DEFAULT_BUCKETS,
+            timestamp_format="%Y-%m-%dT%H:%M:%S.%fZ",
+            logger="flask_kadabra.aggregator", counters=(), timers=()):
+        super(Aggregator, self).__init__(window, logger)
+        self.sender = sender
+        self.window = window
+        self.buckets = sorted(buckets)
+        self.timestamp_format = timestamp_format
+        self.counters = tuple(counters)
+        self.timers = tuple(timers)
+        # The number of sums kept besides the request time's: one per
+        # counter, and a count and a total per timer.
+        self._sums = len(self.counters) + 2 * len(self.timers)
+
+        self._lock = threading.Lock()
+        self._buffers = _ThreadBuffers(dict)
+
+    def record(self, dimensions, request_time, failure, client_error,
+            weight=1.0, counters=None):
+        """Add a request to the current window.
+
+        :param dimensions: The request's dimensions.
+        :type dimensions: dict
+
+        :param request_time: How long the request took.
+        :type request_time: ~datetime.timedelta
+
+        :param failure: ``1`` if the request failed, otherwise ``0``.
+        :type failure: int
+
+        :param client_error: ``1`` if the request was a client error,
+                             otherwise ``0``.
+        :type client_error: int
+
+        :param weight: The number of requests this one stands for, if requests
+                       are sampled.
+        :type weight: float
+
+        :param counters: The value of each of the aggregator's ``counters``
+                         for this request, followed by the count and the
+                         total in milliseconds of each of its ``timers``, all
+                         already weighted, if any.
+        :type counters: tuple
+        """
+        self._ensure_flusher()
+        key = _dimensions_key(dimensions)
+        millis = timedelta_total_seconds(request_time) * 1000.0
+        bucket = bisect.bisect_left(self.buckets, millis)
+        buffer = self._buffers.acquire()
+        try:
+            aggregate = buffer.contents.get(key)
+            if aggregate is None:
+                aggregate = buffer.contents[key] =\
+                        [0, 0, 0, 0.0, millis, millis,
+                                [0] * (len(self.buckets) + 1),
+                                [0] * self._sums]
+            aggregate[0] += weight
+            aggregate[1] += failure * weight
+            aggregate[2] += client_error * weight
+            aggregate[3] += millis * weight
+            if millis < aggregate[4]:
+                aggregate[4] = millis
+            if millis > aggregate[5]:
+                aggregate[5] = millis
+            aggregate[6][bucket] += weight
+            if counters:
+                sums = aggregate[7]
+                for i, value in enumerate(counters):
+                    sums[i] += value
+        finally:
+            buffer.lock.release()
+
+    def flush(self):
+        """Send the metrics rolled up so far and start a new window."""
+        aggregates = self._drain({})
+        now = _get_now()
+        for key, aggregate in aggregates.items():
+            self.sender.send(self._to_metrics(key, aggregate, now))
+
+    def _drain(self, aggregates):
+        # Merge what every thread has rolled up since the last drain into
+        # aggregates.
+        for drained in self._buffers.drain():
+            for key, other in drained.items():
+                aggregate = aggregates.get(key)
+                if aggregate is None:
+                    aggregates[key] = other
+                    continue
+                for i in range(4):
+                    aggregate[i] += other[i]
+                aggregate[4] = min(aggregate[4], other[4])
+                aggregate[5] = max(aggregate[5], other[5])
+                aggregate[6] = [a + b for a, b in zip(aggregate[6], other[6])]
+                aggregate[7] = [a + b for a, b in zip(aggregate[7], other[7])]
+        return aggregates
+
+    def _on_fork(self):
+        self._buffers.reset()
+        _prepare_client(self.sender)
+
+    def _to_metrics(self, key, aggregate, timestamp):
+        count, failure, client_error, total, low, high, buckets, sums =\
+                aggregate
+        counters = [
+            kadabra.Counter("Failure", timestamp, {}, failure),
+            kadabra.Counter("ClientError", timestamp, {}, client_error),
+            kadabra.Counter("RequestTime.count", timestamp, {}, count)]
+        bounds = ["%g" % b for b in self.buckets] + ["inf"]
+        for bound, bucket_count in zip(bounds, buckets):
+            counters.append(kadabra.Counter("RequestTime.bucket.%s" % bound,
+                timestamp, {}, bucket_count))
+        for name, value in zip(self.counters, sums):
+            counters.append(kadabra.Counter(name, timestamp, {}, value))
+        unit = kadabra.Units.MILLISECONDS
+        timers = [kadabra.Timer("RequestTime.%s" % name, timestamp, {},
+            datetime.timedelta(milliseconds=value), unit)
+            for name, value in (("sum", total), ("min", low), ("max", high))]
+        start = len(self.counters)
+        for i, name in enumerate(self.timers):
+            counters.append(kadabra.Counter(name + ".count", timestamp, {},
+                sums[start + 2 * i]))
+            timers.append(kadabra.Timer(name + ".sum", timestamp, {},
+                datetime.timedelta(milliseconds=sums[start + 2 * i + 1]),
+                unit))
+        return kadabra.Metrics([kadabra.Dimension(n, v) for n, v in key],
+                counters, timers, self.timestamp_format)
+
+class SharedAggregator(Aggregator):
+    """An :class:`Aggregator` whose rolled up metrics are shared by every
+    process on the host, such as the workers of a pre-forking server like
+    gunicorn. Instead of each process sending its own metrics every window,
+    requests are recorded in a fixed size table in a memory mapped file at
+    ``path``, and a single process sends the metrics for all of them.
+
+    The table has ``slots`` entries, one per set of dimensions, which are
+    claimed the first time a set of dimensions is recorded and kept for as
+    long as the file exists. Entries are updated under one of ``stripes``
+    locks, each of which is both a thread lock and a lock on a byte of the
+    file, so processes only contend when recording the same entries. Requests
+    that can't be recorded, because the table is full or their dimensions
+    don't fit in ``key_size`` bytes, are counted by :attr:`dropped`.
+
+    Every process runs a flusher thread, but only the one holding an
+    exclusive lock on ``path + ".lock"`` sends metrics. That lock is released
+    when its holder is closed or exits, at which point another process takes
+    over; since the table lives in the file, no requests are lost when
+    workers restart. Use a single instance per file in each process.
+
+    This requires :mod:`fcntl`, so it isn't available on Windows.
+
+    :param sender: The client or sender to send the rolled up metrics to.
+    :type sender: ~kadabra.Kadabra
+
+    :param path: The path of the file to share the table through. It is
+                 created if it doesn't exist; if it does, it must have been
+                 created with the same ``slots``, ``buckets``, and
+                 ``key_size``.
+    :type path: str
+
+    :param slots: The maximum number of sets of dimensions in the table.
+    :type slots: int
+
+    :param window: The number of seconds over which to roll up metrics.
+    :type window: float
+
+    :param buckets: The upper bounds, in milliseconds, of the request time
+                    histogram buckets.
+    :type buckets: list
+
+    :param key_size: The number of bytes reserved for each set of
+                     dimensions, encoded as JSON.
+    :type key_size: int
+
+    :param stripes: The number of locks protecting the table.
+    :type stripes: int
+
+    :param timestamp_format: The format for timestamps of the rolled up
+                             metrics.
+    :type timestamp_format: str
+
+    :param logger: The name of the logger to use.
+    :type logger: str
+
+    :param counters: The names of the counters summed for each set of
+                     dimensions, which must be the same for every process
+                     sharing the file.
+    :type counters: list
+
+    :param timers: The names of the timers whose count and total are summed
+                   for each set of dimensions, which must be the same for
+                   every process sharing the file.
+    :type timers: list
+    """
+    def __init__(self, sender, path, slots=1024, window=10.0,
+            buckets=Aggregator.DEFAULT_BUCKETS, key_size=256, stripes=64,
+            timestamp_format="%Y-%m-%dT%H:%M:%S.%fZ",
+            logger="flask_kadabra.aggregator", counters=(), timers=()):
+        if fcntl is None:
+            raise RuntimeError("SharedAggregator requires fcntl, which is not "
+                    "available on this platform")
+        super(SharedAggregator, self).__init__(sender, window, buckets,
+                timestamp_format, logger, counters, timers)
+        self.path = path
+        self.slots = slots
+        self.key_size = key_size
+        self.stripes = min(stripes, slots)
+
+        #: The number of requests that couldn't be recorded, because the table
+        #: was full or their dimensions were too long.
+        self.dropped = 0
+
+        # Each slot is the length of its key, the key, and then the count,
+        # failure, client error, sum, min, max, buckets, counters, and the
+        # count and total of each timer, as doubles.
+        size = 7 + len(self.buckets) + self._sums
+        self._values = struct.Struct("<%dd" % size)
+        self._zeros = self._values.pack(*([0] * size))
+        self._slot_size = key_size + self._values.size
+        names = json.dumps([self.counters, self.timers]).encode("utf-8")
+        header = _SHARED_HEADER.pack(_SHARED_MAGIC, _SHARED_VERSION, slots,
+                len(self.buckets), key_size, len(names))
+        header += struct.pack("<%dd" % len(self.buckets), *self.buckets)
+        header += names
+        self._header_size = len(header)
+        self._fd = self._open(header)
+        self._map = mmap.mmap(self._fd, self._header_size +
+                slots * self._slot_size)
+        self._stripe_locks = [threading.Lock() for _ in range(self.stripes)]
+        self._slot_cache = {}
+        self._leader = None
+        self._leader_pid = None
+
+    def record(self, dimensions, request_time, failure, client_error,
+            weight=1.0, counters=None):
+        """Add a request to the current window.
+
+        :param dimensions: The request's dimensions.
+        :type dimensions: dict
+
+        :param request_time: How long the request took.
+        :type request_time: ~datetime.timedelta
+
+        :param failure: ``1`` if the request failed, otherwise ``0``.
+        :type failure: int
+
+        :param client_error: ``1`` if the request was a client error,
+                             otherwise ``0``.
+        :type client_error: int
+
+        :param weight: The number of requests this one stands for, if requests
+                       are sampled.
+        :type weight: float
+
+        :param counters: The value of each of the aggregator's ``counters``
+                         for this request, followed by the count and the
+                         total in milliseconds of each of its ``timers``, all
+                         already weighted, if any.
+        :type counters: tuple
+        """
+        self._ensure_flusher()
+        key = _dimensions_key(dimensions)
+        slot = self._slot_cache.get(key)
+        if slot is None:
+            slot = self._find_slot(key)
+            if slot is None:
+                with self._lock:
+                    self.dropped += 1
+                return
+        millis = timedelta_total_seconds(request_time) * 1000.0
+        bucket = bisect.bisect_left(self.buckets, millis)
+        offset = self._header_size + slot * self._slot_size + self.key_size
+        self._acquire(slot)
+        try:
+            values = list(self._values.unpack_from(self._map, offset))
+            if not values[0] or millis < values[4]:
+                values[4] = millis
+            if not values[0] or millis > values[5]:
+                values[5] = millis
+            values[0] += weight
+            values[1] += failure * weight
+            values[2] += client_error * weight
+            values[3] += millis * weight
+            values[6 + bucket] += weight
+            if counters:
+                start = 7 + len(self.buckets)
+                for i, value in enumerate(counters):
+                    values[start + i] += value
+            self._values.pack_into(self._map, offset, *values)
+        finally:
+            self._release(slot)
+
+    def flush(self):
+        """Send the metrics rolled up so far by every process and start a new
+        window, if this process is the one sending them. Otherwise this does
+        nothing.
+        """
+        if not self._lead():
+            return
+        now = _get_now()
+        for slot in range(self.slots):
+            offset = self._header_size + slot * self._slot_size
+            # Keys are never removed, so an empty slot needs no lock.
+            if not _KEY_LENGTH.unpack_from(self._map, offset)[0]:
+                continue
+            self._acquire(slot)
+            try:
+                length = _KEY_LENGTH.unpack_from(self._map, offset)[0]
+                key = self._map[offset + _KEY_LENGTH.size:
+                        offset + _KEY_LENGTH.size + length]
+                values = self._values.unpack_from(self._map,
+                        offset + self.key_size)
+                if values[0]:
+                    self._map[offset + self.key_size:
+                            offset + self._slot_size] = self._zeros
+            finally:
+                self._release(slot)
+            if values[0]:
+                start = 7 + len(self.buckets)
+                aggregate = list(values[:6]) + [list(values[6:start]),
+                        list(values[start:])]
+                self.sender.send(self._to_metrics(
+                    json.loads(key.decode("utf-8")), aggregate, now))
+
+    def close(self, timeout=5.0):
+        """Stop the flusher thread and flush, if this process is the one
+        sending metrics, then let another process take over. This is
+        registered to run when the interpreter exits.
+
+        :param timeout: The maximum number of seconds to wait for the flusher
+                        thread to stop.
+        :type timeout: float
+        """
+        super(SharedAggregator, self).close(timeout)
+        if self._leader is not None and self._leader_pid == os.getpid():
+            os.close(self._leader)
+            self._leader = None
+            self._leader_pid = None
+
+    def _open(self, header):
+        # Open the file, creating and initializing it under a lock on its
+        # first byte if it doesn't exist yet.
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX, 1, 0)
+            try:
+                size = self._header_size + self.slots * self._slot_size
+                existing = os.fstat(fd).st_size
+                if existing == 0:
+                    os.ftruncate(fd, size)
+                    os.write(fd, header)
+                elif existing != size or os.read(fd, len(header)) != header:
+                    raise ValueError("'%s' was created with a different "
+                            "layout" % self.path)
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN, 1, 0)
+        except Exception:
+            os.close(fd)
+            raise
+        return fd
+
+    def _on_fork(self):
+        super(SharedAggregator, self)._on_fork()
+        # Another thread may have held a stripe lock when the process forked.
+        self._stripe_locks = [threading.Lock() for _ in range(self.stripes)]
+
+    def _find_slot(self, key):
+        # Find the slot for a set of dimensions, claiming an empty one if
+        # they aren't in the table yet, using linear probing.
+        encoded = json.dumps(key, separators=(",", ":")).encode("utf-8")
+        if len(encoded) > self.key_size - _KEY_LENGTH.size:
+            return None
+        start = (zlib.crc32(encoded) & 0xffffffff) % self.slots
+        for i in range(self.slots):
+            slot = (start + i) % self.slots
+            offset = self._header_size + slot * self._slot_size
+            key_offset = offset + _KEY_LENGTH.size
+            self._acquire(slot)
+            try:
+                length = _KEY_LENGTH.unpack_from(self._map, offset)[0]
+                if length == 0:
+                    self._map[key_offset:key_offset + len(encoded)] = encoded
+                    _KEY_LENGTH.pack_into(self._map, offset, len(encoded))
+                    found = True
+                else:
+                    found = self._map[key_offset:key_offset + length] ==\
+                            encoded
+            finally:
+                self._release(slot)
+            if found:
+                self._slot_cache[key] = slot
+                return slot
+        return None
+
+    def _acquire(self, slot):
+        stripe = slot % self.stripes
+        self._stripe_locks[stripe].acquire()
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, stripe + 1)
+        except Exception:
+            self._stripe_locks[stripe].release()
+            raise
+
+    def _release(self, slot):
+        stripe = slot % self.stripes
+        fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, stripe + 1)
+        self._stripe_locks[stripe].release()
+
+    def _lead(self):
+        # Whether this process holds the lock that makes it the one sending
+        # metrics, trying to take it if not.
+        pid = os.getpid()
+        if self._leader_pid == pid:
+            return True
+        if self._leader is not None:
+            # Inherited from the parent, which still holds the lock.
+            os.close(self._leader)
+            self._leader = None
+        fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            os.close(fd)
+            return False
+        self._leader = fd
+        self._leader_pid = pid
+        return True
+
+_SHARED_MAGIC = b"KADABRA\x00"
+_SHARED_VERSION = 2
+_SHARED_HEADER = struct.Struct("<8sIIIII")
+_KEY_LENGTH = struct.Struct("<H")
+
+def _get_aggregator(app):
+    if not app.config.get("KADABRA_AGGREGATE"):
+        return None
+    path = app.config.get("KADABRA_AGGREGATE_PATH")
+    if path:
+        aggregator = SharedAggregator(app.kadabra_sender, path,
+                slots=app.config.get("KADABRA_AGGREGATE_SLOTS", 1024),
+                window=app.config.get("KADABRA_AGGREGATE_WINDOW", 10.0),
+                buckets=app.config.get("KADABRA_AGGREGATE_BUCKETS",
+                    Aggregator.DEFAULT_BUCKETS),
+                timestamp_format=app.kadabra.timestamp_format,
+                counters=_get_aggregated_counters(app),
+                timers=_get_aggregated_timers(app))
+    else:
+        aggregator = Aggregator(app.kadabra_sender,
+                window=app.config.get("KADABRA_AGGREGATE_WINDOW", 10.0),
+                buckets=app.config.get("KADABRA_AGGREGATE_BUCKETS",
+                    Aggregator.DEFAULT_BUCKETS),
+                timestamp_format=app.kadabra.timestamp_format,
+                counters=_get_aggregated_counters(app),
+                timers=_get_aggregated_timers(app))
+    # Registered after the senders so it runs before they are closed.
+    atexit.register(aggregator.close)
+    return aggregator
+
+class PrometheusExporter(object):
+    """Keeps running totals of the request time, failure, and client error
+    metrics of requests that record metrics, per set of dimensions, and
+    renders them in the Prometheus text exposition format, so that they can
+    be scraped without running Redis or the Kadabra agent. For each set of
+    dimensions, the following are exposed, with the dimensions as labels:
+
+    - ``<namespace>_requests_total``, ``<namespace>_failures_total``, and
+      ``<namespace>_client_errors_total`` counters.
+    - A ``<namespace>_request_duration_seconds`` histogram of the request
+      time, with the given ``buckets``.
+
+    The rendered body is cached for ``interval`` seconds, so scrapes more
+    frequent than that cost next to nothing; when it is rendered again, only
+    the series which have changed since are formatted anew.
+
+    If ``path`` is given, the totals are kept in a memory mapped file at that
+    path instead of in the process, in the same way as
+    :class:`SharedAggregator` does, so that every process on the host, such
+    as the workers of a pre-forking server like gunicorn, records into and
+    renders from the same totals: whichever worker answers a scrape reports
+    on all of them. The file must not be shared with a
+    :class:`SharedAggregator`. This requires :mod:`fcntl`, so it isn't
+    available on Windows.
+
+    It is created by :meth:`~flask_kadabra.Kadabra.init_app` as the
+    application's ``kadabra_prometheus`` attribute if ``KADABRA_PROMETHEUS``
+    is set, in which case it is also served at ``KADABRA_PROMETHEUS_URL``.
+
+    :param path: The path of the file to share the totals through, or
+                 ``None`` to keep them in the process.
+    :type path: str
+
+    :param slots: If ``path`` is given, the maximum number of sets of
+                  dimensions in the file.
+    :type slots: int
+
+    :param buckets: The upper bounds, in milliseconds, of the request time
+                    histogram buckets.
+    :type buckets: list
+
+    :param interval: The number of seconds for which the rendered body is
+                     cached.
+    :type interval: float
+
+    :param namespace: The prefix of the names of the metrics.
+    :type namespace: str
+    """
+    #: The content type of the rendered body.
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self, path=None, slots=1024,
+            buckets=Aggregator.DEFAULT_BUCKETS, interval=5.0,
+            namespace="kadabra"):
+        self.path = path
+        self.buckets = sorted(buckets)
+        self.interval = interval
+        self.namespace = namespace
+        if path is None:
+            self._totals = _Totals(self.buckets)
+        else:
+            self._totals = _SharedTotals(path, slots, self.buckets)
+        self._families = [(namespace + name, kind, description)
+                for name, kind, description in _PROMETHEUS_FAMILIES]
+        self._bounds = ["%g" % (bound / 1000.0) for bound in self.buckets]
+        self._render_lock = threading.Lock()
+        self._body = None
+        self._rendered_at = None
+        self._series = {}
+
+    def record(self, dimensions, request_time, failure, client_error,
+            weight=1.0):
+        """Add a request to the totals.
+
+        :param dimensions: The request's dimensions.
+        :type dimensions: dict
+
+        :param request_time: How long the request took.
+        :type request_time: ~datetime.timedelta
+
+        :param failure: ``1`` if the request failed, otherwise ``0``.
+        :type failure: int
+
+        :param client_error: ``1`` if the request was a client error,
+                             otherwise ``0``.
+        :type client_error: int
+
+        :param weight: The number of requests this one stands for, if requests
+                       are sampled.
+        :type weight: float
+        """
+        self._totals.record(dimensions, request_time, failure, client_error,
+                weight)
+
+    def render(self):
+        """Return the totals in the Prometheus text exposition format,
+        rendering them again if the cached body is older than ``interval``
+        seconds.
+
+        :rtype: str
+        """
+        if self._body is not None and\
+                _get_monotonic() - self._rendered_at < self.interval:
+            return self._body
+        with self._render_lock:
+            # Another thread may have rendered it while we waited.
+            now = _get_monotonic()
+            if self._body is None or now - self._rendered_at >= self.interval:
+                self._body = self._render()
+                self._rendered_at = now
+            return self._body
+
+    def close(self, timeout=5.0):
+        """Release the file the totals are shared through, if any.
+
+        :param timeout: Unused; accepted for symmetry with the senders.
+        :type timeout: float
+        """
+        self._totals.close(timeout)
+
+    def _render(self):
+        series = {}
+        fragments = []
+        for key, values in sorted(self._totals.snapshot()):
+            cached = self._series.get(key)
+            if cached is None or cached[0] != values:
+                cached = (values, self._format(key, values))
+            series[key] = cached
+            fragments.append(cached[1])
+        self._series = series
+        out = []
+        for i, (name, kind, description) in enumerate(self._families):
+            out.append("# HELP %s %s\n# TYPE %s %s\n" % (name, description,
+                name, kind))
+            out.extend(fragment[i] for fragment in fragments)
+        return "".join(out)
+
+    def _format(self, key, values):
+        # The lines of each family for one set of dimensions.
+        count, failure, client_error, total, buckets = values
+        labels = ",".join('%s="%s"' % (_prometheus_name(name),
+            _prometheus_escape(value)) for name, value in key)
+        selector = "{%s}" % labels if labels else ""
+        requests, failures, client_errors, duration = [name
+                for name, _, _ in self._families]
+        histogram = []
+        cumulative = 0
+        prefix = "%s_bucket{%s" % (duration, labels + "," if labels else "")
+        for bound, bucket_count in zip(self._bounds + ["+Inf"], buckets):
+            cumulative += bucket_count
+            histogram.append('%sle="%s"} %r\n' % (prefix, bound,
+                float(cumulative)))
+        histogram.append("%s_sum%s %r\n" % (duration, selector,
+            total / 1000.0))
+        histogram.append("%s_count%s %r\n" % (duration, selector,
+            float(count)))
+        return ("%s%s %r\n" % (requests, selector, float(count)),
+                "%s%s %r\n" % (failures, selector, float(failure)),
+                "%s%s %r\n" % (client_errors, selector, float(client_error)),
+                "".join(histogram))
+
+_PROMETHEUS_FAMILIES = (
+    ("_requests_total", "counter", "Requests recorded by Flask-Kadabra."),
+    ("_failures_total", "counter",
+        "Requests that failed with a server error."),
+    ("_client_errors_total", "counter",
+        "Requests that failed with a client error."),
+    ("_request_duration_seconds", "histogram", "The time taken by requests."))
+
+def _prometheus_name(name):
+    # Label names may only contain ASCII letters, digits, and underscores,
+    # and may not start with a digit.
+    name = "".join(c if c.isalnum() and ord(c) < 128 else "_"
+            for c in "%s" % name)
+    return "_" + name if not name or name[0].isdigit() else name
+
+def _prometheus_escape(value):
+    return ("%s" % value).replace("\\", "\\\\").replace('"', '\\"').replace(
+            "\n", "\\n")
+
+class _Totals(Aggregator):
+    # An Aggregator whose totals are never sent or reset.
+    def __init__(self, buckets):
+        super(_Totals, self).__init__(None, buckets=buckets)
+        self._totals = {}
+
+    def _ensure_flusher(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def snapshot(self):
+        # The (key, (count, failure, client error, sum, buckets)) of each set
+        # of dimensions.
+        with self._lock:
+            return [(key, (a[0], a[1], a[2], a[3], tuple(a[6])))
+                    for key, a in self._drain(self._totals).items()]
+
+class _SharedTotals(SharedAggregator):
+    # A SharedAggregator whose totals are never sent or reset.
+    def __init__(self, path, slots, buckets):
+        super(_SharedTotals, self).__init__(None, path, slots=slots,
+                buckets=buckets)
+        self._keys = {}
+
+    def _ensure_flusher(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def snapshot(self):
+        totals = []
+        for slot in range(self.slots):
+            offset = self._header_size + slot * self._slot_size
+            length = _KEY_LENGTH.unpack_from(self._map, offset)[0]
+            if not length:
+                continue
+            self._acquire(slot)
+            try:
+                encoded = self._map[offset + _KEY_LENGTH.size:
+                        offset + _KEY_LENGTH.size + length]
+                values = self._values.unpack_from(self._map,
+                        offset + self.key_size)
+            finally:
+                self._release(slot)
+            key = self._keys.get(encoded)
+            if key is None:
+                key = self._keys[encoded] = tuple(tuple(item)
+                        for item in json.loads(encoded.decode("utf-8")))
+            totals.append((key, (values[0], values[1], values[2], values[3],
+                tuple(values[6:7 + len(self.buckets)]))))
+        return totals
+
+def _get_prometheus(app):
+    if not app.config.get("KADABRA_PROMETHEUS"):
+        return None
+    exporter = PrometheusExporter(app.config.get("KADABRA_PROMETHEUS_PATH"),
+            slots=app.config.get("KADABRA_PROMETHEUS_SLOTS", 1024),
+            buckets=app.config.get("KADABRA_PROMETHEUS_BUCKETS",
+                Aggregator.DEFAULT_BUCKETS),
+            interval=app.config.get("KADABRA_PROMETHEUS_INTERVAL", 5.0),
+            namespace=app.config.get("KADABRA_PROMETHEUS_NAMESPACE",
+                "kadabra"))
+    atexit.register(exporter.close)
+    url = app.config.get("KADABRA_PROMETHEUS_URL", "/metrics")
+    if url:
+        app.add_url_rule(url, "kadabra_prometheus",
+                lambda: current_app.response_class(exporter.render(),
+                    content_type=PrometheusExporter.CONTENT_TYPE))
+    return exporter
+
+class QuantileSketch(object):
+    """A mergeable sketch of a distribution of non-negative values, from
+    which quantiles can be estimated with a bounded relative error. Values are
+    counted in logarithmically sized buckets, as in DDSketch: with a relative
+    accuracy of ``a``, any quantile estimate is within ``a`` times the true
+    value. Memory is bounded by ``max_buckets`` regardless of how many values
+    are added; if it is exceeded, the lowest buckets are collapsed, which only
+    affects the accuracy of the lowest quantiles.
+
+    Sketches with the same relative accuracy can be combined with
+    :meth:`merge`, so sketches from several processes can be sent separately
+    (see :meth:`serialize` and :meth:`deserialize`) and merged by whatever
+    receives them.
+
+    :param relative_accuracy: The relative accuracy of quantile estimates,
+                              between 0 and 1.
+    :type relative_accuracy: float
+
+    :param max_buckets: The maximum number of buckets to keep.
+    :type max_buckets: int
+    """
+    def __init__(self, relative_accuracy=0.01, max_buckets=2048):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("Relative accuracy must be between 0 and 1")
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+
+        #: The number of values added to the sketch.
+        self.count = 0
+        #: The number of values that were zero (or negative).
+        self.zero_count = 0
+        #: The counts of values per bucket index.
+        self.buckets = {}
+
+    def add(self, value, weight=1):
+        """Add a value to the sketch.
+
+        :param value: The value to add.
+        :type value: float
+
+        :param weight: The number of times to add the value.
+        :type weight: float
+        """
+        self.count += weight
+        if value <= 0:
+            self.zero_count += weight
+            return
+        index = int(math.ceil(math.log(value) / self._log_gamma))
+        self.buckets[index] = self.buckets.get(index, 0) + weight
+        if len(self.buckets) > self.max_buckets:
+            self._collapse()
+
+    def merge(self, other):
+        """Add all the values in another sketch to this one.
+
+        :param other: The sketch to merge into this one. It must have the same
+                      relative accuracy.
+        :type other: ~flask_kadabra.QuantileSketch
+        """
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Cannot merge sketches with different accuracy")
+        self.count += other.count
+        self.zero_count += other.zero_count
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        if len(self.buckets) > self.max_buckets:
+            self._collapse()
+
+    def quantile(self, q):
+        """Estimate a quantile of the values added to the sketch.
+
+        :param q: The quantile to estimate, between 0 and 1.
+        :type q: float
+
+        :rtype: float
+        :returns: The estimated value, or ``None`` if the sketch is empty.
+        """
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                return 2 * self.gamma ** index / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+    def serialize(self):
+        """Serializes this sketch to a dictionary.
+
+        :rtype: dict
+        :returns: The sketch as a dictionary.
+        """
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "max_buckets": self.max_buckets,
+            "zero_count": self.zero_count,
+            "buckets": sorted(self.buckets.items())
+        }
+
+    @staticmethod
+    def deserialize(value):
+        """Deserializes a dictionary into a
+        :class:`~flask_kadabra.QuantileSketch` instance.
+
+        :param value: The dictionary to deserialize.
+        :type value: dict
+
+        :rtype: ~flask_kadabra.QuantileSketch
+        :returns: The sketch that the dictionary represents.
+        """
+        sketch = QuantileSketch(value["relative_accuracy"],
+                value["max_buckets"])
+        sketch.zero_count = value["zero_count"]
+        sketch.buckets = dict((int(i), c) for i, c in value["buckets"])
+        sketch.count = sketch.zero_count + sum(sketch.buckets.values())
+        return sketch
+
+    def _collapse(self):
+        # Fold the lowest buckets into one so that at most max_buckets remain.
+        indexes = sorted(self.buckets)
+        excess = len(indexes) - self.max_buckets + 1
+        target = indexes[excess]
+        for index in indexes[:excess]:
+            self.buckets[target] += self.buckets.pop(index)
+
+class SketchAggregator(_PeriodicFlusher):
+    """Keeps a :class:`~flask_kadabra.QuantileSketch` of request times per
+    set of dimensions (which for views annotated with
+    :data:`~flask_kadabra.record_metrics` means per ``method``), and sends a
+    summary of each every ``interval`` seconds. Each summary is a
+    :class:`~kadabra.Metrics` with:
+
+    - A ``RequestTime.pXX`` timer, in milliseconds, for each quantile (for
+      example ``RequestTime.p99`` for the 0.99 quantile).
+    - A ``RequestTime.sketch`` counter whose value is the number of requests,
+      and whose ``sketch`` metadata is the JSON serialized sketch, so that
+      sketches from several workers can be merged.
+
+    Each thread (or greenlet, if the server monkey patches threading) keeps
+    its own sketches, which the flusher merges.
+
+    The flusher thread is started the first time a request is recorded, and
+    restarted if the process has forked since.
+
+    :param sender: The client or sender to send the summaries to.
+    :type sender: ~kadabra.Kadabra
+
+    :param interval: The number of seconds between summaries. Each summary
+                     covers the requests since the previous one.
+    :type interval: float
+
+    :param quantiles: The quantiles to send.
+    :type quantiles: list
+
+    :param relative_accuracy: The relative accuracy of the sketches.
+    :type relative_accuracy: float
+
+    :param max_buckets: The maximum number of buckets per sketch.
+    :type max_buckets: int
+
+    :param timestamp_format: The format for timestamps of the summaries.
+    :type timestamp_format: str
+
+    :param logger: The name of the logger to use.
+    :type logger: str
+    """
+    #: The default quantiles to send.
+    DEFAULT_QUANTILES = (0.5, 0.9, 0.99)
+
+    def __init__(self, sender, interval=10.0, quantiles=DEFAULT_QUANTILES,
+            relative_accuracy=0.01, max_buckets=2048,
+            timestamp_format="%Y-%m-%dT%H:%M:%S.%fZ",
+            logger="flask_kadabra.aggregator"):
+        super(SketchAggregator, self).__init__(interval, logger)
+        self.sender = sender
+        self.quantiles = quantiles
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self.timestamp_format = timestamp_format
+
+        self._buffers = _ThreadBuffers(dict)
+
+    def record(self, dimensions, request_time, weight=1.0):
+        """Add a request time to the sketch for its dimensions.
+
+        :param dimensions: The request's dimensions.
+        :type dimensions: dict
+
+        :param request_time: How long the request took.
+        :type request_time: ~datetime.timedelta
+
+        :param weight: The number of requests this one stands for, if requests
+                       are sampled.
+        :type weight: float
+        """
+        self._ensure_flusher()
+        key = _dimensions_key(dimensions)
+        millis = timedelta_total_seconds(request_time) * 1000.0
+        buffer = self._buffers.acquire()
+        try:
+            sketch = buffer.contents.get(key)
+            if sketch is None:
+                sketch = buffer.contents[key] = QuantileSketch(
+                        self.relative_accuracy, self.max_buckets)
+            sketch.add(millis, weight)
+        finally:
+            buffer.lock.release()
+
+    def flush(self):
+        """Send a summary of every sketch and start new ones."""
+        sketches = {}
+        for drained in self._buffers.drain():
+            for key, other in drained.items():
+                sketch = sketches.get(key)
+                if sketch is None:
+                    sketches[key] = other
+                else:
+                    sketch.merge(other)
+        now = _get_now()
+        for key, sketch in sketches.items():
+            self.sender.send(self._to_metrics(key, sketch, now))
+
+    def _on_fork(self):
+        self._buffers.reset()
+        _prepare_client(self.sender)
+
+    def _to_metrics(self, key, sketch, timestamp):
+        timers = [kadabra.Timer("RequestTime.p%s" % _quantile_name(q),
+            timestamp, {}, datetime.timedelta(milliseconds=sketch.quantile(q)),
+            kadabra.Units.MILLISECONDS) for q in self.quantiles]
+        counters = [kadabra.Counter("RequestTime.sketch", timestamp,
+            {"sketch": json.dumps(sketch.serialize())}, sketch.count)]
+        return kadabra.Metrics([kadabra.Dimension(n, v) for n, v in key],
+                counters, timers, self.timestamp_format)
+
+def _quantile_name(q):
+    # 0.5 -> "50", 0.99 -> "99", 0.999 -> "99.9"
+    return ("%f" % (q * 100)).rstrip("0").rstrip(".")
+
+class SlowRequestLog(object):
+    """Keeps a record of the most recent requests whose "RequestTime" was at
+    least ``threshold`` milliseconds, to help find out what makes the slowest
+    requests slow without profiling every request. At most ``size`` records
+    are kept; older ones are discarded as new ones are captured, so the memory
+    used stays bounded.
+
+    It is created by :meth:`~flask_kadabra.Kadabra.init_app` as the
+    application's ``kadabra_slow_requests`` attribute if
+    ``KADABRA_SLOW_REQUEST_THRESHOLD`` is set. Each record is a dictionary
+    with:
+
+    - ``timestamp``: when the request was captured, in ISO 8601 format.
+    - ``request_time``: the request time, in milliseconds.
+    - ``dimensions``: the request's dimensions, such as its route.
+    - ``counters`` and ``timers``: the metrics recorded on ``g.metrics``, with
+      timers in milliseconds. These include the phase timers if
+      ``KADABRA_PHASE_TIMERS`` is set.
+    - ``profile``: if ``KADABRA_SLOW_REQUEST_PROFILE`` is set, the stacks
+      sampled while the request was handled, as a list of ``[stack, count]``
+      pairs with the most frequent first. Each stack is a ``;``-separated list
+      of ``file:function:line`` frames, outermost first, as consumed by flame
+      graph tools. Otherwise ``None``.
+
+    The number of requests captured so far, including those no longer kept,
+    is available as the :attr:`captured` attribute.
+
+    :param threshold: The request time, in milliseconds, from which requests
+                      are captured.
+    :type threshold: float
+
+    :param size: The maximum number of records kept.
+    :type size: int
+    """
+    def __init__(self, threshold, size=100):
+        self.threshold = datetime.timedelta(milliseconds=threshold)
+        self.size = size
+
+        #: The number of requests captured.
+        self.captured = 0
+
+        self._records = collections.deque(maxlen=size)
+
+    def capture(self, collector, request_time, profile=None):
+        """Capture a record of a request.
+
+        :param collector: The collector with the request's metrics. It must
+                          not have been closed yet.
+        :type collector: ~kadabra.client.MetricsCollector
+
+        :param request_time: The request time.
+        :type request_time: ~datetime.timedelta
+
+        :param profile: The number of times each stack was sampled.
+        :type profile: dict
+        """
+        with collector.lock:
+            dimensions = dict(collector.dimensions)
+            counters = dict((name, counter["value"])
+                    for name, counter in collector.counters.items())
+            timers = dict((name, _to_millis(timer["value"]))
+                    for name, timer in collector.timers.items())
+        if profile is not None:
+            profile = sorted(([stack, count]
+                for stack, count in profile.items()),
+                key=lambda sample: -sample[1])
+        # Appending to a bounded deque is atomic, so needs no lock.
+        self._records.append({
+            "timestamp": _get_now().isoformat() + "Z",
+            "request_time": _to_millis(request_time),
+            "dimensions": dimensions,
+            "counters": counters,
+            "timers": timers,
+            "profile": profile})
+        self.captured += 1
+
+    def records(self):
+        """Return the records that are kept, oldest first.
+
+        :rtype: list
+        """
+        return list(self._records)
+
+    def clear(self):
+        """Discard the records that are kept."""
+        self._records.clear()
+
+def _to_millis(value):
+    return timedelta_total_seconds(value) * 1000
+
+class _StackProfiler(_PeriodicFlusher):
+    # Samples the stacks of the threads handling requests every `interval`
+    # seconds, counting how often each stack was seen for each request.
+    def __init__(self, interval=0.005, max_depth=50,
+            logger="flask_kadabra.profiler"):
+        super(_StackProfiler, self).__init__(interval, logger)
+        self.max_depth = max_depth
+        # The thread and the samples of each request, by handle.
+        self._samples = {}
+
+    def start(self):
+        # Start sampling the current thread for a request, and return the
+        # handle to stop with, which may be done from another thread.
+        self._ensure_flusher()
+        handle = object()
+        self._samples[handle] = (threading.current_thread().ident,
+                collections.defaultdict(int))
+        return handle
+
+    def stop(self, handle):
+        # Stop sampling for a request and return its samples, if it was being
+        # sampled.
+        ident, samples = self._samples.pop(handle, (None, None))
+        return samples
+
+    def flush(self):
+        frames = sys._current_frames()
+        for ident, samples in list(self._samples.values()):
+            frame = frames.get(ident)
+            if frame is not None:
+                samples[self._format(frame)] += 1
+
+    def _format(self, frame):
+        stack = []
+        while frame is not None and len(stack) < self.max_depth:
+            code = frame.f_code
+            stack.append("%s:%s:%d" % (os.path.basename(code.co_filename),
+                code.co_name, frame.f_lineno))
+            frame = frame.f_back
+        stack.reverse()
+        return ";".join(stack)
+
+    def _on_fork(self):
+        self._samples = {}
+
+def _get_sketches(app):
+    if not app.config.get("KADABRA_SKETCH"):
+        return None
+    sketches = SketchAggregator(app.kadabra_sender,
+            interval=app.config.get("KADABRA_SKETCH_INTERVAL", 10.0),
+            quantiles=app.config.get("KADABRA_SKETCH_QUANTILES",
+                SketchAggregator.DEFAULT_QUANTILES),
+            relative_accuracy=app.config.get("KADABRA_SKETCH_ACCURACY", 0.01),
+            max_buckets=app.config.get("KADABRA_SKETCH_MAX_BUCKETS", 2048),
+            timestamp_format=app.kadabra.timestamp_format)
+    # Registered after the senders so it runs before they are closed.
+    atexit.register(sketches.close)
+    return sketches
+
+def _get_slow_requests(app):
+    threshold = app.config.get("KADABRA_SLOW_REQUEST_THRESHOLD")
+    if threshold is None:
+        return None
+    slow_requests = SlowRequestLog(threshold,
+            app.config.get("KADABRA_SLOW_REQUEST_LOG_SIZE", 100))
+    url = app.config.get("KADABRA_SLOW_REQUEST_URL")
+    if url:
+        app.add_url_rule(url, "kadabra_slow_requests",
+                lambda: jsonify(records=slow_requests.records()))
+    return slow_requests
+
+def _get_profiler(app):
+    interval = app.config.get("KADABRA_SLOW_REQUEST_PROFILE")
+    if not interval or app.kadabra_slow_requests is None:
+        return None
+    profiler = _StackProfiler(interval / 1000.0)
+    atexit.register(profiler.close)
+    return profiler
+
+def _get_sender(app):
+    # The object that transport_metrics hands closed metrics to; either the
+    # client itself or a chain of senders wrapping it.
+    sender = app.kadabra
+    address = app.config.get("KADABRA_DATAGRAM_ADDRESS")
+    if not app.config.get("KADABRA_SEND_METRICS", True):
+        # For example, only to serve them with KADABRA_PROMETHEUS.
+        return _NULL_SENDER
+    if address:
+        if isinstance(address, list):
+            address = tuple(address)
+        sender = DatagramSender(address)
+        atexit.register(sender.close)
+    elif app.config.get("KADABRA_BINARY_ENCODING"):
+        sender.channel_wrapper = _to_binary_channel
+    if app.config.get("KADABRA_CIRCUIT_BREAKER"):
+        sender = CircuitBreakerSender(sender,
+                spill_path=app.config.get("KADABRA_SPILL_PATH"),
+                failure_threshold=app.config.get("KADABRA_CIRCUIT_FAILURES",
+                    5),
+                reset_timeout=app.config.get("KADABRA_CIRCUIT_RESET", 30.0),
+                max_spill_size=app.config.get("KADABRA_SPILL_MAX_SIZE",
+                    64 * 1024 * 1024))
+        atexit.register(sender.close)
+    batch_size = app.config.get("KADABRA_BATCH_SIZE", 1)
+    if batch_size > 1:
+        sender = BatchSender(sender, batch_size=batch_size,
+                max_latency=app.config.get("KADABRA_BATCH_LATENCY", 0.05))
+        atexit.register(sender.close)
+    if app.config.get("KADABRA_ASYNCIO_SEND"):
+        from flask_kadabra_asyncio import AsyncioSender
+        sender = AsyncioSender(sender,
+                queue_size=app.config.get("KADABRA_QUEUE_SIZE", 10000))
+        atexit.register(sender.close)
+    elif app.config.get("KADABRA_ASYNC_SEND"):
+        sender = AsyncSender(sender,
+                queue_size=app.config.get("KADABRA_QUEUE_SIZE", 10000),
+                overflow=app.config.get("KADABRA_QUEUE_OVERFLOW",
+                    "drop_newest"),
+                block_timeout=app.config.get("KADABRA_QUEUE_TIMEOUT", 0.1))
+        # Registered last so it runs first, flushing into any batch sender.
+        atexit.register(sender.close)
+    return sender
+
+class _NullSender(object):
+    # Discards metrics, when KADABRA_SEND_METRICS is turned off.
+    def send(self, metrics):
+        pass
+
+    def flush(self, timeout=None):
+        return True
+
+    def close(self, timeout=5.0):
+        pass
+
+_NULL_SENDER = _NullSender()
+
+def _get_metrics():
+    # Return the collector for the current request, creating it on first use.
+    ctx = stack.top
+    if ctx is None:
+        raise RuntimeError("Working outside of application context.")
+    collector = getattr(ctx, "kadabra_metrics", None)
+    if collector is None:
+        app = current_app._get_current_object()
+        collector = ctx.kadabra_metrics = _Collector(
+                app.kadabra.timestamp_format, app.kadabra_dimensions,
+                app.kadabra_limiter)
+    return collector
+
+#: Proxy to the :class:`~kadabra.client.MetricsCollector` for the current
+#: request. This is what is exposed as ``g.metrics``; the collector behind it
+#: is only created the first time it is used.
+metrics = LocalProxy(_get_metrics)
+
+def _get_now():
+    return datetime.datetime.utcnow()
+
+def _iscoroutinefunction(func):
+    # Coroutine functions don't exist before Python 3.5.
+    return getattr(inspect, "iscoroutinefunction", lambda f: False)(func)
+
+def _to_timedelta(nanoseconds):
+    return datetime.timedelta(0, 0, nanoseconds // 1000)
+
+# Monotonic, high resolution clock in integer nanoseconds, used for request
+# timing so that it isn't affected by adjustments to the wall clock.
+if hasattr(time, "perf_counter_ns"):
+    _get_clock = time.perf_counter_ns
+else:
+    def _get_clock():
+        return int(getattr(time, "perf_counter", time.time)() * 1e9)
+
+def _get_monotonic():
+    return getattr(time, "monotonic", time.time)()
@@ -0,0 +1,234 @@
+"""
+Asyncio support for Flask-Kadabra.
+
+This lives apart from :mod:`flask_kadabra` because it uses syntax which is
+not available on Python 2; it is imported on demand, when
+:func:`~flask_kadabra.record_metrics` or :func:`~flask_kadabra.timed`
+annotates a coroutine function or when ``KADABRA_ASYNCIO_SEND`` is set.
+"""
+import asyncio, logging, os, threading
+
+from functools import wraps
+
+def wrap_coroutine_view(func, start_view, finish_view):
+    # The coroutine counterpart of record_metrics' decorated_view, so the
+    # view is awaited instead of being handed back to Flask unstarted.
+    @wraps(func)
+    async def decorated_view(*args, **kwargs):
+        ctx = start_view()
+        if ctx is None:
+            return await func(*args, **kwargs)
+        rv = await func(*args, **kwargs)
+        finish_view(ctx)
+        return rv
+    return decorated_view
+
+def wrap_coroutine_timer(func, get_timer):
+    # The coroutine counterpart of timed's timed_function.
+    @wraps(func)
+    async def timed_function(*args, **kwargs):
+        timer = get_timer()
+        if timer is None:
+            return await func(*args, **kwargs)
+        with timer:
+            return await func(*args, **kwargs)
+    return timed_function
+
+class AsyncioSender(object):
+    """Sends :class:`~kadabra.Metrics` to a :class:`~kadabra.Kadabra`
+    client's channel from an asyncio event loop, so that neither the request
+    which produced them nor the loop serving async views waits on the
+    channel. Metrics are placed on a bounded :class:`asyncio.Queue` which is
+    drained by a task; each send to the channel is run in the loop's default
+    executor, since the channel itself blocks.
+
+    :meth:`send` may be called from any thread. If no ``loop`` is given the
+    sender runs its own loop in a daemon thread, which is started on the
+    first call to :meth:`send` and restarted if the process has forked since.
+    When the queue is full the metrics being sent are dropped.
+
+    The number of metrics that were enqueued, sent, and dropped (either due to
+    overflow or because the channel raised an error) are available as the
+    :attr:`enqueued`, :attr:`sent`, and :attr:`dropped` attributes.
+
+    :param client: The client whose channel to send metrics to, or another
+                   sender such as a :class:`~flask_kadabra.BatchSender`.
+    :type client: ~kadabra.Kadabra
+
+    :param loop: The event loop to drain the queue on, for example the one
+                 your ASGI server runs. It must be running for metrics to be
+                 sent.
+    :type loop: ~asyncio.AbstractEventLoop
+
+    :param queue_size: The maximum number of metrics waiting to be sent.
+    :type queue_size: int
+
+    :param logger: The name of the logger to use.
+    :type logger: str
+    """
+    def __init__(self, client, loop=None, queue_size=10000,
+            logger="flask_kadabra.sender"):
+        self.client = client
+        self.queue_size = queue_size
+        self.logger = logging.getLogger(logger)
+
+        #: The number of metrics placed on the queue.
+        self.enqueued = 0
+        #: The number of metrics sent to the channel by the drain task.
+        self.sent = 0
+        #: The number of metrics dropped, either because the queue was full or
+        #: because the channel failed to send them.
+        self.dropped = 0
+
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._loop = loop
+        self._own_loop = loop is None
+        self._thread = None
+        self._pid = None
+        # Created on the loop by _start, the first time metrics are put.
+        self._queue = None
+        self._task = None
+
+    def send(self, metrics):
+        """Queue metrics to be sent by the drain task. This never blocks.
+
+        :param metrics: The metrics to send.
+        :type metrics: ~kadabra.Metrics
+        """
+        loop = self._ensure_loop()
+        if _get_running_loop() is loop:
+            self._put(metrics)
+        else:
+            loop.call_soon_threadsafe(self._put, metrics)
+
+    def flush(self, timeout=None):
+        """Wait until every queued metric has been handled by the drain task.
+        This must not be called from the event loop's own thread.
+
+        :param timeout: The maximum number of seconds to wait, or ``None`` to
+                        wait indefinitely.
+        :type timeout: float
+
+        :rtype: bool
+        :returns: Whether the queue was drained before the timeout expired.
+        """
+        loop = self._loop
+        if loop is None or self._pid != os.getpid() or loop.is_closed():
+            return True
+        if _get_running_loop() is loop:
+            raise RuntimeError("flush() would block the sender's event loop")
+        future = asyncio.run_coroutine_threadsafe(self._join(), loop)
+        try:
+            future.result(timeout)
+        except Exception:
+            future.cancel()
+            return False
+        return True
+
+    def close(self, timeout=5.0):
+        """Flush any queued metrics and stop the drain task, as well as the
+        sender's own event loop if it started one. This is registered to run
+        when the interpreter exits.
+
+        :param timeout: The maximum number of seconds to wait for the queue to
+                        be flushed.
+        :type timeout: float
+        """
+        with self._lock:
+            loop = self._loop
+            if loop is None or self._pid != os.getpid() or loop.is_closed():
+                return
+            if not self.flush(timeout):
+                self.logger.warning("Timed out flushing metrics")
+            future = asyncio.run_coroutine_threadsafe(self._stop(), loop)
+            try:
+                future.result(timeout)
+            except Exception:
+                future.cancel()
+            if self._own_loop:
+                loop.call_soon_threadsafe(loop.stop)
+                self._thread.join(timeout)
+                if not self._thread.is_alive():
+                    loop.close()
+                self._loop = None
+                self._thread = None
+            self._pid = None
+
+    def _ensure_loop(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return self._loop
+        with self._lock:
+            if self._pid != pid:
+                # Either this is the first send, or we are in a forked child
+                # whose copy of the loop's thread doesn't exist. Anything left
+                # on the parent's queue belongs to the parent.
+                self._queue = None
+                self._task = None
+                self._prepare()
+                if self._own_loop:
+                    self._loop = asyncio.new_event_loop()
+                    self._thread = threading.Thread(
+                            target=self._loop.run_forever,
+                            name="flask-kadabra-asyncio-sender")
+                    self._thread.daemon = True
+                    self._thread.start()
+                self._pid = pid
+            return self._loop
+
+    def _prepare(self):
+        # Creates the client at the end of the chain of senders while the
+        # interpreter is still running, as flask_kadabra._prepare_client.
+        prepare = getattr(self.client, "_prepare", None)
+        if prepare is not None:
+            prepare()
+
+    def _put(self, metrics):
+        # Always runs on the loop, so needs no locking against _drain.
+        if self._queue is None:
+            self._queue = asyncio.Queue(self.queue_size)
+            self._task = self._loop.create_task(self._drain())
+        try:
+            self._queue.put_nowait(metrics)
+        except asyncio.QueueFull:
+            self._count("dropped")
+            return
+        self._count("enqueued")
+
+    async def _drain(self):
+        queue = self._queue
+        while True:
+            metrics = await queue.get()
+            try:
+                await self._loop.run_in_executor(None, self.client.send,
+                        metrics)
+                self._count("sent")
+            except Exception:
+                self.logger.exception("Failed to send metrics")
+                self._count("dropped")
+            finally:
+                queue.task_done()
+
+    async def _join(self):
+        if self._queue is not None:
+            await self._queue.join()
+
+    async def _stop(self):
+        task, self._task, self._queue = self._task, None, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    def _count(self, name):
+        with self._stats_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+def _get_running_loop():
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
@@ -23,7 +23,7 @@ setup(
     author_email='balexlandau@gmail.com',
     description='Flask extension for the Kadabra metrics framework',
     long_description=__doc__,
-    py_modules=['flask_kadabra'],
+    py_modules=['flask_kadabra', 'flask_kadabra_asyncio'],
     zip_safe=False,
     include_package_data=True,
     platforms='any',
@@ -1,11 +1,22 @@
-from flask import (Flask, g, Response, current_app)
+from flask import (Flask, Blueprint, g, Response, current_app)
 
-from flask_kadabra import Kadabra, record_metrics
+from flask_kadabra import (Kadabra, AsyncSender, BatchSender, Aggregator,
+        SharedAggregator, QuantileSketch, SketchAggregator, KadabraMiddleware,
+        CardinalityLimiter, SlowRequestLog, CircuitBreakerSender,
+        PrometheusExporter, LazyClient, DatagramSender, DatagramReceiver,
+        BinaryRedisChannel, encode_metrics, decode_metrics, record_metrics,
+        record_blueprint_metrics, timed)
 import kadabra
+from kadabra.agent import ReceiverThread
+from kadabra.channels import RedisChannel
+
+import flask_kadabra
+from flask_kadabra_asyncio import AsyncioSender
 
 from mock import mock, MagicMock, call
 
-import datetime
+import asyncio, datetime, inspect, itertools, json, multiprocessing, os
+import random, subprocess, sys, threading, time
 
 NOW = datetime.datetime.utcnow()
 
@@ -45,21 +56,114 @@ def test_init(mock_client):
     kadabra.init_app(app)
 
     assert kadabra.app == app
-    assert app.kadabra == client
+    assert isinstance(app.kadabra, LazyClient)
+    assert app.kadabra_sender == app.kadabra
+    assert not mock_client.called
+    assert app.kadabra.client == client
+    assert app.kadabra_aggregator is None
     assert len(app.before_request_funcs[None]) == 1
     assert app.before_request_funcs[None][0].__name__ == 'initialize_metrics'
     assert len(app.after_request_funcs[None]) == 1
     assert app.after_request_funcs[None][0].__name__ == 'transport_metrics'
+    assert len(app.teardown_request_funcs[None]) == 1
+    assert app.teardown_request_funcs[None][0].__name__ == 'finalize_metrics'
+
+@mock.patch('kadabra.Kadabra')
+def test_lazy_client(mock_client):
+    config = {"CLIENT_DEFAULT_DIMENSIONS": {"host": "a"},
+            "CLIENT_TIMESTAMP_FORMAT": "%Y"}
+    unit = LazyClient(config)
+    collector = unit.metrics()
+    assert unit.default_dimensions == {"host": "a"}
+    assert unit.timestamp_format == "%Y"
+    assert collector.dimensions == {"host": "a"}
+    assert not mock_client.called
+
+    unit.send("a")
+    unit.send("b")
+    mock_client.assert_called_once_with(config)
+    client = mock_client.return_value
+    client.send.assert_has_calls([call("a"), call("b")])
+
+    # A forked child creates its own client.
+    child = MagicMock()
+    mock_client.return_value = child
+    with mock.patch('os.getpid', return_value=os.getpid() + 1):
+        unit.send("c")
+        assert unit.client == child
+    child.send.assert_called_once_with("c")
+    assert mock_client.call_count == 2
+
+AT_EXIT = """
+import sys
+from flask import Flask
+from flask_kadabra import Kadabra, record_metrics
+
+class Channel(object):
+    def send(self, metrics):
+        sys.stdout.write("sent %s\\n" % dict((counter.name, counter.value)
+            for counter in metrics.counters)["RequestTime.count"])
+
+app = Flask("a")
+app.config["KADABRA_AGGREGATE"] = True
+app.config["KADABRA_AGGREGATE_WINDOW"] = 60
+
+@app.route("/")
+@record_metrics
+def index():
+    return "ok"
+
+Kadabra(app)
+app.kadabra.channel_wrapper = lambda channel: Channel()
+app.test_client().get("/")
+"""
+
+def test_lazy_client_at_exit():
+    # The aggregator's last window is only sent at exit, when it is too late
+    # to create the client.
+    output = subprocess.check_output([sys.executable, "-c", AT_EXIT],
+            stderr=subprocess.STDOUT)
+    assert output.decode("utf-8") == "sent 1.0\n"
+
+def test_init_cheap():
+    # Neither importing the extension nor initializing an app imports the
+    # Redis library or connects to the channel.
+    code = ("import sys; from flask import Flask; import flask_kadabra; "
+            "flask_kadabra.Kadabra(Flask('a')); "
+            "sys.exit('redis' in sys.modules)")
+    assert subprocess.call([sys.executable, "-c", code]) == 0
+
+@mock.patch('flask_kadabra._Collector')
+@mock.patch('kadabra.Kadabra')
+def test_init_metrics(mock_client, mock_collector):
+    client = mock_client.return_value
+    client.send = MagicMock()
+
+    app = get_app()
+    @app.route('/')
+    def test_route():
+        return 'test'
 
+    kadabra = Kadabra()
+    kadabra.init_app(app)
+
+    with app.test_client() as c:
+        c.get('/')
+        assert not mock_collector.called
+        client.send.assert_has_calls([])
+
+@mock.patch('flask_kadabra._Collector')
 @mock.patch('kadabra.Kadabra')
-def test_init_metrics(mock_client):
+def test_init_metrics_lazy(mock_client, mock_collector):
     client = mock_client.return_value
-    client.metrics = MagicMock()
+    metrics = mock_collector.return_value
     client.send = MagicMock()
 
     app = get_app()
     @app.route('/')
     def test_route():
+        g.metrics.add_count("first", 1)
+        g.metrics.add_count("second", 1)
         return 'test'
 
     kadabra = Kadabra()
@@ -67,18 +171,23 @@ def test_init_metrics(mock_client):
 
     with app.test_client() as c:
         c.get('/')
-        client.metrics.assert_called_with()
+        mock_collector.assert_called_once_with(
+                app.kadabra.timestamp_format, {}, None)
+        metrics.add_count.assert_has_calls([
+                call("first", 1),
+                call("second", 1)])
         client.send.assert_has_calls([])
 
+@mock.patch('flask_kadabra._Collector')
+@mock.patch('flask_kadabra._get_clock', return_value=0)
 @mock.patch('flask_kadabra._get_now', return_value=NOW)
 @mock.patch('kadabra.Kadabra')
-def test_transport_200(mock_client, mock_get_now):
+def test_transport_200(mock_client, mock_get_now, mock_get_clock,
+        mock_collector):
     client = mock_client.return_value
-    client.metrics = MagicMock()
-    metrics = client.metrics.return_value
+    metrics = mock_collector.return_value
     metrics.add_count = MagicMock()
     metrics.set_timer = MagicMock()
-    metrics.set_dimension = MagicMock()
     metrics.close = MagicMock()
     closed = metrics.close.return_value
     client.send = MagicMock()
@@ -95,25 +204,26 @@ def test_transport_200(mock_client, mock_get_now):
 
     with app.test_client() as c:
         c.get('/')
-        client.metrics.assert_called_with()
-        metrics.set_dimension.assert_called_with("method", "test_route")
+        mock_collector.assert_called_with(app.kadabra.timestamp_format,
+                {"method": "test_route"}, None)
         metrics.set_timer.assert_called_with("RequestTime", NOW - NOW,
-                kadabra.Units.MILLISECONDS)
+                kadabra.Units.MILLISECONDS, timestamp=NOW)
         metrics.add_count.assert_has_calls([
-                call("Failure", 0),
-                call("ClientError", 0)])
+                call("Failure", 0, timestamp=NOW),
+                call("ClientError", 0, timestamp=NOW)])
         metrics.close.assert_called_with()
         client.send.assert_called_with(closed)
 
+@mock.patch('flask_kadabra._Collector')
+@mock.patch('flask_kadabra._get_clock', return_value=0)
 @mock.patch('flask_kadabra._get_now', return_value=NOW)
 @mock.patch('kadabra.Kadabra')
-def test_transport_500(mock_client, mock_get_now):
+def test_transport_500(mock_client, mock_get_now, mock_get_clock,
+        mock_collector):
     client = mock_client.return_value
-    client.metrics = MagicMock()
-    metrics = client.metrics.return_value
+    metrics = mock_collector.return_value
     metrics.add_count = MagicMock()
     metrics.set_timer = MagicMock()
-    metrics.set_dimension = MagicMock()
     metrics.close = MagicMock()
     closed = metrics.close.return_value
     client.send = MagicMock()
@@ -132,25 +242,26 @@ def test_transport_500(mock_client, mock_get_now):
 
     with app.test_client() as c:
         c.get('/')
-        client.metrics.assert_called_with()
-        metrics.set_dimension.assert_called_with("method", "test_route")
+        mock_collector.assert_called_with(app.kadabra.timestamp_format,
+                {"method": "test_route"}, None)
         metrics.set_timer.assert_called_with("RequestTime", NOW - NOW,
-                kadabra.Units.MILLISECONDS)
+                kadabra.Units.MILLISECONDS, timestamp=NOW)
         metrics.add_count.assert_has_calls([
-                call("Failure", 1),
-                call("ClientError", 0)])
+                call("Failure", 1, timestamp=NOW),
+                call("ClientError", 0, timestamp=NOW)])
         metrics.close.assert_called_with()
         client.send.assert_called_with(closed)
 
+@mock.patch('flask_kadabra._Collector')
+@mock.patch('flask_kadabra._get_clock', return_value=0)
 @mock.patch('flask_kadabra._get_now', return_value=NOW)
 @mock.patch('kadabra.Kadabra')
-def test_transport_400(mock_client, mock_get_now):
+def test_transport_400(mock_client, mock_get_now, mock_get_clock,
+        mock_collector):
     client = mock_client.return_value
-    client.metrics = MagicMock()
-    metrics = client.metrics.return_value
+    metrics = mock_collector.return_value
     metrics.add_count = MagicMock()
     metrics.set_timer = MagicMock()
-    metrics.set_dimension = MagicMock()
     metrics.close = MagicMock()
     closed = metrics.close.return_value
     client.send = MagicMock()
@@ -169,25 +280,58 @@ def test_transport_400(mock_client, mock_get_now):
 
     with app.test_client() as c:
         c.get('/')
-        client.metrics.assert_called_with()
-        metrics.set_dimension.assert_called_with("method", "test_route")
+        mock_collector.assert_called_with(app.kadabra.timestamp_format,
+                {"method": "test_route"}, None)
         metrics.set_timer.assert_called_with("RequestTime", NOW - NOW,
-                kadabra.Units.MILLISECONDS)
+                kadabra.Units.MILLISECONDS, timestamp=NOW)
         metrics.add_count.assert_has_calls([
-                call("Failure", 0),
-                call("ClientError", 1)])
+                call("Failure", 0, timestamp=NOW),
+                call("ClientError", 1, timestamp=NOW)])
         metrics.close.assert_called_with()
         client.send.assert_called_with(closed)
 
+@mock.patch('flask_kadabra._Collector')
+@mock.patch('flask_kadabra._get_clock')
+@mock.patch('flask_kadabra._get_now')
+@mock.patch('kadabra.Kadabra')
+def test_transport_clock_jump(mock_client, mock_get_now, mock_get_clock,
+        mock_collector):
+    client = mock_client.return_value
+    metrics = mock_collector.return_value
+
+    # The wall clock is set back an hour while the request is handled, which
+    # must not affect the request time.
+    jumped = NOW - datetime.timedelta(hours=1)
+    mock_get_now.return_value = jumped
+    mock_get_clock.side_effect = [10**12, 10**12 + 10**6, 10**12 + 4 * 10**6,
+            10**12 + 5 * 10**6]
+
+    app = get_app()
+
+    @app.route('/')
+    @record_metrics
+    def test_route():
+        return 'test'
+
+    unit = Kadabra()
+    unit.init_app(app)
+
+    with app.test_client() as c:
+        c.get('/')
+        metrics.set_timer.assert_called_with("RequestTime",
+                datetime.timedelta(milliseconds=5),
+                kadabra.Units.MILLISECONDS, timestamp=jumped)
+
+@mock.patch('flask_kadabra._Collector')
+@mock.patch('flask_kadabra._get_clock', return_value=0)
 @mock.patch('flask_kadabra._get_now', return_value=NOW)
 @mock.patch('kadabra.Kadabra')
-def test_transport_disable(mock_client, mock_get_now):
+def test_transport_disable(mock_client, mock_get_now, mock_get_clock,
+        mock_collector):
     client = mock_client.return_value
-    client.metrics = MagicMock()
-    metrics = client.metrics.return_value
+    metrics = mock_collector.return_value
     metrics.add_count = MagicMock()
     metrics.set_timer = MagicMock()
-    metrics.set_dimension = MagicMock()
     metrics.close = MagicMock()
     closed = metrics.close.return_value
     client.send = MagicMock()
@@ -205,12 +349,2256 @@ def test_transport_disable(mock_client, mock_get_now):
 
     with app.test_client() as c:
         c.get('/')
-        client.metrics.assert_called_with()
-        metrics.set_dimension.assert_called_with("method", "test_route")
+        mock_collector.assert_called_with(app.kadabra.timestamp_format,
+                {"method": "test_route"}, None)
         metrics.set_timer.assert_called_with("RequestTime", NOW - NOW,
-                kadabra.Units.MILLISECONDS)
+                kadabra.Units.MILLISECONDS, timestamp=NOW)
         metrics.add_count.assert_has_calls([
-                call("Failure", 0),
-                call("ClientError", 0)])
+                call("Failure", 0, timestamp=NOW),
+                call("ClientError", 0, timestamp=NOW)])
         metrics.close.assert_called_with()
         client.send.assert_has_calls([])
+
+@mock.patch('kadabra.Kadabra')
+def test_init_async(mock_client):
+    client = mock_client.return_value
+    app = get_app()
+    app.config["KADABRA_ASYNC_SEND"] = True
+    app.config["KADABRA_QUEUE_SIZE"] = 5
+    app.config["KADABRA_QUEUE_OVERFLOW"] = "block"
+    app.config["KADABRA_QUEUE_TIMEOUT"] = 1.0
+
+    unit = Kadabra()
+    unit.init_app(app)
+
+    sender = app.kadabra_sender
+    assert isinstance(sender, AsyncSender)
+    assert sender.client == app.kadabra
+    assert sender.queue_size == 5
+    assert sender.overflow == "block"
+    assert sender.block_timeout == 1.0
+
+@mock.patch('flask_kadabra._Collector')
+@mock.patch('flask_kadabra._get_now', return_value=NOW)
+@mock.patch('kadabra.Kadabra')
+def test_transport_async(mock_client, mock_get_now, mock_collector):
+    client = mock_client.return_value
+    metrics = mock_collector.return_value
+    closed = metrics.close.return_value
+    client.send = MagicMock()
+
+    app = get_app()
+    app.config["KADABRA_ASYNC_SEND"] = True
+
+    @app.route('/')
+    @record_metrics
+    def test_route():
+        return 'test'
+
+    unit = Kadabra()
+    unit.init_app(app)
+
+    with app.test_client() as c:
+        c.get('/')
+    assert app.kadabra_sender.flush(5.0)
+    client.send.assert_called_once_with(closed)
+    assert app.kadabra_sender.enqueued == 1
+    assert app.kadabra_sender.sent == 1
+    assert app.kadabra_sender.dropped == 0
+    app.kadabra_sender.close()
+
+def get_blocked_sender(**kwargs):
+    # Returns a sender whose worker is stuck sending the first metrics until
+    # the returned event is set.
+    client = MagicMock()
+    started = threading.Event()
+    release = threading.Event()
+    def send(metrics):
+        started.set()
+        release.wait(5.0)
+    client.send = MagicMock(side_effect=send)
+    sender = AsyncSender(client, **kwargs)
+    sender.send("first")
+    assert started.wait(5.0)
+    return sender, client, release
+
+def test_async_sender_drop_newest():
+    sender, client, release = get_blocked_sender(queue_size=2)
+    for m in ("a", "b", "c", "d"):
+        sender.send(m)
+    release.set()
+    assert sender.flush(5.0)
+
+    client.send.assert_has_calls([call("first"), call("a"), call("b")])
+    assert client.send.call_count == 3
+    assert sender.enqueued == 3
+    assert sender.sent == 3
+    assert sender.dropped == 2
+    sender.close()
+
+def test_async_sender_drop_oldest():
+    sender, client, release = get_blocked_sender(queue_size=2,
+            overflow="drop_oldest")
+    for m in ("a", "b", "c", "d"):
+        sender.send(m)
+    release.set()
+    assert sender.flush(5.0)
+
+    client.send.assert_has_calls([call("first"), call("c"), call("d")])
+    assert client.send.call_count == 3
+    assert sender.enqueued == 5
+    assert sender.sent == 3
+    assert sender.dropped == 2
+    sender.close()
+
+def test_async_sender_block_timeout():
+    sender, client, release = get_blocked_sender(queue_size=1,
+            overflow="block", block_timeout=0.01)
+    sender.send("a")
+    sender.send("b")
+    assert sender.dropped == 1
+    release.set()
+    assert sender.flush(5.0)
+
+    client.send.assert_has_calls([call("first"), call("a")])
+    assert sender.sent == 2
+    sender.close()
+
+def test_async_sender_send_error():
+    client = MagicMock()
+    client.send = MagicMock(side_effect=Exception("channel down"))
+    sender = AsyncSender(client)
+    sender.send("a")
+    assert sender.flush(5.0)
+
+    assert sender.sent == 0
+    assert sender.dropped == 1
+    sender.close()
+
+def test_async_sender_close():
+    client = MagicMock()
+    sender = AsyncSender(client)
+    sender.send("a")
+    worker = sender._worker
+    sender.close()
+
+    client.send.assert_called_once_with("a")
+    assert not worker.is_alive()
+
+def test_async_sender_flush_timeout():
+    sender, client, release = get_blocked_sender()
+    assert not sender.flush(0.01)
+    release.set()
+    sender.close()
+
+def test_async_sender_bad_overflow():
+    try:
+        AsyncSender(MagicMock(), overflow="nope")
+        assert False
+    except ValueError:
+        pass
+
+def get_redis_client():
+    client = MagicMock()
+    client.channel = RedisChannel(**RedisChannel.DEFAULT_ARGS)
+    client.channel.client = MagicMock()
+    return client
+
+def get_closed_metrics(name):
+    collector = kadabra.Kadabra().metrics()
+    collector.set_dimension("method", name)
+    collector.add_count("Failure", 0)
+    return collector.close()
+
+def test_batch_sender_size():
+    client = get_redis_client()
+    sender = BatchSender(client, batch_size=3, max_latency=60)
+    batch = [get_closed_metrics(str(i)) for i in range(4)]
+    for m in batch:
+        sender.send(m)
+
+    lpush = client.channel.client.lpush
+    assert lpush.call_count == 1
+    args = lpush.call_args[0]
+    assert args[0] == "kadabra_queue"
+    assert [json.loads(a)["dimensions"] for a in args[1:]] ==\
+            [m.serialize()["dimensions"] for m in batch[:3]]
+    assert sender.batches == 1
+    assert sender.sent == 3
+
+    sender.close()
+    assert lpush.call_count == 2
+    assert len(lpush.call_args[0]) == 2
+    assert sender.batches == 2
+    assert sender.sent == 4
+
+def test_batch_sender_latency():
+    client = get_redis_client()
+    sent = threading.Event()
+    client.channel.client.lpush = MagicMock(
+            side_effect=lambda *args: sent.set())
+    sender = BatchSender(client, batch_size=100, max_latency=0.01)
+    sender.send(get_closed_metrics("a"))
+    sender.send(get_closed_metrics("b"))
+
+    assert sent.wait(5.0)
+    assert len(client.channel.client.lpush.call_args[0]) == 3
+    sender.close()
+    assert client.channel.client.lpush.call_count == 1
+
+def test_batch_sender_other_channel():
+    client = MagicMock()
+    sender = BatchSender(client, batch_size=2, max_latency=60)
+    sender.send("a")
+    client.send.assert_has_calls([])
+    sender.send("b")
+
+    client.send.assert_has_calls([call("a"), call("b")])
+    sender.close()
+
+def test_batch_sender_error():
+    client = MagicMock()
+    client.send = MagicMock(side_effect=Exception("channel down"))
+    sender = BatchSender(client, batch_size=2, max_latency=60)
+    sender.send("a")
+    sender.send("b")
+
+    assert sender.batches == 0
+    assert sender.dropped == 2
+    sender.close()
+
+@mock.patch('kadabra.Kadabra')
+def test_init_batch(mock_client):
+    client = mock_client.return_value
+    app = get_app()
+    app.config["KADABRA_BATCH_SIZE"] = 50
+    app.config["KADABRA_BATCH_LATENCY"] = 0.5
+    app.config["KADABRA_ASYNC_SEND"] = True
+
+    unit = Kadabra()
+    unit.init_app(app)
+
+    sender = app.kadabra_sender
+    assert isinstance(sender, AsyncSender)
+    assert isinstance(sender.client, BatchSender)
+    assert sender.client.client == app.kadabra
+    assert sender.client.batch_size == 50
+    assert sender.client.max_latency == 0.5
+
+def get_serialized(metrics):
+    serialized = metrics.serialize()
+    return (dict((d["name"], d["value"]) for d in serialized["dimensions"]),
+            dict((c["name"], c["value"]) for c in serialized["counters"]),
+            dict((t["name"], t["value"]) for t in serialized["timers"]))
+
+def test_aggregator():
+    sender = MagicMock()
+    unit = Aggregator(sender, window=60, buckets=[10, 100])
+    for millis, failure, client_error in ((5, 0, 0), (50, 1, 0), (500, 0, 1),
+            (7, 0, 0)):
+        unit.record({"method": "a"}, datetime.timedelta(milliseconds=millis),
+                failure, client_error)
+    unit.record({"method": "b"}, datetime.timedelta(milliseconds=1), 0, 0)
+    unit.flush()
+
+    assert sender.send.call_count == 2
+    sent = dict((get_serialized(c[0][0])[0]["method"],
+        get_serialized(c[0][0])) for c in sender.send.call_args_list)
+    dimensions, counters, timers = sent["a"]
+    assert counters == {
+            "Failure": 1.0,
+            "ClientError": 1.0,
+            "RequestTime.count": 4.0,
+            "RequestTime.bucket.10": 2.0,
+            "RequestTime.bucket.100": 1.0,
+            "RequestTime.bucket.inf": 1.0}
+    assert timers == {
+            "RequestTime.sum": 562.0,
+            "RequestTime.min": 5.0,
+            "RequestTime.max": 500.0}
+    assert sent["b"][1]["RequestTime.count"] == 1.0
+
+    unit.flush()
+    assert sender.send.call_count == 2
+    unit.close()
+
+def test_aggregator_window():
+    sender = MagicMock()
+    sent = threading.Event()
+    sender.send = MagicMock(side_effect=lambda m: sent.set())
+    unit = Aggregator(sender, window=0.01)
+    unit.record({"method": "a"}, datetime.timedelta(milliseconds=1), 0, 0)
+
+    assert sent.wait(5.0)
+    unit.close()
+    assert sender.send.call_count == 1
+
+def run_threads(target, count):
+    barrier = threading.Barrier(count)
+    def run(i):
+        barrier.wait()
+        target(i)
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+def test_aggregator_threads():
+    sent = []
+    sender = MagicMock()
+    sender.send = sent.append
+    # Flush continually while the threads record, so that no request is lost
+    # to a buffer being drained at the same time.
+    unit = Aggregator(sender, window=0.001, buckets=[10])
+    def record(i):
+        for j in range(2000):
+            unit.record({"method": "a"}, datetime.timedelta(
+                milliseconds=j % 20), j % 2, 0)
+    run_threads(record, 16)
+    unit.close()
+
+    counters = [get_serialized(m)[1] for m in sent]
+    timers = [get_serialized(m)[2] for m in sent]
+    assert sum(c["RequestTime.count"] for c in counters) == 32000
+    assert sum(c["Failure"] for c in counters) == 16000
+    assert sum(c["RequestTime.bucket.10"] for c in counters) == 17600
+    assert sum(t["RequestTime.sum"] for t in timers) == 16 * 100 * 190
+    assert min(t["RequestTime.min"] for t in timers) == 0
+    assert max(t["RequestTime.max"] for t in timers) == 19
+
+    # The buffers of threads that are gone are forgotten once empty.
+    unit.flush()
+    assert unit._buffers._buffers == []
+
+def test_sketch_aggregator_threads():
+    sent = []
+    sender = MagicMock()
+    sender.send = sent.append
+    unit = SketchAggregator(sender, interval=60)
+    def record(i):
+        for j in range(1000):
+            unit.record({"method": "a"}, datetime.timedelta(
+                milliseconds=j + 1))
+    run_threads(record, 8)
+    unit.close()
+
+    assert len(sent) == 1
+    counters, timers = get_serialized(sent[0])[1:]
+    assert counters == {"RequestTime.sketch": 8000.0}
+    assert abs(timers["RequestTime.p50"] - 500) <= 10
+
+def test_batch_sender_threads():
+    sent = []
+    client = MagicMock()
+    client.send = sent.append
+    sender = BatchSender(client, batch_size=7, max_latency=0.001)
+    def send(i):
+        for j in range(1000):
+            sender.send((i, j))
+    run_threads(send, 16)
+    sender.close()
+
+    assert sorted(sent) == [(i, j) for i in range(16) for j in range(1000)]
+    assert sender.sent == 16000
+    assert sender.dropped == 0
+
+def test_thread_counter():
+    counter = flask_kadabra._ThreadCounter()
+    def add(i):
+        for j in range(1000):
+            counter.add()
+        counter.add(i)
+    run_threads(add, 8)
+    counter.add(2)
+
+    assert counter.value == 8000 + sum(range(8)) + 2
+    # The cells of the threads which are gone were folded into the total.
+    assert len(counter._cells) == 1
+
+def test_async_sender_threads():
+    sent = []
+    client = MagicMock()
+    client.send = sent.append
+    sender = AsyncSender(client, queue_size=100000)
+    def send(i):
+        for j in range(1000):
+            sender.send((i, j))
+    run_threads(send, 8)
+    sender.close()
+
+    assert sorted(sent) == [(i, j) for i in range(8) for j in range(1000)]
+    assert sender.enqueued == 8000
+    assert sender.sent == 8000
+    assert sender.dropped == 0
+
+@mock.patch('flask_kadabra._get_now', return_value=NOW)
+def test_transport_aggregate(mock_get_now):
+    app = get_app()
+    app.config["KADABRA_AGGREGATE"] = True
+    app.config["KADABRA_AGGREGATE_WINDOW"] = 60
+
+    @app.route('/')
+    @record_metrics
+    def test_route():
+        return 'test'
+
+    @app.route('/custom')
+    @record_metrics
+    def custom_route():
+        g.metrics.add_count("custom", 1)
+        return 'test'
+
+    unit = Kadabra()
+    unit.init_app(app)
+    app.kadabra.send = MagicMock()
+
+    with app.test_client() as c:
+        c.get('/')
+        c.get('/')
+        app.kadabra.send.assert_has_calls([])
+        c.get('/custom')
+
+    # Only the metrics recorded by the view are sent with the request.
+    assert app.kadabra.send.call_count == 1
+    dimensions, counters, timers = get_serialized(
+            app.kadabra.send.call_args[0][0])
+    assert dimensions == {"method": "custom_route"}
+    assert counters == {"custom": 1.0}
+    assert timers == {}
+
+    app.kadabra_aggregator.close()
+    assert app.kadabra.send.call_count == 3
+    rolled_up = dict((get_serialized(c[0][0])[0]["method"],
+        get_serialized(c[0][0])) for c in
+        app.kadabra.send.call_args_list[1:])
+    assert rolled_up["test_route"][1]["RequestTime.count"] == 2.0
+    assert rolled_up["test_route"][1]["Failure"] == 0.0
+    assert rolled_up["custom_route"][1]["RequestTime.count"] == 1.0
+
+@mock.patch('flask_kadabra._get_now', return_value=NOW)
+def test_transport_aggregate_builtin_counters(mock_get_now, tmp_path):
+    for path in (None, str(tmp_path / "aggregates")):
+        app = get_app()
+        app.config["KADABRA_AGGREGATE"] = True
+        app.config["KADABRA_AGGREGATE_PATH"] = path
+        app.config["KADABRA_STATUS_COUNTS"] = True
+        app.config["KADABRA_REQUEST_SIZE"] = True
+
+        @app.route('/', methods=["POST"])
+        @record_metrics
+        def test_route():
+            return 'test'
+
+        unit = Kadabra()
+        unit.init_app(app)
+        app.kadabra.send = MagicMock()
+
+        with app.test_client() as c:
+            for i in range(10):
+                c.post('/', data=b"abc")
+
+        # The built-in counters don't cause requests to be sent on their own.
+        app.kadabra.send.assert_has_calls([])
+        app.kadabra_aggregator.close()
+        assert app.kadabra.send.call_count == 1
+        counters = get_serialized(app.kadabra.send.call_args[0][0])[1]
+        assert counters["RequestTime.count"] == 10.0
+        assert counters["RequestSize"] == 30.0
+        assert counters["Status2xx"] == 10.0
+        assert counters["Status5xx"] == 0.0
+
+def test_sketch_quantiles():
+    rng = random.Random(42)
+    values = [rng.lognormvariate(3, 1) for i in range(10000)]
+    sketch = QuantileSketch(relative_accuracy=0.01)
+    for v in values:
+        sketch.add(v)
+    values.sort()
+
+    assert sketch.count == 10000
+    for q in (0.0, 0.5, 0.9, 0.99, 1.0):
+        exact = values[int(q * (len(values) - 1))]
+        assert abs(sketch.quantile(q) - exact) <= 0.01 * exact
+
+def test_sketch_zero_and_empty():
+    sketch = QuantileSketch()
+    assert sketch.quantile(0.5) is None
+    sketch.add(0)
+    sketch.add(0)
+    sketch.add(10)
+    assert sketch.quantile(0.5) == 0.0
+    assert abs(sketch.quantile(1.0) - 10) <= 0.1
+
+def test_sketch_bounded():
+    sketch = QuantileSketch(relative_accuracy=0.01, max_buckets=64)
+    for i in range(1, 100000, 7):
+        sketch.add(i)
+
+    assert len(sketch.buckets) <= 64
+    assert sketch.count == len(range(1, 100000, 7))
+    assert abs(sketch.quantile(0.99) - 99000) <= 0.01 * 99000
+
+def test_sketch_merge():
+    first = QuantileSketch()
+    second = QuantileSketch()
+    combined = QuantileSketch()
+    for i in range(1, 1000):
+        (first if i % 2 else second).add(i)
+        combined.add(i)
+    first.merge(second)
+
+    assert first.count == combined.count
+    assert first.buckets == combined.buckets
+    try:
+        first.merge(QuantileSketch(relative_accuracy=0.05))
+        assert False
+    except ValueError:
+        pass
+
+def test_sketch_serialize():
+    sketch = QuantileSketch()
+    for i in range(100):
+        sketch.add(i)
+    unit = QuantileSketch.deserialize(
+            json.loads(json.dumps(sketch.serialize())))
+
+    assert unit.count == sketch.count
+    assert unit.zero_count == sketch.zero_count
+    assert unit.buckets == sketch.buckets
+    assert unit.quantile(0.9) == sketch.quantile(0.9)
+
+def test_sketch_aggregator():
+    sender = MagicMock()
+    unit = SketchAggregator(sender, interval=60, quantiles=(0.5, 0.999))
+    for millis in range(1, 101):
+        unit.record({"method": "a"}, datetime.timedelta(milliseconds=millis))
+    unit.flush()
+
+    assert sender.send.call_count == 1
+    metrics = sender.send.call_args[0][0]
+    dimensions, counters, timers = get_serialized(metrics)
+    assert dimensions == {"method": "a"}
+    assert counters == {"RequestTime.sketch": 100.0}
+    assert sorted(timers) == ["RequestTime.p50", "RequestTime.p99.9"]
+    assert abs(timers["RequestTime.p50"] - 50) <= 0.5
+    sketch = QuantileSketch.deserialize(json.loads(
+        metrics.counters[0].metadata["sketch"]))
+    assert sketch.count == 100
+
+    unit.flush()
+    assert sender.send.call_count == 1
+    unit.close()
+
+@mock.patch('flask_kadabra._get_now', return_value=NOW)
+def test_transport_sketch(mock_get_now):
+    app = get_app()
+    app.config["KADABRA_SKETCH"] = True
+    app.config["KADABRA_SKETCH_INTERVAL"] = 60
+
+    @app.route('/')
+    @record_metrics
+    def test_route():
+        return 'test'
+
+    unit = Kadabra()
+    unit.init_app(app)
+    app.kadabra.send = MagicMock()
+
+    with app.test_client() as c:
+        c.get('/')
+        c.get('/')
+
+    # The request time is still sent with every request.
+    assert app.kadabra.send.call_count == 2
+    app.kadabra_sketches.close()
+    assert app.kadabra.send.call_count == 3
+    dimensions, counters, timers = get_serialized(
+            app.kadabra.send.call_args[0][0])
+    assert dimensions == {"method": "test_route"}
+    assert counters == {"RequestTime.sketch": 2.0}
+
+def get_sampled_app(decorator, status=200, **config):
+    app = get_app()
+    app.config.update(config)
+
+    @app.route('/')
+    @decorator
+    def test_route():
+        g.metrics.add_count("custom", 1)
+        response = Response()
+        response.status_code = status
+        return response
+
+    unit = Kadabra()
+    unit.init_app(app)
+    app.kadabra.send = MagicMock()
+    return app
+
+@mock.patch('random.random', return_value=0.05)
+def test_sample_recorded(mock_random):
+    app = get_sampled_app(record_metrics(sample_rate=0.1))
+
+    with app.test_client() as c:
+        c.get('/')
+
+    assert app.kadabra.send.call_count == 1
+    dimensions, counters, timers = get_serialized(
+            app.kadabra.send.call_args[0][0])
+    assert dimensions == {"method": "test_route"}
+    assert counters == {"custom": 1.0, "SampleWeight": 10.0, "Failure": 0.0,
+            "ClientError": 0.0}
+    assert list(timers) == ["RequestTime"]
+
+@mock.patch('random.random', return_value=0.1)
+def test_sample_builtin_counters(mock_random):
+    app = get_sampled_app(record_metrics(sample_rate=0.5),
+            KADABRA_REQUEST_SIZE=True, KADABRA_STATUS_COUNTS=True)
+
+    with app.test_client() as c:
+        c.get('/', data=b"abc")
+
+    counters = get_serialized(app.kadabra.send.call_args[0][0])[1]
+    assert counters["SampleWeight"] == 2.0
+    assert counters["RequestSize"] == 6.0
+    assert counters["Status2xx"] == 2.0
+
+@mock.patch('flask_kadabra._Collector')
+@mock.patch('random.random', return_value=0.5)
+def test_sample_dropped(mock_random, mock_collector):
+    app = get_sampled_app(record_metrics(sample_rate=0.1))
+
+    with app.test_client() as c:
+        c.get('/')
+
+    assert not mock_collector.called
+    assert not app.kadabra.send.called
+
+@mock.patch('random.random', return_value=0.5)
+def test_sample_keep_errors(mock_random):
+    app = get_sampled_app(record_metrics(sample_rate=0.1), status=500)
+
+    with app.test_client() as c:
+        c.get('/')
+
+    assert app.kadabra.send.call_count == 1
+    dimensions, counters, timers = get_serialized(
+            app.kadabra.send.call_args[0][0])
+    assert dimensions == {"method": "test_route"}
+    assert counters == {"Failure": 1.0, "ClientError": 0.0}
+
+@mock.patch('random.random')
+def test_sample_keep_errors_totals(mock_random):
+    # Every other request fails, and exactly one in ten of both those that
+    # fail and those that don't is sampled in.
+    mock_random.side_effect = itertools.cycle([0.05 if i in (0, 11) else 0.5
+        for i in range(20)])
+    app = get_app()
+
+    @app.route('/<int:status>')
+    @record_metrics(sample_rate=0.1)
+    def test_route(status):
+        return Response(status=status)
+
+    unit = Kadabra()
+    unit.init_app(app)
+    app.kadabra.send = MagicMock()
+    with app.test_client() as c:
+        for i in range(1000):
+            c.get('/%d' % (500 if i % 2 else 200))
+
+    counters = [get_serialized(c[0][0])[1]
+            for c in app.kadabra.send.call_args_list]
+    assert sum(c.get("SampleWeight", 1.0) for c in counters) == 1000.0
+    assert sum(c["Failure"] for c in counters) == 500.0
+    assert sum(1 for c in counters if c["Failure"]) == 500
+
+@mock.patch('random.random', return_value=0.5)
+def test_sample_drop_errors(mock_random):
+    app = get_sampled_app(record_metrics(sample_rate=0.1, keep_errors=False),
+            status=500)
+
+    with app.test_client() as c:
+        c.get('/')
+
+    app.kadabra.send.assert_has_calls([])
+
+@mock.patch('random.random', return_value=0.3)
+def test_sample_app_config(mock_random):
+    app = get_sampled_app(record_metrics, KADABRA_SAMPLE_RATE=0.25)
+
+    with app.test_client() as c:
+        c.get('/')
+    app.kadabra.send.assert_has_calls([])
+
+    mock_random.return_value = 0.2
+    with app.test_client() as c:
+        c.get('/')
+    assert app.kadabra.send.call_count == 1
+    dimensions, counters, timers = get_serialized(
+            app.kadabra.send.call_args[0][0])
+    assert counters["SampleWeight"] == 4.0
+
+@mock.patch('flask_kadabra._get_monotonic')
+@mock.patch('random.random', return_value=0.15)
+def test_sample_max_per_second(mock_random, mock_get_monotonic):
+    app = get_sampled_app(record_metrics(max_per_second=10))
+
+    # Everything is recorded until there is a previous second to go by.
+    mock_get_monotonic.return_value = 100.5
+    with app.test_client() as c:
+        for i in range(50):
+            c.get('/')
+    assert app.kadabra.send.call_count == 50
+
+    # 50 requests in the previous second means a rate of 0.2.
+    app.kadabra.send.reset_mock()
+    mock_get_monotonic.return_value = 101.5
+    with app.test_client() as c:
+        c.get('/')
+    dimensions, counters, timers = get_serialized(
+            app.kadabra.send.call_args[0][0])
+    assert counters["SampleWeight"] == 5.0
+
+    # Traffic from more than a second ago doesn't count.
+    app.kadabra.send.reset_mock()
+    mock_get_monotonic.return_value = 103.5
+    with app.test_client() as c:
+        c.get('/')
+    dimensions, counters, timers = get_serialized(
+            app.kadabra.send.call_args[0][0])
+    assert "SampleWeight" not in counters
+
+def test_aggregator_weight():
+    sender = MagicMock()
+    unit = Aggregator(sender, window=60, buckets=[10])
+    unit.record({"method": "a"}, datetime.timedelta(milliseconds=5), 1, 0,
+            weight=4.0)
+    unit.flush()
+
+    dimensions, counters, timers = get_serialized(sender.send.call_args[0][0])
+    assert counters["RequestTime.count"] == 4.0
+    assert counters["Failure"] == 4.0
+    assert counters["RequestTime.bucket.10"] == 4.0
+    assert timers["RequestTime.sum"] == 20.0
+    assert timers["RequestTime.max"] == 5.0
+    unit.close()
+
+@mock.patch('flask_kadabra._get_clock')
+def test_phase_timers(mock_get_clock):
+    # WSGI entry, before_request, view start, view end, after_request, and the
+    # response being closed.
+    mock_get_clock.side_effect = [x * 10**6 for x in (0, 1, 3, 10, 12, 20)]
+    app = get_app()
+    app.config["KADABRA_PHASE_TIMERS"] = True
+
+    @app.route('/')
+    @record_metrics
+    def test_route():
+        def generate():
+            yield 'a'
+            yield 'b'
+        return Response(generate())
+
+    unit = Kadabra()
+    unit.init_app(app)
+    app.kadabra.send = MagicMock()
+
+    with app.test_client() as c:
+        rv = c.get('/')
+        assert rv.data == b'ab'
+        app.kadabra.send.assert_has_calls([])
+        rv.close()
+
+    assert app.kadabra.send.call_count == 1
+    dimensions, counters, timers = get_serialized(
+            app.kadabra.send.call_args[0][0])
+    assert timers == {
+            "PreDispatchTime": 3.0,
+            "ViewTime": 7.0,
+            "AfterRequestTime": 2.0,
+            "RequestTime": 11.0,
+            "ResponseTime": 8.0}
+
+@mock.patch('flask_kadabra._get_clock')
+def test_phase_timers_aggregate(mock_get_clock, tmp_path):
+    for path in (None, str(tmp_path / "aggregates")):
+        mock_get_clock.side_effect = [x * 10**6 for x in
+                (0, 1, 3, 10, 12, 20, 100, 101, 103, 110, 112, 120)]
+        app = get_app()
+        app.config["KADABRA_PHASE_TIMERS"] = True
+        app.config["KADABRA_AGGREGATE"] = True
+        app.config["KADABRA_AGGREGATE_PATH"] = path
+        app.config["KADABRA_AGGREGATE_WINDOW"] = 60
+
+        @app.route('/')
+        @record_metrics
+        def test_route():
+            return 'test'
+
+        unit = Kadabra()
+        unit.init_app(app)
+        app.kadabra.send = MagicMock()
+
+        with app.test_client() as c:
+            c.get('/').close()
+            c.get('/').close()
+
+        # The phase timers don't cause requests to be sent on their own.
+        assert not app.kadabra.send.called
+        app.kadabra_aggregator.close()
+        assert app.kadabra.send.call_count == 1
+        dimensions, counters, timers = get_serialized(
+                app.kadabra.send.call_args[0][0])
+        assert counters["RequestTime.count"] == 2.0
+        for name in ("PreDispatchTime", "ViewTime", "AfterRequestTime",
+                "ResponseTime"):
+            assert counters[name + ".count"] == 2.0
+        assert timers["PreDispatchTime.sum"] == 6.0
+        assert timers["ViewTime.sum"] == 14.0
+        assert timers["AfterRequestTime.sum"] == 4.0
+        assert timers["ResponseTime.sum"] == 16.0
+        assert timers["RequestTime.sum"] == 22.0
+
+@mock.patch('kadabra.Kadabra')
+def test_phase_timers_disabled(mock_client):
+    app = get_app()
+    wsgi_app = app.wsgi_app
+    unit = Kadabra()
+    unit.init_app(app)
+
+    assert app.kadabra_phase_timers == False
+    assert app.wsgi_app == wsgi_app
+
+@mock.patch('flask_kadabra._get_clock')
+def test_middleware(mock_get_clock):
+    # WSGI entry, before_request, view start, view end, after_request, the
+    # first chunk of the body, and the response being closed.
+    mock_get_clock.side_effect = [x * 10**6 for x in (0, 1, 3, 10, 12, 15, 40)]
+    app = get_app()
+    app.config["KADABRA_WSGI_MIDDLEWARE"] = True
+
+    @app.route('/')
+    @record_metrics
+    def test_route():
+        def generate():
+            yield ''
+            yield 'abc'
+            yield 'de'
+        return Response(generate())
+
+    unit = Kadabra()
+    unit.init_app(app)
+    app.kadabra.send = MagicMock()
+    assert isinstance(app.wsgi_app, KadabraMiddleware)
+
+    with app.test_client() as c:
+        rv = c.get('/')
+        assert rv.data == b'abcde'
+        app.kadabra.send.assert_has_calls([])
+        rv.close()
+
+    assert app.kadabra.send.call_count == 1
+    dimensions, counters, timers = get_serialized(
+            app.kadabra.send.call_args[0][0])
+    assert counters == {"ResponseSize": 5.0, "Failure": 0.0,
+            "ClientError": 0.0}
+    assert timers == {"TimeToFirstByte": 15.0, "RequestTime": 40.0}
+
+def test_middleware_passthrough():
+    app = get_app()
+    app.config["KADABRA_WSGI_MIDDLEWARE"] = True
+
+    @app.route('/')
+    def test_route():
+        return 'test'
+
+    unit = Kadabra()
+    unit.init_app(app)
+    app_iter = MagicMock()
+    unit = KadabraMiddleware(MagicMock(return_value=app_iter))
+
+    assert unit({}, MagicMock()) is app_iter
+    with app.test_client() as c:
+        assert c.get('/').data == b'test'
+
+@mock.patch('flask_kadabra._get_clock')
+def test_middleware_phase_timers(mock_get_clock):
+    mock_get_clock.side_effect = [x * 10**6 for x in (0, 1, 3, 10, 12, 15, 40)]
+    app = get_app()
+    app.config["KADABRA_WSGI_MIDDLEWARE"] = True
+    app.config["KADABRA_PHASE_TIMERS"] = True
+
+    @app.route('/')
+    @record_metrics
+    def test_route():
+        return 'test'
+
+    unit = Kadabra()
+    unit.init_app(app)
+    app.kadabra.send = MagicMock()
+
+    with app.test_client() as c:
+        c.get('/').close()
+
+    dimensions, counters, timers = get_serialized(
+            app.kadabra.send.call_args[0][0])
+    assert timers == {
+            "PreDispatchTime": 3.0,
+            "ViewTime": 7.0,
+            "AfterRequestTime": 2.0,
+            "ResponseTime": 28.0,
+            "TimeToFirstByte": 15.0,
+            "RequestTime": 40.0}
+
+@mock.patch('flask_kadabra._get_clock')
+def test_middleware_phase_timers_aggregate(mock_get_clock, tmp_path):
+    for path in (None, str(tmp_path / "aggregates")):
+        mock_get_clock.side_effect = [x * 10**6 for x in
+                (0, 1, 3, 10, 12, 15, 40, 100, 101, 103, 110, 112, 115, 140)]
+        app = get_app()
+        app.config["KADABRA_WSGI_MIDDLEWARE"] = True
+        app.config["KADABRA_PHASE_TIMERS"] = True
+        app.config["KADABRA_AGGREGATE"] = True
+        app.config["KADABRA_AGGREGATE_PATH"] = path
+        app.config["KADABRA_AGGREGATE_WINDOW"] = 60
+
+        @app.route('/')
+        @record_metrics
+        def test_route():
+            return 'test'
+
+        unit = Kadabra()
+        unit.init_app(app)
+        app.kadabra.send = MagicMock()
+
+        with app.test_client() as c:
+            c.get('/').close()
+            c.get('/').close()
+
+        # The phase timers don't cause requests to be sent on their own.
+        assert not app.kadabra.send.called
+        app.kadabra_aggregator.close()
+        assert app.kadabra.send.call_count == 1
+        dimensions, counters, timers = get_serialized(
+                app.kadabra.send.call_args[0][0])
+        assert counters["RequestTime.count"] == 2.0
+        assert counters["ResponseSize"] == 8.0
+        for name in ("PreDispatchTime", "ViewTime", "AfterRequestTime",
+                "ResponseTime", "TimeToFirstByte"):
+            assert counters[name + ".count"] == 2.0
+        assert timers["PreDispatchTime.sum"] == 6.0
+        assert timers["ViewTime.sum"] == 14.0
+        assert timers["AfterRequestTime.sum"] == 4.0
+        assert timers["ResponseTime.sum"] == 56.0
+        assert timers["TimeToFirstByte.sum"] == 30.0
+        assert timers["RequestTime.sum"] == 80.0
+
+def get_failing_app(testing):
+    app = get_app()
+    app.testing = testing
+
+    @app.route('/')
+    @record_metrics
+    def test_route():
+        raise ValueError("test")
+
+    unit = Kadabra()
+    unit.init_app(app)
+    app.kadabra.send = MagicMock()
+    return app
+
+def test_unhandled_exception():
+    # When exceptions propagate, after_request functions aren't called.
+    app = get_failing_app(True)
+
+    with app.test_client() as c:
+        try:
+            c.get('/')
+            assert False
+        except ValueError:
+            pass
+
+    assert app.kadabra.send.call_count == 1
+    dimensions, counters, timers = get_serialized(
+            app.kadabra.send.call_args[0][0])
+    assert dimensions == {"method": "test_route", "exception": "ValueError"}
+    assert counters == {"Failure": 1.0, "ClientError": 0.0}
+    assert list(timers) == ["RequestTime"]
+
+def test_handled_exception():
+    app = get_failing_app(False)
+
+    with app.test_client() as c:
+        assert c.get('/').status_code == 500
+
+    assert app.kadabra.send.call_count == 1
+    dimensions, counters, timers = get_serialized(
+            app.kadabra.send.call_args[0][0])
+    assert dimensions == {"method": "test_route", "exception": "ValueError"}
+    assert counters == {"Failure": 1.0, "ClientError": 0.0}
+
+def test_send_once():
+    app = get_app()
+
+    @app.route('/')
+    @record_metrics
+    def test_route():
+        return 'test'
+
+    unit = Kadabra()
+    unit.init_app(app)
+    app.kadabra.send = MagicMock()
+
+    with app.app_context():
+        with app.test_client() as c:
+            c.get('/')
+        assert app.kadabra.send.call_count == 1
+        dimensions, counters, timers = get_serialized(
+                app.kadabra.send.call_args[0][0])
+        assert dimensions == {"method": "test_route"}
+
+def test_coroutine_view():
+    app = get_app()
+
+    @app.route('/')
+    @record_metrics
+    async def test_route():
+        await asyncio.sleep(0)
+        g.metrics.add_count("Awaited", 1)
+        return 'test'
+
+    unit = Kadabra()
+    unit.init_app(app)
+    app.kadabra.send = MagicMock()
+
+    assert inspect.iscoroutinefunction(app.view_functions["test_route"])
+    with app.test_client() as c:
+        assert c.get('/').data == b'test'
+
+    assert app.kadabra.send.call_count == 1
+    dimensions, counters, timers = get_serialized(
+            app.kadabra.send.call_args[0][0])
+    assert dimensions == {"method": "test_route"}
+    assert counters == {"Awaited": 1.0, "Failure": 0.0, "ClientError": 0.0}
+
+@mock.patch('kadabra.Kadabra')
+def test_init_asyncio(mock_client):
+    client = mock_client.return_value
+    app = get_app()
+    app.config["KADABRA_ASYNCIO_SEND"] = True
+    app.config["KADABRA_QUEUE_SIZE"] = 5
+
+    unit = Kadabra()
+    unit.init_app(app)
+
+    sender = app.kadabra_sender
+    assert isinstance(sender, AsyncioSender)
+    assert sender.client == app.kadabra
+    assert sender.queue_size == 5
+
+def test_asyncio_sender():
+    client = MagicMock()
+    sender = AsyncioSender(client)
+    for m in ("a", "b"):
+        sender.send(m)
+    assert sender.flush(5.0)
+
+    client.send.assert_has_calls([call("a"), call("b")])
+    assert sender.enqueued == 2
+    assert sender.sent == 2
+    assert sender.dropped == 0
+    thread = sender._thread
+    sender.close()
+    assert not thread.is_alive()
+
+def test_asyncio_sender_overflow():
+    client = MagicMock()
+    started = threading.Event()
+    release = threading.Event()
+    def send(metrics):
+        started.set()
+        release.wait(5.0)
+    client.send = MagicMock(side_effect=send)
+    sender = AsyncioSender(client, queue_size=1)
+    sender.send("first")
+    assert started.wait(5.0)
+    for m in ("a", "b"):
+        sender.send(m)
+    release.set()
+    assert sender.flush(5.0)
+
+    client.send.assert_has_calls([call("first"), call("a")])
+    assert sender.sent == 2
+    assert sender.dropped == 1
+    sender.close()
+
+def test_asyncio_sender_send_error():
+    client = MagicMock()
+    client.send = MagicMock(side_effect=Exception("channel down"))
+    sender = AsyncioSender(client)
+    sender.send("a")
+    assert sender.flush(5.0)
+
+    assert sender.sent == 0
+    assert sender.dropped == 1
+    sender.close()
+
+def test_asyncio_sender_running_loop():
+    client = MagicMock()
+
+    async def main():
+        sender = AsyncioSender(client, loop=asyncio.get_running_loop())
+        sender.send("a")
+        assert sender.enqueued == 1
+        while not sender.sent:
+            await asyncio.sleep(0.001)
+        await sender._stop()
+
+    asyncio.run(main())
+    client.send.assert_called_once_with("a")
+
+def record_shared(path, method, count):
+    unit = SharedAggregator(MagicMock(), path, slots=16, buckets=[10, 100])
+    for i in range(count):
+        unit.record({"method": method},
+                datetime.timedelta(milliseconds=i % 200), i % 2, 0)
+
+def test_shared_aggregator(tmp_path):
+    sender = MagicMock()
+    path = str(tmp_path / "aggregates")
+    unit = SharedAggregator(sender, path, slots=16, buckets=[10, 100])
+    for millis, failure, client_error in ((5, 0, 0), (50, 1, 0), (500, 0, 1),
+            (7, 0, 0)):
+        unit.record({"method": "a"}, datetime.timedelta(milliseconds=millis),
+                failure, client_error)
+    unit.record({"method": "b"}, datetime.timedelta(milliseconds=1), 0, 0)
+    unit.flush()
+
+    assert sender.send.call_count == 2
+    sent = dict((get_serialized(c[0][0])[0]["method"],
+        get_serialized(c[0][0])) for c in sender.send.call_args_list)
+    dimensions, counters, timers = sent["a"]
+    assert counters == {
+            "Failure": 1.0,
+            "ClientError": 1.0,
+            "RequestTime.count": 4.0,
+            "RequestTime.bucket.10": 2.0,
+            "RequestTime.bucket.100": 1.0,
+            "RequestTime.bucket.inf": 1.0}
+    assert timers == {
+            "RequestTime.sum": 562.0,
+            "RequestTime.min": 5.0,
+            "RequestTime.max": 500.0}
+    assert sent["b"][1]["RequestTime.count"] == 1.0
+
+    unit.flush()
+    assert sender.send.call_count == 2
+    unit.close()
+
+def test_shared_aggregator_processes(tmp_path):
+    sender = MagicMock()
+    path = str(tmp_path / "aggregates")
+    unit = SharedAggregator(sender, path, slots=16, buckets=[10, 100])
+    context = multiprocessing.get_context("fork")
+    workers = [context.Process(target=record_shared, args=(path, m, 500))
+            for m in ("a", "a", "b", "b")]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(30)
+        assert worker.exitcode == 0
+    unit.flush()
+
+    assert sender.send.call_count == 2
+    for c in sender.send.call_args_list:
+        dimensions, counters, timers = get_serialized(c[0][0])
+        assert counters["RequestTime.count"] == 1000.0
+        assert counters["Failure"] == 500.0
+        assert timers["RequestTime.max"] == 199.0
+    unit.close()
+
+def test_shared_aggregator_leader(tmp_path):
+    path = str(tmp_path / "aggregates")
+    first_sender, second_sender = MagicMock(), MagicMock()
+    first = SharedAggregator(first_sender, path, slots=16)
+    second = SharedAggregator(second_sender, path, slots=16)
+    first.flush()
+
+    second.record({"method": "a"}, datetime.timedelta(milliseconds=1), 0, 0)
+    second.flush()
+    assert second_sender.send.call_count == 0
+
+    first.record({"method": "a"}, datetime.timedelta(milliseconds=1), 0, 0)
+    first.close()
+    assert first_sender.send.call_count == 1
+    assert get_serialized(first_sender.send.call_args[0][0])[1][
+            "RequestTime.count"] == 2.0
+
+    # Once the first has closed, the second takes over.
+    second.record({"method": "a"}, datetime.timedelta(milliseconds=1), 0, 0)
+    second.flush()
+    assert second_sender.send.call_count == 1
+    second.close()
+
+def test_shared_aggregator_dropped(tmp_path):
+    unit = SharedAggregator(MagicMock(), str(tmp_path / "aggregates"),
+            slots=1, key_size=32)
+    unit.record({"method": "a"}, datetime.timedelta(milliseconds=1), 0, 0)
+    unit.record({"method": "b"}, datetime.timedelta(milliseconds=1), 0, 0)
+    unit.record({"method": "a" * 32}, datetime.timedelta(milliseconds=1), 0,
+            0)
+    assert unit.dropped == 2
+    unit.close()
+
+def test_shared_aggregator_layout(tmp_path):
+    path = str(tmp_path / "aggregates")
+    SharedAggregator(MagicMock(), path, slots=16).close()
+    try:
+        SharedAggregator(MagicMock(), path, slots=32)
+        assert False
+    except ValueError:
+        pass
+
+@mock.patch('kadabra.Kadabra')
+def test_init_shared_aggregate(mock_client, tmp_path):
+    app = get_app()
+    app.config["KADABRA_AGGREGATE"] = True
+    app.config["KADABRA_AGGREGATE_PATH"] = str(tmp_path / "aggregates")
+    app.config["KADABRA_AGGREGATE_SLOTS"] = 8
+
+    unit = Kadabra()
+    unit.init_app(app)
+
+    aggregator = app.kadabra_aggregator
+    assert isinstance(aggregator, SharedAggregator)
+    assert aggregator.slots == 8
+    aggregator.close()
+
+def get_encodable_metrics():
+    timestamp = datetime.datetime(2017, 3, 4, 5, 6, 7, 891011)
+    return kadabra.Metrics(
+            [kadabra.Dimension("method", "test_route"),
+                kadabra.Dimension("exception", u"\u00e9")],
+            [kadabra.Counter("Failure", timestamp, {}, 1.0),
+                kadabra.Counter("RequestTime.sketch", timestamp,
+                    {"sketch": "{}"}, 2.5)],
+            [kadabra.Timer("RequestTime", timestamp, {},
+                datetime.timedelta(0, 3, 456789),
+                kadabra.Units.MILLISECONDS)])
+
+@mock.patch('flask_kadabra._get_now', return_value=NOW)
+def test_encode_metrics(mock_get_now):
+    metrics = get_encodable_metrics()
+    decoded = decode_metrics(encode_metrics(metrics))
+
+    expected = metrics.serialize()
+    actual = decoded.serialize()
+    assert actual.pop("serialized_at") ==\
+            NOW.strftime(metrics.timestamp_format)
+    expected.pop("serialized_at")
+    assert actual == expected
+    assert decoded.timers[0].value == metrics.timers[0].value
+
+    # Metrics that were serialized before keep their timestamp.
+    decoded.serialized_at = "2017-03-04T05:06:07.000000Z"
+    assert decode_metrics(encode_metrics(decoded)).serialized_at ==\
+            "2017-03-04T05:06:07.000000Z"
+
+def test_decode_metrics_invalid():
+    encoded = encode_metrics(get_encodable_metrics())
+    for data in (b"", b"X" + encoded[1:], encoded[:1] + b"\x01" + encoded[2:],
+            encoded[:1] + b"\xff" + encoded[2:], encoded[:-4]):
+        try:
+            decode_metrics(data)
+            assert False
+        except ValueError:
+            pass
+
+def test_decode_metrics_truncated():
+    encoded = encode_metrics(get_encodable_metrics())
+    for length in range(len(encoded)):
+        try:
+            decode_metrics(encoded[:length])
+            assert False
+        except ValueError:
+            pass
+
+def test_datagram_receiver_truncated(tmp_path):
+    path = str(tmp_path / "kadabra.sock")
+    receiver = DatagramReceiver(path, timeout=1.0)
+    receiver._socket.sendto(b"K\x02" + b"\x00" * 8, path)
+    assert receiver.receive() is None
+    assert receiver.dropped == 1
+    receiver.close()
+
+def test_datagram_unix(tmp_path):
+    path = str(tmp_path / "kadabra.sock")
+    receiver = DatagramReceiver(path, timeout=1.0)
+    sender = DatagramSender(path)
+    for method in ("a", "b", "c"):
+        sender.send(kadabra.Metrics([kadabra.Dimension("method", method)],
+            [], []))
+    assert sender.sent == 3
+    assert sender.dropped == 0
+
+    first = receiver.receive()
+    assert first.dimensions[0].value == "a"
+    batch = receiver.receive_batch(10)
+    assert [m.dimensions[0].value for m in batch] == ["b", "c"]
+    assert receiver.receive_batch(10) == []
+    assert receiver.in_progress(2) == [first, batch[0]]
+
+    receiver.complete([first] + batch)
+    assert receiver.in_progress(10) == []
+    sender.close()
+    receiver.close()
+
+def test_datagram_udp():
+    receiver = DatagramReceiver(("127.0.0.1", 0), timeout=1.0)
+    sender = DatagramSender(receiver.address)
+    sender.send(get_encodable_metrics())
+    assert receiver.receive().counters[0].name == "Failure"
+    receiver._socket.sendto(b"garbage", receiver.address)
+    assert receiver.receive() is None
+    assert receiver.dropped == 1
+    sender.close()
+    receiver.close()
+
+def test_datagram_receiver_down(tmp_path):
+    sender = DatagramSender(str(tmp_path / "kadabra.sock"))
+    sender.send(get_encodable_metrics())
+    assert sender.sent == 0
+    assert sender.dropped == 1
+    sender.close()
+
+def test_datagram_agent(tmp_path):
+    path = str(tmp_path / "kadabra.sock")
+    receiver = DatagramReceiver(path, timeout=1.0)
+    DatagramSender(path).send(get_encodable_metrics())
+    publisher = MagicMock()
+
+    ReceiverThread(receiver, publisher, MagicMock())._run_once()
+    assert publisher.publish.call_count == 1
+    assert publisher.publish.call_args[0][0][0].dimensions[0].value ==\
+            "test_route"
+    assert receiver.in_progress(10) == []
+    receiver.close()
+
+def test_transport_datagram(tmp_path):
+    path = str(tmp_path / "kadabra.sock")
+    receiver = DatagramReceiver(path, timeout=1.0)
+    app = get_app()
+    app.config["KADABRA_DATAGRAM_ADDRESS"] = path
+
+    @app.route('/')
+    @record_metrics
+    def test_route():
+        return 'test'
+
+    unit = Kadabra()
+    unit.init_app(app)
+    assert isinstance(app.kadabra_sender, DatagramSender)
+
+    with app.test_client() as c:
+        c.get('/')
+    dimensions, counters, timers = get_serialized(receiver.receive())
+    assert dimensions == {"method": "test_route"}
+    assert counters == {"Failure": 0.0, "ClientError": 0.0}
+    app.kadabra_sender.close()
+    receiver.close()
+
+def test_encode_metrics_compact():
+    metrics = get_closed_metrics("test_route")
+    encoded = encode_metrics(metrics)
+    assert len(encoded) * 4 < len(json.dumps(metrics.serialize()))
+    assert get_serialized(decode_metrics(encoded)) == get_serialized(metrics)
+
+def test_encode_metrics_uninterned():
+    far = datetime.datetime(1999, 12, 31, 23, 59, 59, 999999)
+    unit = kadabra.Unit("minutes", 1.0 / 60)
+    metrics = kadabra.Metrics([kadabra.Dimension("custom", "value")],
+            [kadabra.Counter("Custom", far, {}, 1.0)],
+            [kadabra.Timer("Custom", far, {}, datetime.timedelta(minutes=2),
+                unit)], "%Y-%m-%d %H:%M:%S.%f")
+    decoded = decode_metrics(encode_metrics(metrics))
+    assert decoded.timestamp_format == "%Y-%m-%d %H:%M:%S.%f"
+    assert decoded.counters[0].timestamp == far
+    assert decoded.timers[0].timestamp == far
+    assert decoded.timers[0].unit.name == "minutes"
+    assert get_serialized(decoded) == get_serialized(metrics)
+
+def get_binary_channel():
+    channel = BinaryRedisChannel(**RedisChannel.DEFAULT_ARGS)
+    channel.client = MagicMock()
+    return channel
+
+def test_binary_redis_channel():
+    channel = get_binary_channel()
+    metrics = get_closed_metrics("test_route")
+    channel.send(metrics)
+    raw = channel.client.lpush.call_args[0][1]
+    assert channel.client.lpush.call_args[0][0] == "kadabra_queue"
+    assert raw[:1] == b"K"
+
+    channel.client.brpoplpush = MagicMock(return_value=raw)
+    received = channel.receive()
+    assert get_serialized(received) == get_serialized(metrics)
+
+    channel.client.pipeline.return_value.execute.return_value = [raw, None]
+    batch = channel.receive_batch(2)
+    assert len(batch) == 1
+
+    channel.client.lrange = MagicMock(return_value=[raw])
+    assert len(channel.in_progress(10)) == 1
+
+    channel.complete([received])
+    channel.client.pipeline.return_value.lrem.assert_called_with(
+            "kadabra_inprogress", 1, raw)
+
+def test_binary_redis_channel_json():
+    channel = get_binary_channel()
+    metrics = get_closed_metrics("test_route")
+    raw = json.dumps(metrics.serialize()).encode("utf-8")
+    channel.client.brpoplpush = MagicMock(return_value=raw)
+    received = channel.receive()
+    assert get_serialized(received) == get_serialized(metrics)
+
+    channel.complete([received])
+    channel.client.pipeline.return_value.lrem.assert_called_with(
+            "kadabra_inprogress", 1, raw)
+
+def test_batch_sender_binary():
+    client = MagicMock()
+    client.channel = get_binary_channel()
+    sender = BatchSender(client, batch_size=2, max_latency=60)
+    batch = [get_closed_metrics(str(i)) for i in range(2)]
+    for m in batch:
+        sender.send(m)
+
+    args = client.channel.client.lpush.call_args[0]
+    assert [decode_metrics(a).dimensions[0].value for a in args[1:]] ==\
+            ["0", "1"]
+    sender.close()
+
+def test_init_binary():
+    app = get_app()
+    app.config["KADABRA_BINARY_ENCODING"] = True
+
+    unit = Kadabra()
+    unit.init_app(app)
+
+    assert isinstance(app.kadabra.channel, BinaryRedisChannel)
+    assert app.kadabra.channel.queue_key == "kadabra_queue"
+
+def get_dimensions_app():
+    app = get_app()
+    seen = []
+
+    @app.route('/')
+    @record_metrics
+    def test_route():
+        seen.append(g.metrics.dimensions)
+        return 'test'
+
+    @app.route('/user')
+    @record_metrics
+    def user_route():
+        g.metrics.set_dimension("user_type", "admin")
+        seen.append(g.metrics.dimensions)
+        return 'test'
+
+    unit = Kadabra(app, {"CLIENT_DEFAULT_DIMENSIONS": {"service": "test"}})
+    app.kadabra.send = MagicMock()
+    return app, seen
+
+def test_view_dimensions_shared():
+    app, seen = get_dimensions_app()
+    with app.test_client() as c:
+        c.get('/')
+        c.get('/')
+
+    assert seen[0] is seen[1]
+    assert seen[0] == {"service": "test", "method": "test_route"}
+    for args in app.kadabra.send.call_args_list:
+        assert get_serialized(args[0][0])[0] ==\
+                {"service": "test", "method": "test_route"}
+
+def test_view_dimensions_copy_on_write():
+    app, seen = get_dimensions_app()
+    with app.test_client() as c:
+        c.get('/user')
+        c.get('/')
+        c.get('/user')
+
+    assert seen[0] is not seen[2]
+    assert seen[1] == {"service": "test", "method": "test_route"}
+    assert get_serialized(app.kadabra.send.call_args_list[0][0][0])[0] ==\
+            {"service": "test", "method": "user_route", "user_type": "admin"}
+    assert app.kadabra_view_dimensions["user_route"] ==\
+            {"service": "test", "method": "user_route"}
+    try:
+        app.kadabra_view_dimensions["user_route"]["user_type"] = "admin"
+        assert False
+    except TypeError:
+        pass
+
+def test_view_dimensions_existing_collector():
+    app, seen = get_dimensions_app()
+
+    @app.before_request
+    def count():
+        g.metrics.add_count("Early", 1)
+
+    with app.test_client() as c:
+        c.get('/')
+
+    dimensions, counters, timers = get_serialized(
+            app.kadabra.send.call_args[0][0])
+    assert dimensions == {"service": "test", "method": "test_route"}
+    assert counters["Early"] == 1.0
+
+def test_cardinality_limiter():
+    unit = CardinalityLimiter(max_values=2, max_names=2)
+    assert [unit.limit("user", u) for u in ("a", "b", "c", "a", "d")] ==\
+            ["a", "b", "__other__", "a", "__other__"]
+    assert unit.limit("region", "east") == "east"
+    assert unit.limit("extra", "value") == "__other__"
+    assert unit.folded == 3
+    assert unit.folded_by_name == {"user": 2, "extra": 1}
+
+def test_transport_cardinality_limit():
+    app = get_app()
+    app.config["KADABRA_MAX_DIMENSION_VALUES"] = 2
+    app.config["KADABRA_DIMENSION_OVERFLOW_VALUE"] = "other"
+
+    @app.route('/<user>')
+    @record_metrics
+    def test_route(user):
+        g.metrics.set_dimension("user", user)
+        return 'test'
+
+    unit = Kadabra(app)
+    app.kadabra.send = MagicMock()
+
+    with app.test_client() as c:
+        for user in ("a", "b", "c"):
+            c.get('/' + user)
+
+    sent = [get_serialized(args[0][0])
+            for args in app.kadabra.send.call_args_list]
+    assert [dimensions["user"] for dimensions, _, _ in sent] ==\
+            ["a", "b", "other"]
+    assert "FoldedDimensions" not in sent[1][1]
+    assert sent[2][1]["FoldedDimensions"] == 1.0
+    assert app.kadabra_limiter.folded == 1
+
+def get_blueprint_app(config=None):
+    app = get_app()
+    app.config.update(config or {})
+    api = Blueprint('api', __name__)
+    admin = Blueprint('admin', __name__)
+
+    @api.route('/users/<int:user_id>')
+    def get_user(user_id):
+        g.metrics.add_count("Lookups", 1)
+        return 'test'
+
+    @api.route('/decorated')
+    @record_metrics
+    def decorated():
+        return 'test'
+
+    @admin.route('/users/<int:user_id>')
+    def get_user(user_id):
+        return 'test'
+
+    @app.route('/status')
+    def status():
+        return 'test'
+
+    api.register_blueprint(admin, url_prefix='/admin')
+    app.register_blueprint(api, url_prefix='/api')
+    unit = Kadabra(app)
+    app.kadabra.send = MagicMock()
+    return app, api
+
+def get_sent_dimensions(app):
+    return [get_serialized(args[0][0])[0]
+            for args in app.kadabra.send.call_args_list]
+
+def test_record_blueprint_metrics():
+    app, api = get_blueprint_app()
+    assert record_blueprint_metrics(api) is api
+
+    with app.test_client() as c:
+        c.get('/api/users/1')
+        c.get('/api/admin/users/1')
+        c.get('/api/decorated')
+        c.get('/status')
+        c.get('/missing')
+
+    assert get_sent_dimensions(app) == [
+            {"endpoint": "api.get_user",
+                "url_rule": "/api/users/<int:user_id>"},
+            {"endpoint": "api.admin.get_user",
+                "url_rule": "/api/admin/users/<int:user_id>"},
+            {"method": "decorated"}]
+    assert get_serialized(app.kadabra.send.call_args_list[0][0][0])[1][
+            "Lookups"] == 1.0
+    assert app.kadabra_endpoints["api.decorated"] is None
+    assert app.kadabra_endpoints["status"] is None
+
+@mock.patch('flask_kadabra._get_clock')
+def test_record_blueprint_phase_timers(mock_get_clock):
+    # WSGI entry, before_request, recording started, view start, view end,
+    # after_request, and the response being closed.
+    mock_get_clock.side_effect = [x * 10**6 for x in (0, 1, 2, 3, 10, 12, 20)]
+    app, api = get_blueprint_app({"KADABRA_PHASE_TIMERS": True})
+    record_blueprint_metrics(api)
+
+    with app.test_client() as c:
+        c.get('/api/users/1').close()
+
+    assert app.kadabra.send.call_count == 1
+    timers = get_serialized(app.kadabra.send.call_args[0][0])[2]
+    assert timers == {
+            "PreDispatchTime": 3.0,
+            "ViewTime": 7.0,
+            "AfterRequestTime": 2.0,
+            "RequestTime": 11.0,
+            "ResponseTime": 8.0}
+
+def test_record_blueprints_config():
+    app, api = get_blueprint_app({"KADABRA_RECORD_BLUEPRINTS": ["api.admin"]})
+
+    with app.test_client() as c:
+        c.get('/api/users/1')
+        c.get('/api/admin/users/1')
+        c.get('/api/admin/users/2')
+
+    sent = get_sent_dimensions(app)
+    assert sent == [{"endpoint": "api.admin.get_user",
+            "url_rule": "/api/admin/users/<int:user_id>"}] * 2
+    assert app.kadabra_endpoints["api.get_user"] is None
+    assert list(app.kadabra_endpoints["api.admin.get_user"]) ==\
+            ["/api/admin/users/<int:user_id>"]
+
+def test_record_rules_config():
+    app, api = get_blueprint_app({"KADABRA_RECORD_RULES": ["/api/users/*",
+        "/status"]})
+
+    with app.test_client() as c:
+        c.get('/api/users/1')
+        c.get('/api/admin/users/1')
+        c.get('/status')
+
+    assert get_sent_dimensions(app) == [
+            {"endpoint": "api.get_user",
+                "url_rule": "/api/users/<int:user_id>"},
+            {"endpoint": "status", "url_rule": "/status"}]
+
+@mock.patch('flask_kadabra._Sampler.sample')
+def test_record_rules_sampled_out(mock_sample):
+    mock_sample.return_value = None
+    app, api = get_blueprint_app({"KADABRA_RECORD_RULES": ["/status"],
+        "KADABRA_SAMPLE_RATE": 0.5})
+
+    @app.route('/fail')
+    def fail():
+        raise ValueError()
+
+    app.config["KADABRA_RECORD_RULES"].append("/fail")
+
+    with app.test_client() as c:
+        c.get('/status')
+        c.get('/fail')
+
+    mock_sample.assert_called_with("fail")
+    assert get_sent_dimensions(app) == [{"endpoint": "fail",
+        "url_rule": "/fail", "exception": "ValueError"}]
+
+def get_payload_app(config):
+    app = get_app()
+    app.config.update(config)
+
+    @app.route('/', methods=['GET', 'POST'])
+    @record_metrics
+    def test_route():
+        return 'test'
+
+    @app.route('/missing')
+    @record_metrics
+    def missing():
+        return 'missing', 404
+
+    @app.route('/teapot')
+    @record_metrics
+    def teapot():
+        return 'teapot', 599
+
+    @app.route('/stream')
+    @record_metrics
+    def stream():
+        return Response(iter([b'a', b'b']))
+
+    @app.route('/fail')
+    @record_metrics
+    def fail():
+        raise ValueError()
+
+    unit = Kadabra(app)
+    app.kadabra.send = MagicMock()
+    return app
+
+def test_payload_metrics_disabled():
+    app = get_payload_app({})
+    assert app.kadabra_finalizers == ()
+
+    with app.test_client() as c:
+        c.post('/', data='payload')
+
+    dimensions, counters, timers = get_serialized(
+            app.kadabra.send.call_args[0][0])
+    assert dimensions == {"method": "test_route"}
+    assert sorted(counters) == ["ClientError", "Failure"]
+
+def test_payload_metrics():
+    app = get_payload_app({"KADABRA_REQUEST_SIZE": True,
+        "KADABRA_RESPONSE_SIZE": True, "KADABRA_STATUS_COUNTS": True,
+        "KADABRA_STATUS_DIMENSION": True})
+
+    with app.test_client() as c:
+        c.post('/', data='payload')
+        c.get('/missing')
+        c.get('/teapot')
+        c.get('/stream')
+        c.get('/fail')
+
+    sent = [get_serialized(args[0][0])
+            for args in app.kadabra.send.call_args_list]
+    assert [d["status"] for d, _, _ in sent] ==\
+            ["200", "404", "other", "200", "500"]
+    assert [c["RequestSize"] for _, c, _ in sent] == [7, 0, 0, 0, 0]
+    assert [c.get("ResponseSize") for _, c, _ in sent[:4]] ==\
+            [4, 7, 6, None]
+    assert sent[4][1]["ResponseSize"] > 0
+    assert [[c["Status%dxx" % i] for i in range(2, 6)]
+            for _, c, _ in sent] == [[1, 0, 0, 0], [0, 0, 1, 0],
+                    [0, 0, 0, 1], [1, 0, 0, 0], [0, 0, 0, 1]]
+    assert sent[4][0]["exception"] == "ValueError"
+
+@mock.patch('flask_kadabra._Sampler.sample')
+def test_status_counts_weighted(mock_sample):
+    mock_sample.return_value = 4.0
+    app = get_payload_app({"KADABRA_STATUS_COUNTS": True,
+        "KADABRA_SAMPLE_RATE": 0.25})
+
+    with app.test_client() as c:
+        c.get('/missing')
+
+    counters = get_serialized(app.kadabra.send.call_args[0][0])[1]
+    assert counters["Status4xx"] == 4.0
+    assert counters["Status2xx"] == 0
+
+def test_slow_request_log():
+    unit = SlowRequestLog(threshold=100, size=2)
+    assert unit.threshold == datetime.timedelta(milliseconds=100)
+
+    for i in range(3):
+        collector = kadabra.Kadabra().metrics()
+        collector.set_dimension("method", "route%d" % i)
+        collector.add_count("Lookups", i)
+        collector.set_timer("ViewTime", datetime.timedelta(milliseconds=120),
+                kadabra.Units.MILLISECONDS)
+        unit.capture(collector, datetime.timedelta(milliseconds=150),
+                {"a.py:f:1": 1, "a.py:f:1;b.py:g:2": 3} if i else None)
+
+    records = unit.records()
+    assert unit.captured == 3
+    assert [r["dimensions"]["method"] for r in records] ==\
+            ["route1", "route2"]
+    assert records[1]["request_time"] == 150.0
+    assert records[1]["counters"] == {"Lookups": 2.0}
+    assert records[1]["timers"] == {"ViewTime": 120.0}
+    assert records[1]["profile"] == [["a.py:f:1;b.py:g:2", 3],
+            ["a.py:f:1", 1]]
+    unit.clear()
+    assert unit.records() == []
+
+def get_slow_app(config):
+    app = get_app()
+    app.config.update(config)
+
+    @app.route('/')
+    @record_metrics
+    def test_route():
+        g.metrics.add_count("Lookups", 1)
+        return 'test'
+
+    @app.route('/slow')
+    @record_metrics
+    def slow_route():
+        time.sleep(0.05)
+        return 'test'
+
+    unit = Kadabra(app)
+    app.kadabra.send = MagicMock()
+    return app
+
+def test_slow_requests_disabled():
+    app = get_slow_app({})
+    assert app.kadabra_slow_requests is None
+    assert app.kadabra_profiler is None
+
+def test_slow_requests():
+    app = get_slow_app({"KADABRA_SLOW_REQUEST_THRESHOLD": 25,
+        "KADABRA_SLOW_REQUEST_URL": "/_slow"})
+
+    with app.test_client() as c:
+        c.get('/')
+        c.get('/slow')
+        records = json.loads(c.get('/_slow').data)["records"]
+
+    assert len(records) == 1
+    assert records[0]["dimensions"] == {"method": "slow_route"}
+    assert records[0]["request_time"] >= 50
+    assert records[0]["profile"] is None
+    assert app.kadabra.send.call_count == 2
+
+def test_slow_requests_profile():
+    app = get_slow_app({"KADABRA_SLOW_REQUEST_THRESHOLD": 0,
+        "KADABRA_SLOW_REQUEST_PROFILE": 1})
+
+    with app.test_client() as c:
+        c.get('/')
+        c.get('/slow')
+    app.kadabra_profiler.close()
+
+    records = app.kadabra_slow_requests.records()
+    assert records[0]["counters"] == {"Lookups": 1.0}
+    assert any("slow_route" in stack for stack, count in records[1]["profile"])
+    assert app.kadabra_profiler._samples == {}
+
+def test_slow_requests_profile_async():
+    app = get_slow_app({"KADABRA_SLOW_REQUEST_THRESHOLD": 0,
+        "KADABRA_SLOW_REQUEST_PROFILE": 1})
+
+    @app.route('/async')
+    @record_metrics
+    async def async_route():
+        # Blocks, so that the coroutine is on the stack when it is sampled.
+        time.sleep(0.05)
+        return 'test'
+
+    with app.test_client() as c:
+        c.get('/async')
+    app.kadabra_profiler.close()
+
+    profile = app.kadabra_slow_requests.records()[0]["profile"]
+    assert any("async_route" in stack for stack, count in profile)
+    assert app.kadabra_profiler._samples == {}
+
+def get_timer_app():
+    app = get_app()
+
+    @timed("DatabaseTime")
+    def query(millis):
+        time.sleep(millis / 1000.0)
+
+    @timed
+    def render():
+        pass
+
+    @app.route('/')
+    @record_metrics
+    def test_route():
+        query(5)
+        with g.metrics.timer("Checkout"):
+            query(10)
+            query(1)
+        render()
+        return 'test'
+
+    unit = Kadabra(app)
+    app.kadabra.send = MagicMock()
+    return app, query
+
+def test_timers():
+    app, query = get_timer_app()
+    query(0)
+
+    with app.test_client() as c:
+        c.get('/')
+
+    dimensions, counters, timers = get_serialized(
+            app.kadabra.send.call_args[0][0])
+    assert counters["DatabaseTime.count"] == 1.0
+    assert counters["Checkout/DatabaseTime.count"] == 2.0
+    assert counters["Checkout.count"] == 1.0
+    assert counters["render.count"] == 1.0
+    assert timers["DatabaseTime.sum"] >= 5
+    assert timers["Checkout/DatabaseTime.sum"] >= 11
+    assert 10 <= timers["Checkout/DatabaseTime.max"] <\
+            timers["Checkout/DatabaseTime.sum"]
+    assert timers["Checkout.max"] >= timers["Checkout/DatabaseTime.sum"]
+
+def test_timer_exception():
+    app = get_app()
+
+    @app.route('/')
+    @record_metrics
+    def test_route():
+        try:
+            with g.metrics.timer("Outer"):
+                with g.metrics.timer("Inner"):
+                    raise ValueError()
+        except ValueError:
+            pass
+        with g.metrics.timer("Next"):
+            pass
+        return 'test'
+
+    unit = Kadabra(app)
+    app.kadabra.send = MagicMock()
+
+    with app.test_client() as c:
+        c.get('/')
+
+    counters = get_serialized(app.kadabra.send.call_args[0][0])[1]
+    assert sorted(counters) == ["ClientError", "Failure", "Next.count",
+            "Outer.count", "Outer/Inner.count"]
+
+def test_timers_sampled_out():
+    app, query = get_timer_app()
+    app.kadabra_sampler = MagicMock(keep_errors=False)
+    app.kadabra_sampler.sample.return_value = None
+
+    with app.test_client() as c:
+        c.get('/')
+
+    app.kadabra.send.assert_not_called()
+
+def test_timed_coroutine():
+    app = get_app()
+
+    @timed("FetchTime")
+    async def fetch():
+        await asyncio.sleep(0.001)
+        return 'test'
+
+    @app.route('/')
+    @record_metrics
+    async def test_route():
+        return await fetch()
+
+    unit = Kadabra(app)
+    app.kadabra.send = MagicMock()
+
+    with app.test_client() as c:
+        assert c.get('/').data == b'test'
+
+    counters = get_serialized(app.kadabra.send.call_args[0][0])[1]
+    assert counters["FetchTime.count"] == 1.0
+
+def test_timed_gather():
+    app = get_app()
+
+    @timed("A")
+    async def a():
+        await asyncio.sleep(0.01)
+
+    @timed("B")
+    async def b():
+        await asyncio.sleep(0.001)
+
+    @app.route('/')
+    @record_metrics
+    async def test_route():
+        with g.metrics.timer("Outer"):
+            await asyncio.gather(a(), b())
+        await asyncio.gather(a(), b())
+        return 'test'
+
+    unit = Kadabra(app)
+    app.kadabra.send = MagicMock()
+
+    with app.test_client() as c:
+        c.get('/')
+
+    counters = get_serialized(app.kadabra.send.call_args[0][0])[1]
+    assert sorted(name for name in counters if name.endswith(".count")) == [
+            "A.count", "B.count", "Outer.count", "Outer/A.count",
+            "Outer/B.count"]
+
+def get_breaker(tmp_path, **kwargs):
+    client = MagicMock()
+    client.send = MagicMock(side_effect=Exception("channel down"))
+    unit = CircuitBreakerSender(client, str(tmp_path / "spill"),
+            failure_threshold=2, reset_timeout=30, **kwargs)
+    return client, unit
+
+def get_spilled(tmp_path):
+    with open(str(tmp_path / "spill"), "rb") as f:
+        return [decode_metrics(record)
+                for record in flask_kadabra._unframe(f.read())]
+
+def test_circuit_breaker_closed_takes_no_lock(tmp_path):
+    client = MagicMock()
+    unit = CircuitBreakerSender(client, str(tmp_path / "spill"))
+    unit.send(get_encodable_metrics())
+    unit._lock = MagicMock()
+    def send(i):
+        for j in range(100):
+            unit.send(get_encodable_metrics())
+    run_threads(send, 4)
+
+    assert not unit._lock.__enter__.called
+    assert unit.sent == 401
+    assert unit.state == "closed"
+
+@mock.patch('flask_kadabra._get_monotonic', return_value=100.0)
+def test_circuit_breaker_opens(mock_monotonic, tmp_path):
+    client, unit = get_breaker(tmp_path)
+    metrics = get_encodable_metrics()
+
+    unit.send(metrics)
+    assert unit.state == "closed"
+    unit.send(metrics)
+    assert unit.state == "open"
+    unit.send(metrics)
+
+    assert client.send.call_count == 2
+    assert unit.failures == 2
+    assert unit.spilled == 3
+    assert unit.sent == 0
+    assert [get_serialized(m) for m in get_spilled(tmp_path)] ==\
+            [get_serialized(metrics)] * 3
+
+    # The trial send fails, so the circuit stays open.
+    mock_monotonic.return_value = 130.0
+    assert unit.state == "half-open"
+    unit.send(metrics)
+    assert client.send.call_count == 3
+    assert unit.state == "open"
+    mock_monotonic.return_value = 159.0
+    unit.send(metrics)
+    assert client.send.call_count == 3
+    assert unit.spilled == 5
+
+@mock.patch('flask_kadabra._get_monotonic', return_value=100.0)
+def test_circuit_breaker_replays(mock_monotonic, tmp_path):
+    client, unit = get_breaker(tmp_path, replay_batch_size=2)
+    metrics = get_encodable_metrics()
+    for i in range(5):
+        unit.send(metrics)
+
+    client.send.side_effect = None
+    mock_monotonic.return_value = 130.0
+    unit.send(metrics)
+    assert unit.state == "closed"
+    assert unit.flush(5.0)
+
+    assert unit.sent == 1
+    assert unit.replayed == 5
+    assert client.send.call_count == 2 + 1 + 5
+    assert not os.path.exists(str(tmp_path / "spill"))
+    assert not os.path.exists(str(tmp_path / "spill.replaying"))
+
+@mock.patch('flask_kadabra._get_monotonic', return_value=100.0)
+def test_circuit_breaker_replay_fails(mock_monotonic, tmp_path):
+    client, unit = get_breaker(tmp_path, replay_batch_size=2)
+    metrics = get_encodable_metrics()
+    for i in range(6):
+        unit.send(metrics)
+
+    # The first batch of the replay is sent, the second one fails.
+    client.send.side_effect = [None, None, None, Exception("down again")]
+    mock_monotonic.return_value = 130.0
+    unit.send(metrics)
+    assert unit.flush(5.0)
+
+    assert unit.replayed == 2
+    assert unit.state == "open"
+    assert len(get_spilled(tmp_path)) == 4
+
+def test_circuit_breaker_leftover_spill(tmp_path):
+    metrics = get_encodable_metrics()
+    with open(str(tmp_path / "spill"), "wb") as f:
+        f.write(flask_kadabra._frame(encode_metrics(metrics)) * 2)
+        # Partly written when the process died.
+        f.write(flask_kadabra._frame(encode_metrics(metrics))[:10])
+
+    client = MagicMock()
+    unit = CircuitBreakerSender(client, str(tmp_path / "spill"))
+    unit.send(metrics)
+    assert unit.flush(5.0)
+
+    assert unit.sent == 1
+    assert unit.replayed == 2
+    assert client.send.call_count == 3
+
+def test_circuit_breaker_undecodable_spill(tmp_path):
+    metrics = get_encodable_metrics()
+    with open(str(tmp_path / "spill"), "wb") as f:
+        f.write(flask_kadabra._frame(b"garbage"))
+        f.write(flask_kadabra._frame(encode_metrics(metrics)))
+        f.write(flask_kadabra._frame(b"garbage"))
+
+    def lpush(key, *values):
+        # Like Redis, which rejects a push with no values.
+        if not values:
+            raise Exception("wrong number of arguments")
+    client = MagicMock()
+    client.channel = get_redis_client().channel
+    client.channel.client.lpush.side_effect = lpush
+    unit = CircuitBreakerSender(client, str(tmp_path / "spill"),
+            replay_batch_size=1)
+    unit.send(metrics)
+    assert unit.flush(5.0)
+
+    assert unit.state == "closed"
+    assert unit.failures == 0
+    assert unit.replayed == 1
+    assert unit.dropped == 2
+    assert client.send.call_count == 1
+    assert client.channel.client.lpush.call_count == 1
+    assert not os.path.exists(str(tmp_path / "spill"))
+
+def test_circuit_breaker_limits(tmp_path):
+    client, unit = get_breaker(tmp_path, max_spill_size=300)
+    for i in range(10):
+        unit.send(get_encodable_metrics())
+
+    assert unit.spilled + unit.dropped == 10
+    assert 0 < unit.spilled < 10
+    assert os.path.getsize(str(tmp_path / "spill")) <= 300
+
+    client, unit = get_breaker(tmp_path)
+    unit.spill_path = None
+    unit.send(get_encodable_metrics())
+    assert unit.dropped == 1
+
+def test_circuit_breaker_batches(tmp_path):
+    client, unit = get_breaker(tmp_path)
+    client.channel = get_redis_client().channel
+    client.channel.client.lpush.side_effect = Exception("channel down")
+    sender = BatchSender(unit, batch_size=2, max_latency=60)
+    metrics = get_encodable_metrics()
+    sender.send(metrics)
+    sender.send(metrics)
+
+    assert client.channel.client.lpush.call_count == 1
+    assert sender.batches == 1
+    assert unit.spilled == 2
+    sender.close()
+
+@mock.patch('kadabra.Kadabra')
+def test_init_circuit_breaker(mock_client, tmp_path):
+    client = mock_client.return_value
+    app = get_app()
+    app.config["KADABRA_CIRCUIT_BREAKER"] = True
+    app.config["KADABRA_SPILL_PATH"] = str(tmp_path / "spill")
+    app.config["KADABRA_CIRCUIT_FAILURES"] = 3
+    app.config["KADABRA_ASYNC_SEND"] = True
+
+    unit = Kadabra(app)
+
+    sender = app.kadabra_sender
+    assert isinstance(sender, AsyncSender)
+    assert isinstance(sender.client, CircuitBreakerSender)
+    assert sender.client.client == app.kadabra
+    assert sender.client.failure_threshold == 3
+    assert sender.client.reset_timeout == 30.0
+
+PROMETHEUS_TEXT = """\
+# HELP kadabra_requests_total Requests recorded by Flask-Kadabra.
+# TYPE kadabra_requests_total counter
+kadabra_requests_total{method="a"} 3.0
+kadabra_requests_total{method="b\\"\\n",r_1="e"} 1.0
+# HELP kadabra_failures_total Requests that failed with a server error.
+# TYPE kadabra_failures_total counter
+kadabra_failures_total{method="a"} 1.0
+kadabra_failures_total{method="b\\"\\n",r_1="e"} 0.0
+# HELP kadabra_client_errors_total Requests that failed with a client error.
+# TYPE kadabra_client_errors_total counter
+kadabra_client_errors_total{method="a"} 1.0
+kadabra_client_errors_total{method="b\\"\\n",r_1="e"} 0.0
+# HELP kadabra_request_duration_seconds The time taken by requests.
+# TYPE kadabra_request_duration_seconds histogram
+kadabra_request_duration_seconds_bucket{method="a",le="0.01"} 1.0
+kadabra_request_duration_seconds_bucket{method="a",le="0.1"} 2.0
+kadabra_request_duration_seconds_bucket{method="a",le="+Inf"} 3.0
+kadabra_request_duration_seconds_sum{method="a"} 0.555
+kadabra_request_duration_seconds_count{method="a"} 3.0
+kadabra_request_duration_seconds_bucket{method="b\\"\\n",r_1="e",le="0.01"} 1.0
+kadabra_request_duration_seconds_bucket{method="b\\"\\n",r_1="e",le="0.1"} 1.0
+kadabra_request_duration_seconds_bucket{method="b\\"\\n",r_1="e",le="+Inf"} 1.0
+kadabra_request_duration_seconds_sum{method="b\\"\\n",r_1="e"} 0.001
+kadabra_request_duration_seconds_count{method="b\\"\\n",r_1="e"} 1.0
+"""
+
+def record_prometheus(unit):
+    for millis, failure, client_error in ((5, 0, 0), (50, 1, 0),
+            (500, 0, 1)):
+        unit.record({"method": "a"}, datetime.timedelta(milliseconds=millis),
+                failure, client_error)
+    unit.record({"method": 'b"\n', "r-1": "e"},
+            datetime.timedelta(milliseconds=1), 0, 0)
+
+def test_prometheus_exporter():
+    unit = PrometheusExporter(buckets=[10, 100])
+    record_prometheus(unit)
+    assert unit.render() == PROMETHEUS_TEXT
+
+def test_prometheus_exporter_shared(tmp_path):
+    path = str(tmp_path / "totals")
+    context = multiprocessing.get_context("fork")
+    worker = context.Process(target=record_prometheus,
+            args=(PrometheusExporter(path, slots=16, buckets=[10, 100]),))
+    worker.start()
+    worker.join(30)
+    assert worker.exitcode == 0
+
+    unit = PrometheusExporter(path, slots=16, buckets=[10, 100])
+    assert unit.render() == PROMETHEUS_TEXT
+    unit.close()
+
+@mock.patch('flask_kadabra._get_monotonic', return_value=100.0)
+def test_prometheus_exporter_cache(mock_monotonic):
+    unit = PrometheusExporter(buckets=[10, 100], interval=5.0)
+    record_prometheus(unit)
+    body = unit.render()
+    unit.record({"method": "a"}, datetime.timedelta(milliseconds=5), 0, 0)
+    series = dict(unit._series)
+
+    mock_monotonic.return_value = 104.0
+    assert unit.render() is body
+    mock_monotonic.return_value = 105.0
+    assert 'kadabra_requests_total{method="a"} 4.0' in unit.render()
+    # Only the series which changed were formatted again.
+    assert [key for key in series if unit._series[key] is series[key]] ==\
+            [(("method", 'b"\n'), ("r-1", "e"))]
+
+def test_prometheus_endpoint():
+    app = get_app()
+    app.config["KADABRA_PROMETHEUS"] = True
+    app.config["KADABRA_SEND_METRICS"] = False
+
+    @app.route('/')
+    @record_metrics
+    def test_route():
+        return 'test'
+
+    unit = Kadabra(app)
+    app.kadabra.send = MagicMock()
+
+    with app.test_client() as c:
+        c.get('/')
+        c.get('/')
+        response = c.get('/metrics')
+
+    assert response.content_type == PrometheusExporter.CONTENT_TYPE
+    assert 'kadabra_requests_total{method="test_route"} 2.0\n' in\
+            response.get_data(as_text=True)
+    app.kadabra.send.assert_not_called()